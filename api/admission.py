@@ -0,0 +1,168 @@
+import asyncio
+import time
+from collections import deque
+from typing import AsyncIterator, Deque, Dict, Optional
+
+import pymongo
+from fastapi import HTTPException, WebSocketException, status
+from fastapi.requests import HTTPConnection
+from pymongo.errors import PyMongoError
+
+from api.config import get_settings
+from api.metrics import admission_in_flight, admission_queue_depth, admission_shed
+
+# The routes that run for as long as the collection takes, they have no deadline. A client stops them by
+# disconnecting.
+UNBOUNDED_ROUTES = frozenset({"/populate", "/users/export", "/users/import", "/users/changes"})
+# The routes that must still answer when the API is overloaded.
+EXEMPT_ROUTE_PREFIXES = ("/diagnostics/",)
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+class Overloaded(Exception):
+    """Raised when a request is shed, with the reason: `queue_full` or `queue_timeout`."""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class AdmissionController:
+    """Bounds the requests of one route that are handled at the same time.
+
+    At most `limit` requests run; the next `max_queue` wait in FIFO order, for at most `queue_timeout` seconds. Any
+    other request is shed right away, so that an overloaded worker answers 503 in microseconds instead of piling up
+    requests that will time out anyway."""
+
+    def __init__(self, route: str, limit: int, max_queue: int, queue_timeout: float):
+        self.route = route
+        self.limit = limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.running = 0
+        self.admitted = 0
+        self.shed: Dict[str, int] = {"queue_full": 0, "queue_timeout": 0, "deadline": 0}
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self, timeout: Optional[float] = None):
+        """Wait for a slot, for at most `timeout` seconds or the `queue_timeout`. Raises Overloaded when the queue
+        is full or the wait times out."""
+        if self.running < self.limit and not self._waiters:
+            self._admit()
+            return
+        if len(self._waiters) >= self.max_queue:
+            self.record_shed("queue_full")
+            raise Overloaded("queue_full")
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        admission_queue_depth.labels(self.route).inc()
+        try:
+            await asyncio.wait_for(future, min(self.queue_timeout, timeout if timeout is not None else float("inf")))
+        except asyncio.TimeoutError:
+            self.record_shed("queue_timeout")
+            raise Overloaded("queue_timeout")
+        except BaseException:
+            # Cancelled, e.g. the client disconnected, after `release` handed it the slot.
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        finally:
+            if future in self._waiters:
+                self._waiters.remove(future)
+            admission_queue_depth.labels(self.route).dec()
+
+    def release(self):
+        """Free a slot, or hand it over to the oldest waiting request."""
+        while self._waiters:
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                self.admitted += 1
+                return
+        self.running -= 1
+        admission_in_flight.labels(self.route).dec()
+
+    def _admit(self):
+        self.running += 1
+        self.admitted += 1
+        admission_in_flight.labels(self.route).inc()
+
+    def record_shed(self, reason: str):
+        self.shed[reason] += 1
+        admission_shed.labels(self.route, reason).inc()
+
+    def stats(self) -> Dict[str, object]:
+        return {"limit": self.limit, "max_queue": self.max_queue, "running": self.running, "waiting": self.waiting,
+                "admitted": self.admitted, "shed": dict(self.shed)}
+
+
+# One controller per route, created on the first request of the route, in the worker that handles it.
+controllers: Dict[str, AdmissionController] = {}
+
+
+def get_controller(route: str) -> AdmissionController:
+    if route not in controllers:
+        settings = get_settings()
+        controllers[route] = AdmissionController(
+            route, limit=settings.admission_route_limits.get(route, settings.admission_max_concurrency),
+            max_queue=settings.admission_max_queue, queue_timeout=settings.admission_queue_timeout_ms / 1000)
+    return controllers[route]
+
+
+def is_timeout(error: Optional[BaseException]) -> bool:
+    """Whether a MongoDB operation failed because the deadline of the request expired."""
+    return isinstance(error, PyMongoError) and error.timeout
+
+
+def _unavailable(detail: str) -> HTTPException:
+    return HTTPException(status_code=503, detail=detail,
+                         headers={"Retry-After": str(get_settings().admission_retry_after_seconds)})
+
+
+async def admission(connection: HTTPConnection) -> AsyncIterator[None]:
+    """Dependency that admits a request, or a WebSocket, through the controller of its route, and runs it with a
+    deadline.
+
+    The deadline starts when the request arrives, so that the time spent in the queue counts. Every MongoDB operation
+    of the request gets the time left as `maxTimeMS`, so that the server stops the work of a request that the client
+    has given up on. A request that runs out of time answers 503, including when the endpoint turned the timeout
+    into a 500."""
+    route = connection.scope["route"].path
+    if route.startswith(EXEMPT_ROUTE_PREFIXES):
+        yield
+        return
+    settings = get_settings()
+    arrived = time.monotonic()
+    # The NDJSON stream of the users runs for as long as the collection takes, like the unbounded routes. The header
+    # only lifts the deadline there, the other routes answer with a bounded amount of work whatever is accepted.
+    streamed = route == "/users" and connection.scope.get("method") == "GET" and \
+        NDJSON_MEDIA_TYPE in connection.headers.get("accept", "")
+    unbounded = route in UNBOUNDED_ROUTES or streamed
+    timeout = None if unbounded or not settings.request_timeout_ms else settings.request_timeout_ms / 1000
+    controller = get_controller(route)
+    try:
+        await controller.acquire(timeout)
+    except Overloaded:
+        if connection.scope["type"] == "websocket":
+            raise WebSocketException(status.WS_1013_TRY_AGAIN_LATER, "The server is overloaded. Please retry later.")
+        raise _unavailable("The server is overloaded. Please retry later.")
+    try:
+        with pymongo.timeout(None if timeout is None else max(timeout - (time.monotonic() - arrived), 0.001)):
+            yield
+    except HTTPException as e:
+        # The endpoints turn the database errors into a 500, the timeout is the exception it was raised from.
+        if e.status_code == 500 and is_timeout(e.__context__):
+            controller.record_shed("deadline")
+            raise _unavailable("The request took too long. Please retry later.")
+        raise
+    except PyMongoError as e:
+        if e.timeout:
+            controller.record_shed("deadline")
+            raise _unavailable("The request took too long. Please retry later.")
+        raise
+    finally:
+        controller.release()
@@ -0,0 +1,110 @@
+from dataclasses import dataclass, field
+from typing import Any, List
+
+import orjson
+from beanie import PydanticObjectId
+from pydantic import ValidationError
+from pymongo.errors import BulkWriteError
+
+from api.hashing import password_hasher
+from api.models import UserInDB
+from api.schemas import BulkItemResult, BulkItemStatus, UserCreate
+
+DUPLICATE_KEY_ERROR_CODE = 11000
+BULK_CHUNK_SIZE = 1000
+
+
+@dataclass
+class InsertResult:
+    """The outcome of an unordered bulk insert. `duplicates` and `errors` hold the positions of the documents
+    that were rejected, relative to the list that was passed in."""
+    inserted: int = 0
+    duplicates: List[int] = field(default_factory=list)
+    errors: List[int] = field(default_factory=list)
+
+
+async def insert_users(users: List[UserInDB]) -> InsertResult:
+    """Write the users with a single unordered `insert_many`. A rejected document (for example a duplicate email)
+    does not stop the rest of the batch from being written. IDs are assigned up front, so the callers can tell which
+    users were created."""
+    if not users:
+        return InsertResult()
+    for user in users:
+        if user.id is None:
+            user.id = PydanticObjectId()
+    try:
+        result = await UserInDB.insert_many(users, ordered=False)
+        return InsertResult(inserted=len(result.inserted_ids))
+    except BulkWriteError as e:
+        outcome = InsertResult(inserted=e.details.get("nInserted", 0))
+        for error in e.details.get("writeErrors", []):
+            if error.get("code") == DUPLICATE_KEY_ERROR_CODE:
+                outcome.duplicates.append(error["index"])
+            else:
+                outcome.errors.append(error["index"])
+        return outcome
+
+
+@dataclass
+class InvalidItem:
+    """An item of a bulk request body that could not be decoded."""
+    error: str
+
+
+def parse_items(body: bytes, ndjson: bool) -> List[Any]:
+    """Decode a bulk request body, either a JSON array or one JSON document per line. A line that is not valid JSON
+    becomes an `InvalidItem`, so that it is reported without failing the other lines. Raises ValueError when a
+    JSON body is not an array."""
+    if not ndjson:
+        items = orjson.loads(body)
+        if not isinstance(items, list):
+            raise ValueError("The request body must be a JSON array.")
+        return items
+    items = []
+    for line in body.splitlines():
+        if not line.strip():
+            continue
+        try:
+            items.append(orjson.loads(line))
+        except orjson.JSONDecodeError as e:
+            items.append(InvalidItem(str(e)))
+    return items
+
+
+async def create_users(items: List[Any], chunk_size: int = BULK_CHUNK_SIZE) -> List[BulkItemResult]:
+    """Validate, hash the passwords of and insert the items chunk by chunk, returning one result per item, in the
+    same order."""
+    results = []
+    for start in range(0, len(items), chunk_size):
+        chunk_results = []
+        users = []
+        for index, item in enumerate(items[start:start + chunk_size], start):
+            if isinstance(item, InvalidItem):
+                chunk_results.append(BulkItemResult(index=index, status=BulkItemStatus.invalid, errors=[item.error]))
+                continue
+            try:
+                user = UserInDB(**UserCreate.parse_obj(item).dict())
+            except ValidationError as e:
+                chunk_results.append(BulkItemResult(
+                    index=index, status=BulkItemStatus.invalid,
+                    errors=[f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors()]))
+                continue
+            chunk_results.append(BulkItemResult(index=index, status=BulkItemStatus.created))
+            users.append((user, chunk_results[-1]))
+
+        hashes = await password_hasher.hash_many([user.password for user, _ in users])
+        for (user, _), hashed in zip(users, hashes):
+            user.password = hashed
+        outcome = await insert_users([user for user, _ in users])
+        duplicates, errors = set(outcome.duplicates), set(outcome.errors)
+        for position, (user, result) in enumerate(users):
+            if position in duplicates:
+                result.status = BulkItemStatus.conflict
+                result.errors = ["There is already a user with this email."]
+            elif position in errors:
+                result.status = BulkItemStatus.error
+                result.errors = ["The user could not be written to the database."]
+            else:
+                result.id = user.id
+        results.extend(chunk_results)
+    return results
@@ -0,0 +1,203 @@
+import asyncio
+import logging
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from beanie import PydanticObjectId
+from beanie.operators import In
+
+from api.changes import RESYNC, ChangeFeed, ChangeFeedUnavailable
+from api.config import get_settings
+from api.loader import BatchLoader
+from api.models import UserInDB
+
+logger = logging.getLogger(__name__)
+
+# How long to wait before subscribing to the change feed again, after it could not be opened.
+FOLLOW_RETRY_SECONDS = 30
+
+
+class CacheBackend(ABC):
+    """The storage behind `UserCache`. Implement it to plug in a shared cache."""
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[Any]:
+        ...
+
+    @abstractmethod
+    def set(self, key: str, value: Any):
+        ...
+
+    @abstractmethod
+    def delete(self, key: str):
+        ...
+
+    @abstractmethod
+    def clear(self):
+        ...
+
+    @abstractmethod
+    def stats(self) -> Dict[str, int]:
+        ...
+
+
+class LRUCache(CacheBackend):
+    """An in-process cache that holds at most `max_size` entries, evicting the least recently used entry first.
+    Entries expire `ttl` seconds after they were set."""
+
+    def __init__(self, max_size: int = 10000, ttl: float = 60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None or entry[1] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key: str, value: Any):
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key: str):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._entries), "max_size": self.max_size, "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions}
+
+
+async def fetch_by_id(ids: List[PydanticObjectId]) -> Dict[PydanticObjectId, UserInDB]:
+    return {user.id: user for user in await UserInDB.find(In(UserInDB.id, ids)).to_list()}
+
+
+async def fetch_by_email(emails: List[str]) -> Dict[str, UserInDB]:
+    return {user.email: user for user in await UserInDB.find(In(UserInDB.email, emails)).to_list()}
+
+
+class UserCache:
+    """Read-through cache of users by ID and by email.
+
+    Every write must call `invalidate` or `clear`. A lookup that started before an invalidation does not store its
+    result, so a user that was read while being deleted is never put back in the cache. The writes of the other
+    processes are invalidated by `follow`, from the change feed. The misses are read through a `BatchLoader`, so that
+    the concurrent misses share their queries, whether the cache is enabled or not."""
+
+    def __init__(self, backend: CacheBackend = None, batch_window: float = 0.001, max_batch_size: int = 100,
+                 timeout: Optional[float] = None, enabled: bool = True):
+        self.backend = backend or LRUCache()
+        self.by_id = BatchLoader("id", fetch_by_id, batch_window, max_batch_size, timeout)
+        self.by_email = BatchLoader("email", fetch_by_email, batch_window, max_batch_size, timeout)
+        self.enabled = enabled
+        self._generation = 0
+
+    async def get_by_id(self, doc_id: PydanticObjectId) -> Optional[UserInDB]:
+        user = self.backend.get(f"id:{doc_id}") if self.enabled else None
+        if user is None:
+            generation = self._generation
+            user = await self.by_id.load(doc_id)
+            self._store(user, generation)
+        return user.copy() if user else None
+
+    async def get_by_email(self, email: str) -> Optional[UserInDB]:
+        user = None
+        if self.enabled:
+            # The email entry only holds the ID, so that invalidating the ID of a user, which is all the change feed
+            # tells of a deleted user, invalidates its email as well.
+            doc_id = self.backend.get(f"email:{email}")
+            user = self.backend.get(f"id:{doc_id}") if doc_id is not None else None
+            if user is not None and user.email != email:
+                user = None
+        if user is None:
+            generation = self._generation
+            user = await self.by_email.load(email)
+            self._store(user, generation)
+        return user.copy() if user else None
+
+    def _store(self, user: Optional[UserInDB], generation: int):
+        if user is None or not self.enabled or generation != self._generation:
+            return
+        self.backend.set(f"id:{user.id}", user)
+        self.backend.set(f"email:{user.email}", user.id)
+
+    def invalidate(self, user: UserInDB):
+        """Drop the entries of a user. Call it with the state of the user before the write."""
+        self.invalidate_id(user.id, user.email)
+
+    def invalidate_id(self, doc_id: PydanticObjectId, email: Optional[str] = None):
+        """Drop the entries of the user with this ID, and make its next lookups, and the next lookups of `email`, read
+        the database again."""
+        self._generation += 1
+        self.backend.delete(f"id:{doc_id}")
+        self.by_id.forget(doc_id)
+        if email is not None:
+            self.backend.delete(f"email:{email}")
+            self.by_email.forget(email)
+
+    def clear(self):
+        self._generation += 1
+        self.backend.clear()
+        self.by_id.clear()
+        self.by_email.clear()
+
+    async def follow(self, feed: ChangeFeed, queue_size: int, required: bool = False):
+        """Invalidate the users written by the other processes as the change feed reports them, until cancelled. The
+        cache is cleared whenever the feed has to be subscribed to again, since changes may have been missed.
+
+        When other workers write to the same database, the cache is `required` to follow the feed, and is disabled
+        while it cannot: the change streams need a replica set."""
+        warned = False
+        while True:
+            try:
+                subscription = await feed.subscribe(queue_size)
+            except ChangeFeedUnavailable as e:
+                if not warned:
+                    if required:
+                        logger.warning("The user cache is disabled, the writes of the other workers cannot be "
+                                       "followed: %s", e)
+                    else:
+                        logger.info("The user cache does not follow the change feed: %s", e)
+                    warned = True
+                await asyncio.sleep(FOLLOW_RETRY_SECONDS)
+                continue
+            try:
+                # The changes made before the subscription were not seen.
+                self.clear()
+                if required:
+                    self.enabled = True
+                async for event in subscription.events():
+                    if event["operation"] == RESYNC:
+                        break
+                    self.invalidate_id(PydanticObjectId(event["user_id"]), event.get("user", {}).get("email"))
+            finally:
+                feed.unsubscribe(subscription)
+                if required:
+                    self.enabled = False
+                self.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.backend.stats(), "enabled": self.enabled}
+
+
+settings = get_settings()
+# With several workers, the cache is only enabled once it follows the change feed, see `UserCache.follow`.
+user_cache = UserCache(LRUCache(settings.cache_max_size, settings.cache_ttl_seconds),
+                       batch_window=settings.lookup_batch_window_ms / 1000,
+                       max_batch_size=settings.lookup_max_batch_size,
+                       timeout=settings.request_timeout_ms / 1000 if settings.request_timeout_ms else None,
+                       enabled=settings.workers == 1)
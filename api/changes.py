@@ -0,0 +1,203 @@
+import asyncio
+import contextvars
+import logging
+from typing import AsyncIterator, List, Optional, Set
+
+from api.metrics import change_feed_events, change_feed_resyncs, change_feed_subscribers
+from api.models import UserInDB
+from api.projection import DEFAULT_FIELDS, USER_FIELDS
+from api.serialization import dumps
+
+logger = logging.getLogger(__name__)
+
+USER_OPERATIONS = ("insert", "update", "replace", "delete")
+# The last event sent to a subscriber that has to reload the users, before it is disconnected.
+RESYNC = "resync"
+# The password hash and the search keys never leave the database.
+PIPELINE = [{"$match": {"operationType": {"$in": list(USER_OPERATIONS)}}},
+            {"$project": {"fullDocument.password": 0, "fullDocument.search_keys": 0}}]
+# How long a getMore of the change stream waits for new events on the server.
+MAX_AWAIT_TIME_MS = 1000
+
+
+class ChangeFeedUnavailable(Exception):
+    """Raised when the change stream cannot be opened, e.g. when MongoDB is not a replica set."""
+
+
+def change_event(change: dict) -> dict:
+    """The event of a change of the users collection. Its `id` is the resume token of the change. The `user` is the
+    current version of the user, without its sensitive fields, and an update lists the fields it changed."""
+    event = {"id": change["_id"]["_data"], "operation": change["operationType"],
+             "user_id": str(change["documentKey"]["_id"])}
+    if change.get("fullDocument") is not None:
+        event["user"] = {field: value for field, value in change["fullDocument"].items() if field in DEFAULT_FIELDS}
+    if change["operationType"] == "update":
+        description = change["updateDescription"]
+        event["changed_fields"] = sorted(field for field in [*description.get("updatedFields", {}),
+                                                             *description.get("removedFields", [])]
+                                         if field.split(".")[0] in USER_FIELDS)
+    return event
+
+
+def resync_event(reason: str) -> dict:
+    return {"id": None, "operation": RESYNC, "reason": reason}
+
+
+def format_sse(event: dict) -> bytes:
+    """An event in the `text/event-stream` format. Its resume token is the SSE event ID, so a browser sends it back in
+    `Last-Event-ID` when it reconnects."""
+    lines = [f"id: {event['id']}"] if event["id"] else []
+    lines += [f"event: {event['operation']}", f"data: {dumps(event).decode()}"]
+    return ("\n".join(lines) + "\n\n").encode()
+
+
+class Subscription:
+    """The events of one subscriber, in a bounded queue. A subscriber that falls `queue_size` events behind gets a
+    resync event in place of its backlog, and is dropped: it must reload the users and subscribe again."""
+
+    def __init__(self, queue_size: int):
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self.closed = False
+
+    def push(self, event: dict) -> bool:
+        """Queue an event without waiting. Returns False when the subscriber is closed."""
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(event)
+            return True
+        except asyncio.QueueFull:
+            self.close("The subscriber fell too far behind the changes.")
+            return False
+
+    def close(self, reason: str):
+        """Replace the backlog with a resync event, which ends the subscription."""
+        if self.closed:
+            return
+        self.closed = True
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(resync_event(reason))
+        change_feed_resyncs.inc()
+
+    async def events(self, heartbeat: Optional[float] = None) -> AsyncIterator[Optional[dict]]:
+        """Yield the events as they arrive, and None after `heartbeat` seconds without any. Ends after a resync."""
+        while True:
+            try:
+                event = await asyncio.wait_for(self.queue.get(), heartbeat)
+            except asyncio.TimeoutError:
+                yield None
+                continue
+            yield event
+            if event["operation"] == RESYNC:
+                return
+
+
+class ChangeFeed:
+    """One change stream of the users collection per worker, shared by all the subscribers of the worker.
+
+    The stream is opened by the first subscriber and closed after the last one leaves. Every change is pushed to
+    the queue of every subscriber without waiting, so a slow subscriber never holds the stream back. A subscriber that
+    resumes after a token reads the changes it missed from a stream of its own, then continues with the shared one."""
+
+    def __init__(self):
+        self.subscribers: Set[Subscription] = set()
+        self._task: Optional[asyncio.Task] = None
+        self._opened: Optional[asyncio.Future] = None
+
+    def open_stream(self, resume_after: Optional[str] = None):
+        return UserInDB.get_motor_collection().watch(
+            PIPELINE, full_document="updateLookup", max_await_time_ms=MAX_AWAIT_TIME_MS,
+            resume_after={"_data": resume_after} if resume_after else None)
+
+    async def subscribe(self, queue_size: int, resume_after: Optional[str] = None) -> Subscription:
+        """Subscribe to the changes from now on, or from after the `resume_after` token. Raises
+        ChangeFeedUnavailable when the change stream cannot be opened."""
+        if self._task is None or self._task.done():
+            self._opened = asyncio.get_running_loop().create_future()
+            # Run in an empty context, the stream outlives the request that opened it and must not inherit its
+            # deadline.
+            self._task = contextvars.Context().run(asyncio.create_task, self._run(self._opened))
+        opened = self._opened
+        subscription = Subscription(queue_size)
+        self.subscribers.add(subscription)
+        change_feed_subscribers.inc()
+        try:
+            await asyncio.shield(opened)
+            if resume_after:
+                await self._catch_up(subscription, resume_after)
+        except BaseException:
+            self.unsubscribe(subscription)
+            raise
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        if subscription not in self.subscribers:
+            return
+        self.subscribers.discard(subscription)
+        change_feed_subscribers.dec()
+        if not self.subscribers and self._task is not None:
+            self._task.cancel()
+            self._task = self._opened = None
+
+    async def _run(self, opened: asyncio.Future):
+        try:
+            async with self.open_stream() as stream:
+                # The stream is only opened on the server by its first read, the changes after it are not missed.
+                change = await stream.try_next()
+                opened.set_result(None)
+                while True:
+                    if change is not None:
+                        self._publish(change_event(change))
+                    change = await stream.try_next()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if not opened.done():
+                # Reported to the subscriber, which decides how to tell about it.
+                opened.set_exception(ChangeFeedUnavailable(str(e)))
+                return
+            logger.exception("The change stream was interrupted")
+            # The stream could not be resumed by the driver, every subscriber has to start over.
+            for subscription in list(self.subscribers):
+                subscription.close("The change stream was interrupted.")
+                self.unsubscribe(subscription)
+        finally:
+            if not opened.done():
+                opened.cancel()
+
+    def _publish(self, event: dict):
+        change_feed_events.inc()
+        for subscription in list(self.subscribers):
+            if not subscription.push(event):
+                self.unsubscribe(subscription)
+
+    async def _catch_up(self, subscription: Subscription, resume_after: str):
+        """Queue the changes since `resume_after` ahead of the live ones. The subscription is already receiving the
+        live changes, the missed ones are read until the private stream has nothing more, and the live changes that
+        were read twice are dropped."""
+        missed: List[dict] = []
+        try:
+            async with self.open_stream(resume_after) as stream:
+                while (change := await stream.try_next()) is not None:
+                    missed.append(change_event(change))
+                    if len(missed) >= subscription.queue.maxsize:
+                        subscription.close("Too many changes were missed.")
+                        return
+        except Exception:
+            logger.exception("Could not resume the changes after %s", resume_after)
+            # The token is invalid, or too old to be in the oplog.
+            subscription.close("The changes cannot be resumed from this token.")
+            return
+        if subscription.closed:
+            return
+        seen = {event["id"] for event in missed}
+        live = []
+        while not subscription.queue.empty():
+            live.append(subscription.queue.get_nowait())
+        for event in missed + [event for event in live if event["id"] not in seen]:
+            if not subscription.push(event):
+                return
+
+
+change_feed = ChangeFeed()
@@ -0,0 +1,113 @@
+import importlib.util
+import zlib
+from functools import lru_cache
+from typing import Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+
+from api.serialization import parse_accept
+
+GZIP_LEVEL = 6
+# The default level of zstd: faster than gzip at level 6, with a better ratio.
+ZSTD_LEVEL = 3
+# Responses that are already compressed.
+COMPRESSED_MEDIA_TYPES = ("application/gzip", "application/zstd", "image/", "video/", "audio/")
+
+
+@lru_cache
+def zstd_available() -> bool:
+    return importlib.util.find_spec("zstandard") is not None
+
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    """The content encoding of a response: zstd when the client accepts it and `zstandard` is installed, otherwise
+    gzip when the client accepts it."""
+    accepted = {coding for coding, quality in parse_accept(accept_encoding) if quality > 0}
+    if zstd_available() and ("zstd" in accepted or "*" in accepted):
+        return "zstd"
+    if "gzip" in accepted or "*" in accepted:
+        return "gzip"
+    return None
+
+
+class _Compressor:
+    """Compresses a response body, chunk by chunk. Every chunk is flushed, so that a streamed line reaches the
+    client as soon as it is sent."""
+
+    def __init__(self, encoding: str):
+        if encoding == "zstd":
+            # Imported here, zstandard is optional, see `zstd_available`.
+            import zstandard
+            self._compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+            self._flush_block = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        else:
+            self._compressor = zlib.compressobj(GZIP_LEVEL, wbits=31)
+            self._flush_block = zlib.Z_SYNC_FLUSH
+
+    def compress(self, data: bytes, last: bool) -> bytes:
+        compressed = self._compressor.compress(data)
+        return compressed + (self._compressor.flush() if last else self._compressor.flush(self._flush_block))
+
+
+class CompressionMiddleware:
+    """ASGI middleware that compresses the responses with zstd or gzip, depending on the `Accept-Encoding` of the
+    request. A response smaller than `minimum_size` is sent as it is, compressing it would cost more time than it
+    saves. A streamed response is compressed whatever its size, its size is not known when it starts."""
+
+    def __init__(self, app, minimum_size: int = 1024):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+        compressor: Optional[_Compressor] = None
+        passthrough = False
+
+        async def send_wrapper(message):
+            nonlocal start, compressor, passthrough
+            if message["type"] == "http.response.start":
+                start = message
+                headers = Headers(raw=message["headers"])
+                passthrough = "content-encoding" in headers or \
+                    headers.get("content-type", "").startswith(COMPRESSED_MEDIA_TYPES)
+                if passthrough:
+                    await send(message)
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            body, more_body = message.get("body", b""), message.get("more_body", False)
+            if compressor is None:
+                # The first chunk of the body decides whether the response is compressed.
+                if not more_body and (not body or len(body) < self.minimum_size):
+                    passthrough = True
+                    await send(start)
+                    await send(message)
+                    return
+                compressor = _Compressor(encoding)
+                headers = MutableHeaders(raw=list(start["headers"]))
+                start["headers"] = headers.raw
+                headers["Content-Encoding"] = encoding
+                headers.add_vary_header("Accept-Encoding")
+                if more_body:
+                    del headers["Content-Length"]
+                else:
+                    body = compressor.compress(body, last=True)
+                    headers["Content-Length"] = str(len(body))
+                    await send(start)
+                    await send({"type": "http.response.body", "body": body})
+                    return
+                await send(start)
+            await send({"type": "http.response.body", "body": compressor.compress(body, last=not more_body),
+                        "more_body": more_body})
+
+        await self.app(scope, receive, send_wrapper)
@@ -0,0 +1,85 @@
+from functools import lru_cache
+from typing import Dict, Optional
+
+from pydantic import BaseSettings, Field
+
+
+class Settings(BaseSettings):
+    """The configuration of the API. Every field can be set with an environment variable prefixed with `API_`
+    (for example `API_MONGODB_URI`), or in a `.env` file at the working directory."""
+    mongodb_uri: str = Field("mongodb://localhost:27017/users", description="The MongoDB connection string.")
+    database_name: str = Field("user_db", description="The database that holds the users collection.")
+    max_pool_size: int = Field(100, description="The maximum number of connections per MongoDB server.")
+    min_pool_size: int = Field(0, description="The number of connections kept open per MongoDB server.")
+    max_idle_time_ms: Optional[int] = Field(None, description="Close pooled connections idle for longer than this.")
+    connect_timeout_ms: int = Field(10000, description="The timeout for opening a connection.")
+    server_selection_timeout_ms: int = Field(10000, description="The timeout for finding a suitable server.")
+    compressors: Optional[str] = Field(None, description="Comma separated wire compressors, e.g. `zstd,snappy`. "
+                                                         "zstd needs the `zstandard` package, snappy `python-snappy`.")
+    app_name: str = Field("fastcrudapi", description="The application name reported to the MongoDB server logs.")
+    warm_up_connections: int = Field(0, description="The number of connections opened at startup, before the API "
+                                                    "starts serving requests.")
+    fast_responses: bool = Field(False, description="Serialize the read responses once with orjson, straight from "
+                                                    "the documents read from MongoDB, skipping the validation of the "
+                                                    "response model.")
+    bulk_max_items: int = Field(10000, description="The maximum number of users in a bulk create request.")
+    bulk_max_body_bytes: int = Field(16 * 1024 * 1024, description="The maximum size of a bulk create request body.")
+    cache_max_size: int = Field(10000, description="The maximum number of entries of the user cache.")
+    cache_ttl_seconds: float = Field(60, description="How long a user stays in the cache.")
+    workers: int = Field(1, ge=1, description="The number of processes that serve the API, set by `serve`. With "
+                                              "more than one, the user cache of a process is only used while the "
+                                              "change feed tells it about the writes of the others. Set it when "
+                                              "several instances of the API share the database.")
+    lookup_batch_window_ms: float = Field(1, ge=0, description="The lookups of single users by ID, or by email, that "
+                                                              "arrive within this window are fetched with one "
+                                                              "query. With 0, only the lookups of the same event "
+                                                              "loop iteration are.")
+    lookup_max_batch_size: int = Field(100, ge=1, description="The maximum number of users fetched by one query of "
+                                                              "the lookups.")
+    metrics_enabled: bool = Field(True, description="Record the HTTP and MongoDB metrics exposed on `/metrics`.")
+    profiling_token: Optional[str] = Field(None, description="Profile the requests that carry this value in the "
+                                                             "`X-Profile` header.")
+    profiling_sample_rate: float = Field(0, ge=0, le=1, description="The fraction of the requests to profile.")
+    profiling_dir: str = Field("profiles", description="The directory where the profiles are saved.")
+    profiling_max_files: int = Field(100, ge=1, description="The number of profiles kept in `profiling_dir`, the "
+                                                            "oldest are removed.")
+    password_hash_workers: Optional[int] = Field(None, description="The number of passwords hashed at the same time. "
+                                                                   "Defaults to the number of CPUs.")
+    password_hash_processes: bool = Field(False, description="Hash the passwords in a pool of processes instead of "
+                                                             "threads.")
+    password_hash_n: int = Field(2 ** 14, description="The scrypt CPU and memory cost. Lower it, e.g. to 16, only "
+                                                      "for development and tests.")
+    password_hash_r: int = Field(8, description="The scrypt block size.")
+    password_hash_p: int = Field(1, description="The scrypt parallelization.")
+    compression_min_bytes: Optional[int] = Field(1024, description="Compress the responses larger than this with "
+                                                                   "zstd or gzip, when the client accepts it. Unset "
+                                                                   "it to turn the compression off.")
+    changes_queue_size: int = Field(1000, ge=1, description="The changes buffered per subscriber of the change "
+                                                           "feed. A subscriber that falls further behind is sent a "
+                                                           "resync event and disconnected.")
+    changes_heartbeat_seconds: float = Field(15, gt=0, description="Send a comment to the SSE subscribers after this "
+                                                                   "long without changes, to keep the connection "
+                                                                   "open through proxies.")
+    admission_max_concurrency: int = Field(100, ge=1, description="The requests of a route handled at the same "
+                                                                  "time, per worker. The others wait in a queue.")
+    admission_route_limits: Dict[str, int] = Field(
+        {"/populate": 2, "/users/import": 2, "/users/export": 4, "/users/bulk": 8, "/users/changes": 1000},
+        description="The concurrency limits of the routes that differ from `admission_max_concurrency`, by path "
+                    "template, e.g. `{\"/users/export\": 4}`.")
+    admission_max_queue: int = Field(200, ge=0, description="The requests of a route waiting for a slot, per worker. "
+                                                            "Any other request is answered 503 right away.")
+    admission_queue_timeout_ms: int = Field(1000, ge=0, description="Answer 503 to a request that waited this long "
+                                                                    "for a slot.")
+    admission_retry_after_seconds: int = Field(1, ge=0, description="The `Retry-After` header of the 503 responses.")
+    request_timeout_ms: Optional[int] = Field(5000, description="The deadline of a request, queue included, passed "
+                                                                "to MongoDB as `maxTimeMS`. Streamed responses, "
+                                                                "populate, export and import have none.")
+
+    class Config:
+        env_prefix = "API_"
+        env_file = ".env"
+
+
+@lru_cache
+def get_settings() -> Settings:
+    return Settings()
@@ -1,10 +1,69 @@
+import asyncio
+from typing import Optional
+
 import motor.motor_asyncio
 from beanie import init_beanie
+from api.config import Settings, get_settings
+from api.indexes import sync_indexes
+from api.jobs import create_job_indexes
+from api.metrics import CommandMetrics, PoolMetrics
 from api.models import UserInDB
 
+# The client shared by the whole process. It is created by `init_db` and closed by `close_db`.
+client: Optional[motor.motor_asyncio.AsyncIOMotorClient] = None
+_background_tasks = set()
+
+
+def create_client(settings: Settings) -> motor.motor_asyncio.AsyncIOMotorClient:
+    """Create a Motor client with the pool, timeout and compression options of the settings."""
+    options = {
+        "maxPoolSize": settings.max_pool_size,
+        "minPoolSize": settings.min_pool_size,
+        "connectTimeoutMS": settings.connect_timeout_ms,
+        "serverSelectionTimeoutMS": settings.server_selection_timeout_ms,
+        "appname": settings.app_name,
+    }
+    if settings.max_idle_time_ms is not None:
+        options["maxIdleTimeMS"] = settings.max_idle_time_ms
+    if settings.compressors:
+        options["compressors"] = settings.compressors
+    if settings.metrics_enabled:
+        options["event_listeners"] = [CommandMetrics(), PoolMetrics()]
+    return motor.motor_asyncio.AsyncIOMotorClient(settings.mongodb_uri, **options)
+
+
+async def init_db(settings: Settings = None):
+    global client
+    settings = settings or get_settings()
+    client = create_client(settings)
+    await init_beanie(database=client[settings.database_name], document_models=[UserInDB])
+    if settings.warm_up_connections:
+        await warm_up(settings.warm_up_connections)
+    # Build the indexes in the background, so the API can serve requests while they are created.
+    for coroutine in (sync_indexes(UserInDB), create_job_indexes()):
+        task = asyncio.create_task(coroutine)
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+
+async def warm_up(connections: int):
+    """Open `connections` pooled connections by sending as many concurrent pings, so that the first requests do not
+    pay for the connection handshakes."""
+    await asyncio.gather(*(client.admin.command("ping") for _ in range(connections)))
+
+
+async def ping_db() -> bool:
+    try:
+        await UserInDB.get_motor_collection().database.command("ping")
+        return True
+    except Exception:
+        return False
+
 
-async def init_db():
-    client = motor.motor_asyncio.AsyncIOMotorClient(
-        "mongodb://localhost:27017/users"
-    )
-    await init_beanie(database=client["user_db"], document_models=[UserInDB])
+async def close_db():
+    global client
+    for task in list(_background_tasks):
+        task.cancel()
+    if client is not None:
+        client.close()
+        client = None
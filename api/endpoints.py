@@ -1,22 +1,118 @@
-from typing import Annotated, List
+import asyncio
+import logging
+import time
+from datetime import date, datetime
+from typing import Annotated, AsyncIterator, FrozenSet, Optional, Union
 from beanie import PydanticObjectId
-from fastapi import HTTPException, Path, Query, APIRouter
+from beanie.odm.utils.encoder import Encoder
+from fastapi import Depends, HTTPException, Header, Path, Query, APIRouter, Request, Response, WebSocket, status
+from fastapi.responses import StreamingResponse
+from pymongo import ReturnDocument
 from pymongo.errors import DuplicateKeyError
-from api.database import init_db
-from api.utils import generate_users
-from api.models import UserInDB
-from api.schemas import UserUpdate, UserCreate
+from api.utils import UserGenerator
+from api.admission import admission, controllers
+from api.bulk import create_users, insert_users, parse_items
+from api.cache import user_cache
+from api.changes import ChangeFeedUnavailable, change_feed, format_sse
+from api.config import get_settings
+from api.filters import user_filter
+from api.hashing import password_hasher
+from api.indexes import explain_query_shapes, index_status
+from api.jobs import get_job, start_delete_job
+from api.lookup import lookup_users
+from api.models import UserInDB, search_keys
+from api.pagination import (DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, STREAM_BATCH_SIZE, combine_filters, decode_cursor,
+                            decode_sort_cursor, encode_cursor, encode_sort_cursor, iter_batches, keyset_filter,
+                            sort_spec)
+from api.projection import DEFAULT_FIELDS, SensitiveFieldError, parse_fields, project_user, project_user_dict, \
+    projection_model
+from api.schemas import (BulkCreateResult, BulkItemStatus, DeleteJob, ExportFormat, Gender, ImportProgress,
+                         PopulateSummary, ResponseFormat, Role, UserCount, UserLookup, UserLookupResult, UserOut,
+                         UserSort, UserUpdate, UserCreate)
+from api.search import MAX_SEARCH_RESULTS, search_users
+from api.serialization import (RAW_BSON_OPTIONS, FastJSONResponse, UploadStreamingResponse, dumps, dumps_ndjson,
+                               negotiate, users_response)
+from api.transfer import (IMPORT_CHUNK_SIZE, MAX_IMPORT_CHUNK_SIZE, MAX_REPORTED_REJECTED_ROWS, export_users,
+                          gzip_chunks, import_users)
 
-router = APIRouter()
+logger = logging.getLogger(__name__)
 
+# Every route of the users API goes through the admission control, see `api.admission`.
+router = APIRouter(dependencies=[Depends(admission)], responses={
+    503: {"description": "The server is overloaded, or the request ran out of time. Retry after `Retry-After` "
+                         "seconds.", "content": {
+        "application/json": {
+            "example": {
+                "detail": "The server is overloaded. Please retry later."}
+        }
+    }}})
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+CSV_MEDIA_TYPE = "text/csv"
+GZIP_MEDIA_TYPE = "application/gzip"
+SSE_MEDIA_TYPE = "text/event-stream"
+MAX_POPULATE_BATCH_SIZE = 10000
+# The formats of a lookup, the users are not streamed.
+LOOKUP_FORMATS = (ResponseFormat.json, ResponseFormat.msgpack, ResponseFormat.bson, ResponseFormat.columnar)
+
+
+def _parse_fields(fields: Optional[str], allow_sensitive: bool) -> FrozenSet[str]:
+    try:
+        return parse_fields(fields, allow_sensitive)
+    except SensitiveFieldError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-@router.on_event("startup")
-async def start_db():
-    """Initiate the database connection."""
-    await init_db()
 
+def requested_fields(fields: Annotated[Optional[str], Query(
+        description="Comma separated fields to return, e.g. `email,first_name`. The `_id` is always returned. "
+                    "The `password` can not be requested.")] = None) -> FrozenSet[str]:
+    """Dependency that parses the `fields=` parameter of the read endpoints."""
+    return _parse_fields(fields, allow_sensitive=False)
 
-@router.get("/users", response_model=list[UserInDB], status_code=200, operation_id="get_all_users", responses={
+
+def export_fields(fields: Annotated[Optional[str], Query(
+        description="Comma separated fields to export, e.g. `email,first_name`. The `_id` is always exported. "
+                    "The password hashes are only exported when `password` is requested.")] = None
+                  ) -> FrozenSet[str]:
+    """Dependency that parses the `fields=` parameter of the export, the only one that accepts the `password`."""
+    return _parse_fields(fields, allow_sensitive=True)
+
+
+def list_filter(
+        role: Annotated[Optional[Role], Query(description="Only return the users with this role.")] = None,
+        gender: Annotated[Optional[Gender], Query(description="Only return the users of this gender.")] = None,
+        born_after: Annotated[Optional[date], Query(description="Only return the users born on or after this date.")
+        ] = None,
+        born_before: Annotated[Optional[date], Query(description="Only return the users born before this date.")
+        ] = None,
+        min_age: Annotated[Optional[int], Query(ge=0, le=150, description="Only return the users at least this old.")
+        ] = None,
+        max_age: Annotated[Optional[int], Query(ge=0, le=150, description="Only return the users at most this old.")
+        ] = None,
+        name_prefix: Annotated[Optional[str], Query(min_length=1, max_length=256, description=(
+            "Only return the users whose last name starts with this prefix. Case sensitive."))] = None,
+) -> dict:
+    """Dependency that turns the filters of the list and count endpoints into a MongoDB filter."""
+    return user_filter(role=role, gender=gender, born_after=born_after, born_before=born_before, min_age=min_age,
+                       max_age=max_age, name_prefix=name_prefix)
+
+
+@router.get("/users", response_model=list[UserOut], response_model_exclude_unset=True, status_code=200,
+            operation_id="get_all_users", responses={
+    200: {"description": "A page of users. The cursor of the next page is returned in the `X-Next-Cursor` header. "
+                         "Send `Accept: application/x-ndjson` to stream all the matching users instead. The page "
+                         "can also be requested as MessagePack, as a sequence of BSON documents, or as columnar "
+                         "JSON with one array per field.",
+          "content": {response_format.value: {} for response_format in ResponseFormat
+                      if response_format != ResponseFormat.json}},
+    400: {"description": "Bad Request", "content": {
+        "application/json": {
+            "example": {
+                "detail": "Invalid cursor."}
+        }
+    }},
     500: {"description": "Internal Server Error",
           "content": {
               "application/json": {
@@ -26,21 +122,355 @@ async def start_db():
           },
           }
 })
-async def get_all_users() -> list[UserInDB]:
-    """Get all users. Returns a List with User objects or an empty list if no data is available."""
+async def get_all_users(
+        request: Request,
+        response: Response,
+        query: Annotated[dict, Depends(list_filter)],
+        sort: Annotated[UserSort, Query(description="The sort order. A leading `-` sorts in descending order.")
+        ] = UserSort.id,
+        limit: Annotated[Optional[int], Query(ge=1, le=MAX_PAGE_SIZE,
+                                              description="The maximum number of users to return.")] = None,
+        after: Annotated[Optional[str], Query(description="The cursor returned by the previous page.")] = None,
+        fields: Annotated[FrozenSet[str], Depends(requested_fields)] = DEFAULT_FIELDS,
+        accept: Annotated[Optional[str], Header(include_in_schema=False)] = None,
+) -> list[UserOut]:
+    """Get the users matching the filters, one page at a time, ordered by ID or by the `sort` field. Returns a List
+    with User objects or an empty list if no data is available. When more users exist, the cursor of the next page is
+    set in the `X-Next-Cursor` and `Link` headers. With `Accept: application/x-ndjson` the users are streamed one per
+    line, read from the database in batches. The other formats of the `Accept` header are encoded straight from the
+    documents, like the fast responses; BSON documents are sent as they were received from MongoDB, and keep the
+    field of the `sort` order."""
     try:
-        users_cursor = UserInDB.find()
-        users = await users_cursor.to_list(length=None)
+        if sort.field == "_id":
+            after_id, after_value = (decode_cursor(after), None) if after else (None, None)
+        else:
+            after_value, after_id = decode_sort_cursor(after, sort.field) if after else (None, None)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    query = combine_filters(query, keyset_filter(after_id, sort.descending, sort.field, after_value))
+
+    fast = get_settings().fast_responses
+    response_format = negotiate(accept)
+    if response_format == ResponseFormat.ndjson:
+        return StreamingResponse(stream_users(query, sort, limit, fields, fast), media_type=NDJSON_MEDIA_TYPE)
+
+    page_size = limit or DEFAULT_PAGE_SIZE
+    model = projection_model(fields)
+    projection = dict(model.Settings.projection)
+    # The sort value of the last user is needed for the cursor of the next page.
+    extra_field = sort.field not in projection and sort.field != "_id"
+    if extra_field:
+        projection[sort.field] = 1
+    collection = UserInDB.get_motor_collection()
+    if response_format == ResponseFormat.bson:
+        collection = collection.with_options(codec_options=RAW_BSON_OPTIONS)
+    try:
+        users = await collection.find(
+            query, projection=projection, sort=sort_spec(sort.field, sort.descending), limit=page_size + 1
+        ).to_list(None)
     except Exception as e:
         raise HTTPException(
             status_code=500,
             detail="An internal error occurred while fetching the data from the database. Please try again."
         )
 
-    return users
+    headers = {}
+    if len(users) > page_size:
+        users = users[:page_size]
+        last = users[-1]
+        next_cursor = encode_cursor(last["_id"]) if sort.field == "_id" else \
+            encode_sort_cursor(sort.field, last.get(sort.field), last["_id"])
+        headers["X-Next-Cursor"] = next_cursor
+        headers["Link"] = f'<{request.url.include_query_params(after=next_cursor)}>; rel="next"'
+    if extra_field and response_format != ResponseFormat.bson:
+        for user in users:
+            user.pop(sort.field, None)
+
+    if fast or response_format != ResponseFormat.json:
+        return users_response(users, response_format, fields, headers=headers)
+    response.headers.update(headers)
+    return [model.parse_obj(user) for user in users]
+
+
+async def stream_users(query: dict, sort: UserSort, limit: Optional[int], fields: FrozenSet[str] = DEFAULT_FIELDS,
+                       fast: bool = False) -> AsyncIterator[Union[str, bytes]]:
+    """Yield the users as NDJSON, one chunk per batch read from the Motor cursor."""
+    model = projection_model(fields)
+    cursor = UserInDB.get_motor_collection().find(
+        query, projection=model.Settings.projection, sort=sort_spec(sort.field, sort.descending), limit=limit or 0,
+        batch_size=STREAM_BATCH_SIZE
+    )
+    async for batch in iter_batches(cursor):
+        if fast:
+            yield dumps_ndjson(batch)
+        else:
+            yield "".join(model.parse_obj(document).json(by_alias=True, exclude_unset=True) + "\n"
+                          for document in batch)
+
+
+@router.get("/users/count", response_model=UserCount, status_code=200, operation_id="count_users", responses={
+    500: {"description": "Internal Server Error", "content": {
+        "application/json": {
+            "example": {
+                "detail": "An internal error occurred while fetching the data from the database. Please try again."}
+        }
+    }}
+})
+async def count_users(query: Annotated[dict, Depends(list_filter)]) -> UserCount:
+    """Count the users matching the filters. Without filters, the count is read from the collection metadata with
+    `estimated_document_count`, which does not scan the collection."""
+    collection = UserInDB.get_motor_collection()
+    try:
+        if query:
+            return UserCount(count=await collection.count_documents(query), estimated=False)
+        return UserCount(count=await collection.estimated_document_count(), estimated=True)
+    except Exception:
+        logger.exception("Could not count the users matching %s", query)
+        raise HTTPException(status_code=500,
+                            detail="An internal error occurred while fetching the data from the database. Please try again.")
+
+
+@router.get("/users/export", status_code=200, operation_id="export_users", responses={
+    200: {"description": "The users, as NDJSON or CSV, optionally compressed with gzip.", "content": {
+        NDJSON_MEDIA_TYPE: {}, CSV_MEDIA_TYPE: {}, GZIP_MEDIA_TYPE: {}}},
+    400: {"description": "Bad Request", "content": {
+        "application/json": {
+            "example": {
+                "detail": "Unknown field(s): age."}
+        }
+    }}
+})
+async def export_all_users(
+        query: Annotated[dict, Depends(list_filter)],
+        fields: Annotated[FrozenSet[str], Depends(export_fields)] = DEFAULT_FIELDS,
+        export_format: Annotated[ExportFormat, Query(alias="format", description="The format of the file.")
+        ] = ExportFormat.ndjson,
+        gzip: Annotated[bool, Query(description="Compress the file with gzip.")] = False,
+) -> StreamingResponse:
+    """Export the users matching the filters, streamed straight from the Motor cursor, so the memory used does not
+    depend on the number of users. The password hashes are only exported when `password` is in `fields`, which is
+    needed for a backup that can be imported again."""
+    chunks = export_users(query, fields, export_format)
+    file_name = f"users.{export_format.value}"
+    if gzip:
+        chunks, file_name = gzip_chunks(chunks), file_name + ".gz"
+    media_type = GZIP_MEDIA_TYPE if gzip else NDJSON_MEDIA_TYPE if export_format == ExportFormat.ndjson else \
+        CSV_MEDIA_TYPE
+    return StreamingResponse(chunks, media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="{file_name}"'})
+
 
+@router.post("/users/import", response_model=ImportProgress, status_code=200, operation_id="import_users",
+             openapi_extra={"requestBody": {"required": True, "content": {
+                 NDJSON_MEDIA_TYPE: {"schema": {"$ref": "#/components/schemas/UserCreate"}},
+                 CSV_MEDIA_TYPE: {"schema": {"type": "string"}}}}},
+             responses={
+                 400: {"description": "Bad Request", "content": {
+                     "application/json": {
+                         "example": {
+                             "detail": "The request body is not valid gzip data. 2000 users were imported."}
+                     }
+                 }},
+                 415: {"description": "Unsupported Media Type", "content": {
+                     "application/json": {
+                         "example": {
+                             "detail": "The file must be NDJSON (application/x-ndjson) or CSV (text/csv)."}
+                     }
+                 }}
+             })
+async def import_all_users(
+        request: Request,
+        chunk_size: Annotated[int, Query(ge=1, le=MAX_IMPORT_CHUNK_SIZE,
+                                         title="The number of rows validated and written per chunk.")
+        ] = IMPORT_CHUNK_SIZE,
+        accept: Annotated[Optional[str], Header(include_in_schema=False)] = None,
+) -> ImportProgress:
+    """Import users from an NDJSON or CSV file, e.g. one made by `/users/export`, sent as the request body with its
+    `Content-Type`, and `Content-Encoding: gzip` when it is compressed. The file is read incrementally, validated
+    against `UserCreate` in chunks and written with an unordered `insert_many`. Rows exported with their password
+    keep the hash, the other passwords are hashed. Invalid rows and duplicate emails or IDs are reported with their
+    line, without failing the rest of the file. With `Accept: application/x-ndjson`, the progress is streamed after
+    every chunk."""
+    content_type = request.headers.get("content-type", "")
+    if NDJSON_MEDIA_TYPE in content_type:
+        import_format = ExportFormat.ndjson
+    elif CSV_MEDIA_TYPE in content_type:
+        import_format = ExportFormat.csv
+    else:
+        raise HTTPException(status_code=415,
+                            detail="The file must be NDJSON (application/x-ndjson) or CSV (text/csv).")
+    progress = import_users(request.stream(), import_format,
+                            gzipped="gzip" in request.headers.get("content-encoding", ""), chunk_size=chunk_size)
+    if accept and NDJSON_MEDIA_TYPE in accept:
+        return UploadStreamingResponse((chunk.json() + "\n" async for chunk in progress), media_type=NDJSON_MEDIA_TYPE)
+
+    rejected_rows = []
+    try:
+        async for summary in progress:
+            rejected_rows.extend(summary.rejected_rows[:MAX_REPORTED_REJECTED_ROWS - len(rejected_rows)])
+    except Exception:
+        logger.exception("Could not import the users")
+        raise HTTPException(status_code=500,
+                            detail="An error occurred while persisting the users to the database. Please try again.")
+    if summary.error:
+        raise HTTPException(status_code=400, detail=f"{summary.error} {summary.inserted} users were imported.")
+    return summary.copy(update={"rejected_rows": rejected_rows})
 
-@router.get("/users/{doc_id}", response_model=UserInDB, status_code=200, operation_id="get_user_by_id", responses={
+
+@router.get("/users/search", response_model=list[UserOut], response_model_exclude_unset=True, status_code=200,
+            operation_id="search_users", responses={
+        400: {"description": "Bad Request", "content": {
+            "application/json": {
+                "example": {
+                    "detail": "Unknown field(s): age."}
+            }
+        }},
+        500: {"description": "Internal Server Error", "content": {
+            "application/json": {
+                "example": {
+                    "detail": "An internal error occurred while fetching the data from the database. Please try again."}
+            }
+        }}})
+async def search_users_by_prefix(
+        q: Annotated[str, Query(min_length=1, max_length=100, description=(
+            "The start of the full name, the last name, the first name or the email of the users. Case and accents "
+            "are ignored."))],
+        limit: Annotated[int, Query(ge=1, le=MAX_SEARCH_RESULTS, description="The maximum number of users to return.")
+        ] = 10,
+        fields: Annotated[FrozenSet[str], Depends(requested_fields)] = DEFAULT_FIELDS,
+) -> list[UserOut]:
+    """Typeahead search. The users are ranked: exact matches first, then the shortest matching names, with the
+    full name before the last name, the first name and the email."""
+    try:
+        users = await search_users(q, limit, fields)
+    except Exception:
+        logger.exception("Could not search the users matching %r", q)
+        raise HTTPException(status_code=500,
+                            detail="An internal error occurred while fetching the data from the database. Please try again.")
+
+    if get_settings().fast_responses:
+        return FastJSONResponse(users)
+    model = projection_model(fields)
+    return [model.parse_obj(user) for user in users]
+
+
+@router.get("/users/changes", status_code=200, operation_id="watch_users", responses={
+    200: {"description": "The changes of the users, as server-sent events. The `id` of an event is its resume "
+                         "token. A `resync` event means the users must be reloaded, and ends the stream.",
+          "content": {SSE_MEDIA_TYPE: {
+              "example": 'id: 8265...\nevent: update\ndata: {"id": "8265...", "operation": "update", '
+                         '"user_id": "64b7d6f1...", "user": {...}, "changed_fields": ["email"]}\n\n'}}},
+    503: {"description": "The change feed is not available, MongoDB is not a replica set.", "content": {
+        "application/json": {
+            "example": {
+                "detail": "The change feed is not available."}
+        }
+    }}})
+async def watch_users(
+        resume_after: Annotated[Optional[str], Query(
+            description="Resume after the event with this ID, without missing any change.")] = None,
+        last_event_id: Annotated[Optional[str], Header(include_in_schema=False)] = None,
+) -> StreamingResponse:
+    """Stream the inserts, updates and deletes of the users, as they happen, as server-sent events. A reconnecting
+    browser resumes from its `Last-Event-ID`; other clients pass the ID of the last event they received in
+    `resume_after`. The same changes are available over a WebSocket on the same path."""
+    settings = get_settings()
+    try:
+        subscription = await change_feed.subscribe(settings.changes_queue_size, resume_after or last_event_id)
+    except ChangeFeedUnavailable:
+        raise HTTPException(status_code=503, detail="The change feed is not available.")
+
+    async def events() -> AsyncIterator[bytes]:
+        try:
+            async for event in subscription.events(settings.changes_heartbeat_seconds):
+                yield format_sse(event) if event is not None else b": heartbeat\n\n"
+        finally:
+            change_feed.unsubscribe(subscription)
+
+    return StreamingResponse(events(), media_type=SSE_MEDIA_TYPE,
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@router.websocket("/users/changes")
+async def watch_users_websocket(
+        websocket: WebSocket,
+        resume_after: Annotated[Optional[str], Query()] = None,
+):
+    """Send the changes of the users as JSON messages, like the server-sent events of `GET /users/changes`. The
+    socket is closed after a `resync` message."""
+    try:
+        subscription = await change_feed.subscribe(get_settings().changes_queue_size, resume_after)
+    except ChangeFeedUnavailable:
+        await websocket.close(code=status.WS_1011_INTERNAL_ERROR, reason="The change feed is not available.")
+        return
+    await websocket.accept()
+
+    async def send_events():
+        async for event in subscription.events():
+            await websocket.send_text(dumps(event).decode())
+
+    async def wait_for_disconnect():
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+
+    tasks = [asyncio.create_task(send_events()), asyncio.create_task(wait_for_disconnect())]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        if tasks[0] in done:
+            await websocket.close()
+    finally:
+        for task in tasks:
+            task.cancel()
+        change_feed.unsubscribe(subscription)
+
+
+@router.post("/users/lookup", response_model=UserLookupResult, response_model_exclude_unset=True, status_code=200,
+             operation_id="lookup_users", responses={
+        200: {"description": "Successful Response", "content": {
+            response_format.value: {} for response_format in LOOKUP_FORMATS if response_format != ResponseFormat.json}},
+        400: {"description": "Bad Request", "content": {
+            "application/json": {
+                "example": {
+                    "detail": "Unknown field(s): age."}
+            }
+        }},
+        500: {"description": "Internal Server Error", "content": {
+            "application/json": {
+                "example": {
+                    "detail": "An internal error occurred while fetching the data from the database. Please try again."}
+            }
+        }}})
+async def lookup_users_batch(
+        lookup: UserLookup,
+        fields: Annotated[FrozenSet[str], Depends(requested_fields)] = DEFAULT_FIELDS,
+        accept: Annotated[Optional[str], Header(include_in_schema=False)] = None,
+) -> UserLookupResult:
+    """Get many users by ID and/or email with a single query. The users are returned in the order they were
+    requested, and the IDs and emails that match no user are listed in `not_found`. The response can also be
+    requested as MessagePack, BSON or columnar JSON, with the `Accept` header."""
+    response_format = negotiate(accept, LOOKUP_FORMATS)
+    try:
+        users, not_found = await lookup_users(lookup.ids, lookup.emails, fields,
+                                              raw=response_format == ResponseFormat.bson)
+    except Exception as e:
+        raise HTTPException(status_code=500,
+                            detail="An internal error occurred while fetching the data from the database. Please try "
+                                   "again.")
+
+    if get_settings().fast_responses or response_format != ResponseFormat.json:
+        return users_response(users, response_format, fields, not_found=not_found)
+    model = projection_model(fields)
+    return UserLookupResult(users=[model.parse_obj(user) for user in users], not_found=not_found)
+
+
+@router.get("/users/{doc_id}", response_model=UserOut, response_model_exclude_unset=True, status_code=200,
+            operation_id="get_user_by_id", responses={
+    400: {"description": "Bad Request", "content": {
+        "application/json": {
+            "example": {
+                "detail": "Unknown field(s): age."}
+        }
+    }},
     404: {"description": "User not found.", "content": {
         "application/json": {
             "example": {
@@ -56,25 +486,38 @@ async def get_all_users() -> list[UserInDB]:
 })
 async def get_user_by_id(
         doc_id: Annotated[
-            PydanticObjectId, Path(alias="Document ID", description="The document ID of the user to fetch.")]
-) -> UserInDB:
+            PydanticObjectId, Path(title="Document ID", description="The document ID of the user to fetch.")],
+        response: Response,
+        fields: Annotated[FrozenSet[str], Depends(requested_fields)] = DEFAULT_FIELDS,
+) -> UserOut:
     """Get user by ID.
     Fetches a user from the database given the correct document ID.
     Returns 404 if there is no match and 500 for any other issues. """
-    print(type(doc_id))
-    if not isinstance(doc_id, PydanticObjectId):
-        raise HTTPException(status_code=404, detail="The ID provided does not match any users in the database.")
     try:
-        user = await UserInDB.get(doc_id)
-        return user
+        user = await user_cache.get_by_id(doc_id)
     except Exception as e:
         raise HTTPException(status_code=500,
                             detail="An internal error occurred while fetching the data from the database. Please try "
                                    "again.")
 
+    if not user:
+        raise HTTPException(status_code=404, detail="The ID provided does not match any users in the database.")
+
+    if get_settings().fast_responses:
+        return FastJSONResponse(project_user_dict(user, fields), headers={"ETag": etag(user)})
+    response.headers["ETag"] = etag(user)
+    return project_user(user, fields)
+
 
 # GET USERS BY EMAIL
-@router.get("/user", response_model=UserInDB, status_code=200, operation_id="get_by_email", responses={
+@router.get("/user", response_model=UserOut, response_model_exclude_unset=True, status_code=200,
+            operation_id="get_by_email", responses={
+    400: {"description": "Bad Request", "content": {
+        "application/json": {
+            "example": {
+                "detail": "Unknown field(s): age."}
+        }
+    }},
     404: {"description": "User not found", "content": {
         "application/json": {
             "example": {
@@ -89,10 +532,13 @@ async def get_user_by_id(
     }}
 }
             )
-async def get_by_email(email: Annotated[str, Query(title="The email of the user to fetch.")]) -> UserInDB:
+async def get_by_email(
+        email: Annotated[str, Query(title="The email of the user to fetch.")],
+        fields: Annotated[FrozenSet[str], Depends(requested_fields)] = DEFAULT_FIELDS,
+) -> UserOut:
     """Get a user by their email."""
     try:
-        user = await UserInDB.find_one(UserInDB.email == email)
+        user = await user_cache.get_by_email(email)
     except Exception as e:
         raise HTTPException(status_code=500,
                             detail="An error occurred while fetching the data from the database. Please try again.")
@@ -100,10 +546,13 @@ async def get_by_email(email: Annotated[str, Query(title="The email of the user
     if not user:
         raise HTTPException(status_code=404, detail=f"user with email: {email} not found.")
 
-    return user
+    if get_settings().fast_responses:
+        return FastJSONResponse(project_user_dict(user, fields))
+    return project_user(user, fields)
 
 
-@router.post("/users", response_model=UserInDB, status_code=201, operation_id="create_user", responses={
+@router.post("/users", response_model=UserInDB, response_model_exclude={"password", "search_keys"}, status_code=201,
+             operation_id="create_user", responses={
     500: {"description": "Internal Server Error", "content": {
         "application/json": {
             "example": {
@@ -119,9 +568,9 @@ async def get_by_email(email: Annotated[str, Query(title="The email of the user
              )
 async def create_user(user: UserCreate) -> UserInDB:
     """ Create a user. Returns the user data from the database after saving said user, including the newly
-    created ID."""
+    created ID, without the password hash."""
     try:
-        user_in_db = UserInDB(**user.dict())
+        user_in_db = UserInDB(**{**user.dict(), "password": await password_hasher.hash(user.password)})
         db_user = await user_in_db.insert()
     except DuplicateKeyError:
         raise HTTPException(
@@ -136,6 +585,7 @@ async def create_user(user: UserCreate) -> UserInDB:
 
     # user_out_data = db_user.dict(exclude={'id'})
     if db_user:
+        user_cache.invalidate(db_user)
         return db_user
     else:
         raise HTTPException(
@@ -143,6 +593,62 @@ async def create_user(user: UserCreate) -> UserInDB:
         )
 
 
+@router.post("/users/bulk", response_model=BulkCreateResult, status_code=200, operation_id="create_users_bulk",
+             openapi_extra={"requestBody": {"required": True, "content": {
+                 "application/json": {"schema": {"type": "array",
+                                                 "items": {"$ref": "#/components/schemas/UserCreate"}}},
+                 "application/x-ndjson": {"schema": {"$ref": "#/components/schemas/UserCreate"}}}}},
+             responses={
+                 400: {"description": "Bad Request", "content": {
+                     "application/json": {
+                         "example": {
+                             "detail": "The request body must be a JSON array."}
+                     }
+                 }},
+                 413: {"description": "Request Entity Too Large", "content": {
+                     "application/json": {
+                         "example": {
+                             "detail": "The request body is larger than 16777216 bytes."}
+                     }
+                 }}
+             })
+async def create_users_bulk(request: Request) -> BulkCreateResult:
+    """Create many users at once, from a JSON array or from NDJSON (`Content-Type: application/x-ndjson`). Items are
+    validated and written in chunks with an unordered `insert_many`. Invalid items and duplicate emails are reported
+    per item, in the order of the request, without failing the rest of the batch."""
+    settings = get_settings()
+    too_large = HTTPException(status_code=413,
+                              detail=f"The request body is larger than {settings.bulk_max_body_bytes} bytes.")
+    if int(request.headers.get("content-length") or 0) > settings.bulk_max_body_bytes:
+        raise too_large
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > settings.bulk_max_body_bytes:
+            raise too_large
+
+    try:
+        items = parse_items(bytes(body), NDJSON_MEDIA_TYPE in request.headers.get("content-type", ""))
+    except ValueError as e:
+        # orjson.JSONDecodeError is a ValueError as well
+        raise HTTPException(status_code=400, detail=str(e))
+    if len(items) > settings.bulk_max_items:
+        raise HTTPException(status_code=413,
+                            detail=f"A bulk request can create at most {settings.bulk_max_items} users.")
+
+    try:
+        results = await create_users(items)
+    except Exception:
+        logger.exception("Could not create %d users", len(items))
+        raise HTTPException(
+            status_code=500,
+            detail="An error occurred while persisting the users to the database. Please try again."
+        )
+
+    created = sum(result.status == BulkItemStatus.created for result in results)
+    return BulkCreateResult(created=created, failed=len(results) - created, results=results)
+
+
 @router.delete("/users/{doc_id}", status_code=200, operation_id="delete", responses={
     200: {"description": "Successful Response", "content": {
         "application/json": {
@@ -165,103 +671,350 @@ async def create_user(user: UserCreate) -> UserInDB:
 }
                )
 async def delete_user(doc_id: Annotated[
-    PydanticObjectId, Path(alias="Document ID", description="The document ID of the user that will be deleted.")]):
+    PydanticObjectId, Path(title="Document ID", description="The document ID of the user that will be deleted.")]):
     user = await UserInDB.get(doc_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found.")
 
     deleted_user = await user.delete()
+    user_cache.invalidate(user)
     if not deleted_user:
         raise HTTPException(status_code=500, detail="Failed to delete user. Please try again.")
 
     return {"message": "User deleted successfully"}
 
 
-@router.delete("/users", status_code=200, operation_id="",
-               description="Delete all users from the database.", responses={
+@router.delete("/users", status_code=200, operation_id="delete_users",
+               description="Delete all users from the database, or only the users that match the filters.", responses={
         200: {"description": "Successful Response", "content": {
             "application/json": {
                 "example": {
-                    "message": "All users have been deleted successfully"}
+                    "message": "10 users have been deleted.", "deleted": 10}
             }
         }},
+        202: {"description": "The delete job has been started. Its progress is available at `status_url`.",
+              "content": {
+                  "application/json": {
+                      "example": {
+                          "job_id": "0b0f6d5e5bfc4e1e9f1b8c1f1a2b3c4d",
+                          "status_url": "/jobs/0b0f6d5e5bfc4e1e9f1b8c1f1a2b3c4d"}
+                  }
+              }},
         404: {"description": "User not found", "content": {
             "application/json": {
                 "example": {
-                    "detail": "No users were found. The database is empty."}
+                    "detail": "No users were found."}
             }
         }},
-        500: {"description": "User not found", "content": {
+        500: {"description": "Internal Server Error", "content": {
             "application/json": {
                 "example": {
                     "detail": "An internal error occurred while fetching the data from the database. Please try again."}
             }
         }}
     })
-async def delete_all_users():
-    all_users = await UserInDB.find_all().to_list()
-    # Delete each user one by one (optional)
-    if all_users:
-        try:
-            for user in all_users:
-                await user.delete()
-
-            return {"message": "All users have been deleted successfully"}
-        except Exception as e:
-            print(e)
-            raise HTTPException(
-                status_code=500,
-                detail="An internal error occurred while fetching the data from the database. Please try again."
-            )
-    else:
-        raise HTTPException(status_code=404, detail="No users were found. The database is empty.")
+async def delete_all_users(
+        response: Response,
+        role: Annotated[Optional[Role], Query(description="Only delete the users with this role.")] = None,
+        created_after: Annotated[Optional[datetime], Query(
+            description="Only delete the users created at or after this date.")] = None,
+        created_before: Annotated[Optional[datetime], Query(
+            description="Only delete the users created before this date.")] = None,
+        background: Annotated[bool, Query(
+            description="Delete in bounded chunks in the background and return a job ID right away.")] = False,
+):
+    """Delete the users matching the filters with a single server side `delete_many`. In background mode, a job ID
+    is returned with status 202 and the progress of the delete can be followed at `/jobs/{job_id}`."""
+    query = user_filter(role=role, created_after=created_after, created_before=created_before)
+    if background:
+        job = await start_delete_job(query)
+        response.status_code = 202
+        return {"job_id": job.id, "status_url": f"/jobs/{job.id}"}
+
+    try:
+        result = await UserInDB.get_motor_collection().delete_many(query)
+    except Exception:
+        logger.exception("Could not delete the users matching %s", query)
+        raise HTTPException(
+            status_code=500,
+            detail="An internal error occurred while fetching the data from the database. Please try again."
+        )
+    finally:
+        user_cache.clear()
+
+    if not result.deleted_count:
+        raise HTTPException(status_code=404, detail="No users were found.")
+
+    if not query:
+        return {"message": "All users have been deleted.", "deleted": result.deleted_count}
+    return {"message": f"{result.deleted_count} users have been deleted.", "deleted": result.deleted_count}
+
+
+@router.get("/jobs/{job_id}", response_model=DeleteJob, status_code=200, operation_id="get_job", responses={
+    404: {"description": "Job not found", "content": {
+        "application/json": {
+            "example": {
+                "detail": "Job not found."}
+        }
+    }},
+    500: {"description": "Internal Server Error", "content": {
+        "application/json": {
+            "example": {
+                "detail": "An internal error occurred while fetching the data from the database. Please try again."}
+        }
+    }}
+})
+async def get_job_status(job_id: Annotated[str, Path(description="The ID of the background job.")]) -> DeleteJob:
+    """Get the progress of a background delete job, started by any worker."""
+    try:
+        job = await get_job(job_id)
+    except Exception:
+        logger.exception("Could not read the job %s", job_id)
+        raise HTTPException(status_code=500,
+                            detail="An internal error occurred while fetching the data from the database. Please try again.")
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return job
 
 
-@router.get("/populate", response_model=List[UserInDB], status_code=201,
+@router.get("/populate", response_model=PopulateSummary, status_code=201,
             description="Create users in the database with dummy data.", responses={
+        201: {"description": "Successful Response. Send `Accept: application/x-ndjson` to receive a progress line "
+                             "after every batch, followed by the summary.",
+              "content": {"application/x-ndjson": {}}},
+        500: {"description": "Internal Server Error", "content": {
+            "application/json": {
+                "example": {
+                    "detail": "An internal error occurred while fetching the data from the database. Please try again."}
+            }
+        }}})
+async def populate_db(
+        count: Annotated[int, Query(
+            ge=0, title="Count represents the number of entries the DB will be populated with.")],
+        batch_size: Annotated[int, Query(ge=1, le=MAX_POPULATE_BATCH_SIZE,
+                                         title="The number of users generated and written per batch.")] = 1000,
+        seed: Annotated[Optional[int], Query(title="Generate the same users for the same seed.")] = None,
+        accept: Annotated[Optional[str], Header(include_in_schema=False)] = None,
+) -> PopulateSummary:
+    """Populate the database with dummy data. Through Query parameters the user can decide the amount
+    of users to populate the db with. Users are generated in batches, and the next batch is generated while the
+    current one is written with an unordered `insert_many`."""
+    if accept and NDJSON_MEDIA_TYPE in accept:
+        return StreamingResponse(populate_progress(count, batch_size, seed), media_type=NDJSON_MEDIA_TYPE,
+                                 status_code=201)
+
+    try:
+        summary = PopulateSummary(inserted=0, duplicates=0, elapsed_seconds=0, docs_per_second=0)
+        async for summary in populate_pipeline(count, batch_size, seed):
+            pass
+        return summary
+    except Exception:
+        logger.exception("Could not populate the database with %d users", count)
+        raise HTTPException(status_code=500,
+                            detail="An internal error occurred while fetching the data from the database. Please try again.")
+
+
+async def populate_progress(count: int, batch_size: int, seed: Optional[int] = None) -> AsyncIterator[str]:
+    """The NDJSON progress of a populate. The status is already sent, so a failure is reported by a last line with
+    an `error`, and the totals so far."""
+    summary = PopulateSummary(inserted=0, duplicates=0, elapsed_seconds=0, docs_per_second=0)
+    try:
+        async for summary in populate_pipeline(count, batch_size, seed):
+            yield summary.json() + "\n"
+    except Exception:
+        logger.exception("Could not populate the database with %d users", count)
+        yield summary.copy(update={"error": "An internal error occurred while writing the users to the database."}
+                           ).json() + "\n"
+
+
+async def populate_pipeline(count: int, batch_size: int, seed: Optional[int] = None) -> AsyncIterator[PopulateSummary]:
+    """Generate and insert `count` users, yielding the running totals after every batch."""
+    started = time.perf_counter()
+    inserted = duplicates = 0
+    generator = await asyncio.to_thread(UserGenerator, seed)
+    batches = generator.batches(count, batch_size)
+    next_batch = asyncio.create_task(asyncio.to_thread(next, batches, None))
+    try:
+        while (batch := await next_batch) is not None:
+            next_batch = asyncio.create_task(asyncio.to_thread(next, batches, None))
+            hashes = await password_hasher.hash_many([user["password"] for user in batch])
+            # The generated users are valid by construction, they do not need to be validated again.
+            result = await insert_users([
+                UserInDB.construct(**{**user, "password": hashed,
+                                      "search_keys": search_keys(user["first_name"], user["last_name"], user["email"])})
+                for user, hashed in zip(batch, hashes)])
+            inserted += result.inserted
+            duplicates += len(result.duplicates)
+            elapsed = time.perf_counter() - started
+            yield PopulateSummary(inserted=inserted, duplicates=duplicates, elapsed_seconds=round(elapsed, 3),
+                                  docs_per_second=round(inserted / elapsed, 1) if elapsed else 0)
+    finally:
+        next_batch.cancel()
+
+
+@router.get("/diagnostics/indexes", status_code=200, operation_id="diagnose_indexes",
+            description="Report the state of the indexes and the query plan of every query the API sends.", responses={
         200: {"description": "Successful Response", "content": {
             "application/json": {
                 "example": {
-                    "message": "All users have been deleted successfully"}
+                    "indexes": {"email_unique": "ok", "role_id": "ok"},
+                    "query_plans": {"get_by_email": {"stages": ["FETCH", "IXSCAN"], "collscan": False}}}
             }
         }},
-        500: {"description": "User not found", "content": {
+        500: {"description": "Internal Server Error", "content": {
             "application/json": {
                 "example": {
                     "detail": "An internal error occurred while fetching the data from the database. Please try again."}
             }
         }}})
-async def populate_db(
-        count: Annotated[int, Query(title="Count represents the number of entries the DB will be populated with.")]
-) -> List[UserInDB]:
-    """Populate the database with dummy data. Through Query parameters the user can decide the amount
-    of users to populate the db with."""
-    users_create = generate_users(count)
-    users_out = []
+async def diagnose_indexes():
+    """Run `explain()` on every query shape the endpoints issue. Shapes that are not served by an index are flagged
+    with `collscan`, and also with `expected` when no index is meant to serve them, like the count of a gender."""
     try:
-        for user in users_create:
-            db_user = await UserInDB(**user.dict()).insert()
-            user_out_data = db_user.dict(exclude={'id'})
-            users_out.append(db_user)
-        return users_out
-    except Exception as e:
-        print(e)
+        query_plans = await explain_query_shapes()
+    except Exception:
+        logger.exception("Could not explain the query shapes")
         raise HTTPException(status_code=500,
                             detail="An internal error occurred while fetching the data from the database. Please try again.")
+    return {"indexes": index_status, "query_plans": query_plans}
 
 
-@router.patch("/users/{doc_id}", response_model=UserInDB, status_code=200, tags=["Users"])
-async def update_user(doc_id: PydanticObjectId, user_update: UserUpdate) -> UserInDB:
-    print(user_update)
-    """Update a user entry by ID."""
-    user = await UserInDB.get(doc_id)
+@router.get("/diagnostics/cache", status_code=200, operation_id="diagnose_cache",
+            description="Report the size and the hit, miss and eviction counters of the user cache, and whether it is "
+                        "enabled.", responses={
+        200: {"description": "Successful Response", "content": {
+            "application/json": {
+                "example": {"size": 120, "max_size": 10000, "hits": 5400, "misses": 130, "evictions": 0,
+                            "enabled": True}
+            }
+        }}})
+async def diagnose_cache():
+    """Get the counters of the user cache, to help sizing it."""
+    return user_cache.stats()
 
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
 
-    for field, value in user_update.dict(exclude_unset=True).items():
-        print(field, value)
-        setattr(user, field, value)
+@router.get("/diagnostics/lookups", status_code=200, operation_id="diagnose_lookups",
+            description="Report how the lookups of single users by ID and by email were coalesced.", responses={
+        200: {"description": "Successful Response", "content": {
+            "application/json": {
+                "example": {"id": {"loads": 5200, "coalesced": 3100, "batches": 180, "in_flight": 4},
+                            "email": {"loads": 800, "coalesced": 20, "batches": 95, "in_flight": 0}}
+            }
+        }}})
+async def diagnose_lookups():
+    """Get the counters of the lookups that missed the cache. `loads - coalesced` users were fetched with `batches`
+    queries."""
+    return {"id": user_cache.by_id.stats(), "email": user_cache.by_email.stats()}
+
+
+@router.get("/diagnostics/hashing", status_code=200, operation_id="diagnose_hashing",
+            description="Report the queue and the counters of the password hashing pool.", responses={
+        200: {"description": "Successful Response", "content": {
+            "application/json": {
+                "example": {"workers": 4, "waiting": 12, "running": 4, "completed": 930, "wait_seconds": 3.2,
+                            "hash_seconds": 46.5}
+            }
+        }}})
+async def diagnose_hashing():
+    """Get the counters of the password hashing pool. A growing `waiting` count, or `wait_seconds` growing faster
+    than `hash_seconds`, means that the pool is saturated."""
+    return password_hasher.stats()
+
 
-    await user.save()
+@router.get("/diagnostics/admission", status_code=200, operation_id="diagnose_admission",
+            description="Report the concurrency, the queue and the shed requests of every route.", responses={
+        200: {"description": "Successful Response", "content": {
+            "application/json": {
+                "example": {"/users/{doc_id}": {"limit": 100, "max_queue": 200, "running": 100, "waiting": 37,
+                                                "admitted": 52000, "shed": {"queue_full": 0, "queue_timeout": 12,
+                                                                            "deadline": 3}}}
+            }
+        }}})
+async def diagnose_admission():
+    """Get the counters of the admission control of this worker, per route. Requests shed with `queue_full` or
+    `queue_timeout` mean that the limit of the route is too low for the load, or the database too slow for it."""
+    return {route: controller.stats() for route, controller in controllers.items()}
+
+
+@router.patch("/users/{doc_id}", response_model=UserInDB, response_model_exclude={"password", "search_keys"},
+              status_code=200, tags=["Users"], responses={
+    404: {"description": "User not found", "content": {
+        "application/json": {
+            "example": {
+                "detail": "User not found"}
+        }
+    }},
+    409: {"description": "Conflict", "content": {
+        "application/json": {
+            "example": {
+                "detail": "There is already a user with this email."}
+        }
+    }},
+    412: {"description": "The user was modified since the revision given in `If-Match`.", "content": {
+        "application/json": {
+            "example": {
+                "detail": "The user has been modified by another request."}
+        }
+    }}
+})
+async def update_user(
+        doc_id: PydanticObjectId,
+        user_update: UserUpdate,
+        response: Response,
+        if_match: Annotated[Optional[str], Header(
+            description="The ETag of the user, as returned by a previous read or update. The update is rejected with "
+                        "412 if the user has been modified since.")] = None,
+) -> UserInDB:
+    """Update a user entry by ID. Only the fields that are set are written, with their search keys, in a single
+    atomic `find_one_and_update`. Returns the updated user, without the password hash."""
+    query = {"_id": doc_id}
+    if if_match is not None and if_match.strip() != "*":
+        revision = parse_etag(if_match)
+        if revision is None:
+            raise HTTPException(status_code=412, detail="The user has been modified by another request.")
+        # Users created before revisions were introduced have no revision field.
+        query["revision"] = {"$in": [0, None]} if revision == 0 else revision
+
+    update = Encoder(custom_encoders=UserInDB.get_settings().bson_encoders, to_db=True).encode(
+        user_update.dict(exclude_unset=True))
+    if "password" in update:
+        update["password"] = await password_hasher.hash(update["password"])
+    # The names are always set, the email only sometimes: its search key is then computed from the stored one, in
+    # the same update. The emails are ASCII, so lowercasing them is all their normalization does.
+    keys = search_keys(update["first_name"], update["last_name"], update.get("email", ""))
+    new_keys = {"$literal": keys} if "email" in update else \
+        {"$concatArrays": [{"$literal": keys[:3]}, [{"$toLower": "$email"}]]}
+    # An update pipeline, so that the values are wrapped in $literal: a name starting with `$` is not a field path.
+    pipeline = [{"$set": {**{field: {"$literal": value} for field, value in update.items()}, "search_keys": new_keys,
+                          "revision": {"$add": [{"$ifNull": ["$revision", 0]}, 1]}}}]
+    try:
+        before = await UserInDB.get_motor_collection().find_one_and_update(
+            query, pipeline, return_document=ReturnDocument.BEFORE)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail="There is already a user with this email.")
+
+    if before is None:
+        if "revision" in query:
+            raise HTTPException(status_code=412, detail="The user has been modified by another request.")
+        raise HTTPException(status_code=404, detail="User not found")
+
+    user = UserInDB.parse_obj({**before, **update, "revision": before.get("revision", 0) + 1})
+    user_cache.invalidate(UserInDB.parse_obj(before))
+    user_cache.invalidate(user)
+    response.headers["ETag"] = etag(user)
     return user
+
+
+def etag(user: UserInDB) -> str:
+    return f'"{user.revision}"'
+
+
+def parse_etag(value: str) -> Optional[int]:
+    """Read the revision from an `If-Match` header. Returns None when it is not an ETag of this API."""
+    value = value.strip()
+    if value.startswith("W/"):
+        value = value[2:]
+    try:
+        return int(value.strip('"'))
+    except ValueError:
+        return None
@@ -0,0 +1,63 @@
+import re
+from datetime import date, datetime
+from typing import Optional
+
+from bson import ObjectId
+
+from api.schemas import Gender, Role
+
+
+def user_filter(
+        role: Optional[Role] = None,
+        created_after: Optional[datetime] = None,
+        created_before: Optional[datetime] = None,
+        gender: Optional[Gender] = None,
+        born_after: Optional[date] = None,
+        born_before: Optional[date] = None,
+        min_age: Optional[int] = None,
+        max_age: Optional[int] = None,
+        name_prefix: Optional[str] = None,
+        today: Optional[date] = None,
+) -> dict:
+    """Build a MongoDB filter for the users collection. The creation date is read from the timestamp embedded in
+    the `_id`, so no extra field or index is needed to filter on it. The dates of birth are stored as ISO strings,
+    which compare in the same order as the dates. The name prefix is case sensitive and matches the start of the last
+    name, so that it can be served by an index."""
+    query = {}
+    if role is not None:
+        query["role"] = role.value
+    if gender is not None:
+        query["gender"] = gender.value
+
+    birth_range = {}
+    if born_after is not None:
+        birth_range["$gte"] = born_after.isoformat()
+    if born_before is not None:
+        birth_range["$lt"] = born_before.isoformat()
+    today = today or date.today()
+    if min_age is not None:
+        birth_range["$lte"] = _years_before(today, min_age).isoformat()
+    if max_age is not None:
+        birth_range["$gt"] = _years_before(today, max_age + 1).isoformat()
+    if birth_range:
+        query["date_of_birth"] = birth_range
+
+    if name_prefix:
+        query["last_name"] = {"$regex": f"^{re.escape(name_prefix)}"}
+
+    id_range = {}
+    if created_after is not None:
+        id_range["$gte"] = ObjectId.from_datetime(created_after)
+    if created_before is not None:
+        id_range["$lt"] = ObjectId.from_datetime(created_before)
+    if id_range:
+        query["_id"] = id_range
+    return query
+
+
+def _years_before(day: date, years: int) -> date:
+    try:
+        return day.replace(year=day.year - years)
+    except ValueError:
+        # February 29th, in a year that is not a leap year
+        return day.replace(year=day.year - years, day=28)
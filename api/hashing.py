@@ -0,0 +1,158 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+import re
+import time
+import concurrent.futures
+from concurrent.futures import Executor
+from typing import Dict, List, Optional
+
+from api.config import get_settings
+
+HASH_ALGORITHM = "scrypt"
+SALT_BYTES = 16
+KEY_BYTES = 32
+HASH_PATTERN = re.compile(r"scrypt\$(\d{1,10})\$(\d{1,10})\$(\d{1,10})\$([A-Za-z0-9+/]+)\$([A-Za-z0-9+/]+)")
+# Passwords hashed per job by `hash_many`, so that a bulk insert does not pay the executor overhead per password.
+BATCH_JOB_SIZE = 64
+
+
+def _b64(data: bytes) -> str:
+    return base64.b64encode(data).decode("ascii").rstrip("=")
+
+
+def _unb64(data: str) -> bytes:
+    return base64.b64decode(data + "=" * (-len(data) % 4))
+
+
+def _max_memory(n: int, r: int, p: int) -> int:
+    # What scrypt needs for these parameters, with some slack. The default limit of OpenSSL is 32 MiB.
+    return 2 * 128 * r * (n + p + 2)
+
+
+def hash_password_sync(password: str, n: int, r: int, p: int) -> str:
+    """Hash a password with scrypt, in the `scrypt$n$r$p$salt$hash` format. This blocks for as long as the cost
+    parameters require, so it must not be called on the event loop."""
+    salt = os.urandom(SALT_BYTES)
+    key = hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=_max_memory(n, r, p),
+                         dklen=KEY_BYTES)
+    return f"{HASH_ALGORITHM}${n}${r}${p}${_b64(salt)}${_b64(key)}"
+
+
+def hash_passwords_sync(passwords: List[str], n: int, r: int, p: int) -> List[str]:
+    return [hash_password_sync(password, n, r, p) for password in passwords]
+
+
+def is_password_hash(value: str, n: int, r: int, p: int) -> bool:
+    """Whether a value is a hash made by `hash_password_sync`, as found in an export of the users, that costs at
+    least as much as a hash with the cost parameters `n`, `r` and `p`: its `n` is a power of 2 no lower than `n`,
+    its `r` and `p` are no higher than `r` and `p`, and its salt and key have the lengths of `hash_password_sync`.
+    Anything else is a plaintext password, even if it looks like a hash."""
+    match = HASH_PATTERN.fullmatch(value)
+    if match is None:
+        return False
+    hash_n, hash_r, hash_p = (int(group) for group in match.groups()[:3])
+    if hash_n & (hash_n - 1) or hash_n < max(n, 2) or not 1 <= hash_r <= r or not 1 <= hash_p <= p:
+        return False
+    try:
+        return len(_unb64(match[4])) == SALT_BYTES and len(_unb64(match[5])) == KEY_BYTES
+    except ValueError:
+        return False
+
+
+def verify_password_sync(password: str, hashed: str) -> bool:
+    try:
+        algorithm, n, r, p, salt, key = hashed.split("$")
+        n, r, p = int(n), int(r), int(p)
+    except ValueError:
+        return False
+    if algorithm != HASH_ALGORITHM:
+        return False
+    try:
+        expected = _unb64(key)
+        actual = hashlib.scrypt(password.encode(), salt=_unb64(salt), n=n, r=r, p=p, maxmem=_max_memory(n, r, p),
+                                dklen=len(expected))
+    except ValueError:
+        # Invalid base64, or cost parameters that scrypt rejects, e.g. an `n` that is not a power of 2.
+        return False
+    return hmac.compare_digest(actual, expected)
+
+
+class PasswordHasher:
+    """Runs the password hashes in a pool of threads or processes, so that they never block the event loop.
+
+    At most `workers` hash jobs run at the same time; the other callers wait in a queue. The number of waiting and
+    running jobs, and the time spent waiting and hashing, are tracked for sizing the pool."""
+
+    def __init__(self, workers: int, use_processes: bool = False, n: int = 2 ** 14, r: int = 8, p: int = 1):
+        self.workers = workers
+        self.use_processes = use_processes
+        self.n, self.r, self.p = n, r, p
+        self._executor: Optional[Executor] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.waiting = self.running = self.completed = 0
+        self.wait_seconds = self.hash_seconds = 0.0
+
+    def _get_executor(self) -> Executor:
+        # Created on first use, so that every worker process of the server gets its own pool.
+        if self._executor is None:
+            # Looked up here, concurrent.futures only imports multiprocessing when ProcessPoolExecutor is used.
+            futures = concurrent.futures
+            pool = futures.ProcessPoolExecutor if self.use_processes else futures.ThreadPoolExecutor
+            self._executor = pool(max_workers=self.workers)
+        return self._executor
+
+    async def _run(self, function, *args):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.workers)
+        queued = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        started = time.perf_counter()
+        self.wait_seconds += started - queued
+        self.running += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._get_executor(), function, *args)
+        finally:
+            self.running -= 1
+            self.completed += 1
+            self.hash_seconds += time.perf_counter() - started
+            self._semaphore.release()
+
+    async def hash(self, password: str) -> str:
+        return await self._run(hash_password_sync, password, self.n, self.r, self.p)
+
+    async def hash_many(self, passwords: List[str]) -> List[str]:
+        """Hash many passwords, in jobs of `BATCH_JOB_SIZE` that run in parallel on the pool."""
+        jobs = [self._run(hash_passwords_sync, passwords[start:start + BATCH_JOB_SIZE], self.n, self.r, self.p)
+                for start in range(0, len(passwords), BATCH_JOB_SIZE)]
+        return [hashed for chunk in await asyncio.gather(*jobs) for hashed in chunk]
+
+    async def verify(self, password: str, hashed: str) -> bool:
+        return await self._run(verify_password_sync, password, hashed)
+
+    def stats(self) -> Dict[str, float]:
+        return {"workers": self.workers, "waiting": self.waiting, "running": self.running,
+                "completed": self.completed, "wait_seconds": round(self.wait_seconds, 3),
+                "hash_seconds": round(self.hash_seconds, 3)}
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        self._semaphore = None
+
+
+def _create_hasher() -> PasswordHasher:
+    settings = get_settings()
+    return PasswordHasher(workers=settings.password_hash_workers or os.cpu_count() or 1,
+                          use_processes=settings.password_hash_processes, n=settings.password_hash_n,
+                          r=settings.password_hash_r, p=settings.password_hash_p)
+
+
+password_hasher = _create_hasher()
@@ -0,0 +1,39 @@
+from fastapi import APIRouter, HTTPException
+
+from api.database import ping_db
+
+router = APIRouter()
+
+
+@router.get("/healthz", status_code=200, operation_id="healthz", responses={
+    200: {"description": "The process is alive.", "content": {
+        "application/json": {
+            "example": {
+                "status": "ok"}
+        }
+    }}
+})
+async def healthz():
+    """Liveness probe. It does not touch the database."""
+    return {"status": "ok"}
+
+
+@router.get("/readyz", status_code=200, operation_id="readyz", responses={
+    200: {"description": "The API can serve requests.", "content": {
+        "application/json": {
+            "example": {
+                "status": "ready"}
+        }
+    }},
+    503: {"description": "The database cannot be reached.", "content": {
+        "application/json": {
+            "example": {
+                "detail": "The database is not reachable."}
+        }
+    }}
+})
+async def readyz():
+    """Readiness probe. Returns 503 until the database answers a ping."""
+    if not await ping_db():
+        raise HTTPException(status_code=503, detail="The database is not reachable.")
+    return {"status": "ready"}
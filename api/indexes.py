@@ -0,0 +1,139 @@
+import argparse
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, List, Type
+
+from beanie import Document
+from bson import ObjectId
+from pymongo import IndexModel
+
+from api.models import USER_INDEXES, UserInDB
+
+logger = logging.getLogger(__name__)
+
+# The state of the last index sync, per index name: "ok", "created", "rebuilt", "outdated" or the error that occurred.
+index_status: Dict[str, str] = {}
+
+# One sample of every query shape the endpoints send to the users collection, as (filter, sort) pairs.
+QUERY_SHAPES = {
+    "get_all_users": ({"_id": {"$gt": ObjectId("000000000000000000000000")}}, [("_id", 1)]),
+    "get_user_by_id": ({"_id": ObjectId("000000000000000000000000")}, None),
+    "get_by_email": ({"email": "email@provider.com"}, None),
+    "lookup_users": ({"$or": [{"_id": {"$in": [ObjectId("000000000000000000000000")]}},
+                              {"email": {"$in": ["email@provider.com"]}}]}, None),
+    "delete_users_by_role": ({"role": "admin", "_id": {"$gte": ObjectId.from_datetime(datetime(2023, 1, 1))}},
+                             [("_id", 1)]),
+    "list_users_by_name_prefix": ({"last_name": {"$regex": "^Dim"}}, [("last_name", 1), ("_id", 1)]),
+    "list_users_by_age": ({"date_of_birth": {"$gt": "1990-01-01", "$lte": "2000-01-01"}},
+                          [("date_of_birth", -1), ("_id", -1)]),
+    "list_users_by_role_gender_and_age": ({"role": "user", "gender": "female",
+                                           "date_of_birth": {"$gt": "1990-01-01", "$lte": "2000-01-01"}},
+                                          [("date_of_birth", 1), ("_id", 1)]),
+    "list_users_by_role_sorted_by_name": ({"role": "user"}, [("last_name", 1), ("_id", 1)]),
+    "list_users_by_role_sorted_by_age": ({"role": "user"}, [("date_of_birth", -1), ("_id", -1)]),
+    "list_users_by_gender": ({"gender": "female", "_id": {"$gt": ObjectId("000000000000000000000000")}}, [("_id", 1)]),
+    "count_users_by_role": ({"role": "admin"}, None),
+    "count_users_by_gender": ({"gender": "female"}, None),
+    "search_users": ({"search_keys": {"$regex": "^ada"}}, None),
+}
+# The shapes that are knowingly not served by an index. A gender matches a large part of the users, so an index on
+# it would not read much less than the collection scan, and would cost every insert. The pages of users of a gender
+# walk the `_id` index instead, and stop once they are full.
+UNINDEXED_SHAPES = {"count_users_by_gender"}
+
+
+def _index_spec(index: dict) -> tuple:
+    """Normalize an index definition, as declared or as returned by `index_information()`, for comparison."""
+    key = index["key"].items() if isinstance(index["key"], dict) else index["key"]
+    fields = [(field, int(direction) if isinstance(direction, (int, float)) else direction) for field, direction in key]
+    return fields, bool(index.get("unique", False))
+
+
+async def sync_indexes(model: Type[Document] = UserInDB, indexes: List[IndexModel] = None,
+                       drop_stale: bool = False, rebuild_unique: bool = False) -> Dict[str, str]:
+    """Create the declared indexes that are missing, and rebuild the ones whose definition has changed. Indexes that
+    are not declared are only dropped when `drop_stale` is set. Failures are recorded in `index_status` and logged,
+    they never raise, so this can safely run in the background while the API is serving requests.
+
+    A unique index is rebuilt by dropping it first, which lets duplicates in until the new one is built, so an
+    outdated unique index is only reported, unless `rebuild_unique` is set."""
+    indexes = USER_INDEXES if indexes is None else indexes
+    collection = model.get_motor_collection()
+    try:
+        existing = await collection.index_information()
+    except Exception as e:
+        logger.error("Could not list the indexes: %s", e)
+        for index in indexes:
+            index_status[index.document["name"]] = f"error: {e}"
+        return index_status
+    for index in indexes:
+        name = index.document["name"]
+        try:
+            if name not in existing:
+                await collection.create_indexes([index])
+                index_status[name] = "created"
+            elif _index_spec(existing[name]) == _index_spec(index.document):
+                index_status[name] = "ok"
+            elif not rebuild_unique and (existing[name].get("unique") or index.document.get("unique")):
+                logger.warning("The unique index %s differs from its declaration. Rebuild it during a maintenance "
+                               "window with `python -m api.indexes --rebuild-unique`.", name)
+                index_status[name] = "outdated"
+            else:
+                await collection.drop_index(name)
+                await collection.create_indexes([index])
+                index_status[name] = "rebuilt"
+        except Exception as e:
+            logger.error("Could not sync the index %s: %s", name, e)
+            index_status[name] = f"error: {e}"
+    if drop_stale:
+        declared = {index.document["name"] for index in indexes}
+        for name in existing.keys() - declared - {"_id_"}:
+            try:
+                await collection.drop_index(name)
+            except Exception as e:
+                logger.error("Could not drop the index %s: %s", name, e)
+    return index_status
+
+
+def _plan_stages(plan: dict) -> List[str]:
+    stages = [plan.get("stage")]
+    for child in plan.get("inputStages", []) + [plan[key] for key in ("inputStage", "queryPlan") if key in plan]:
+        stages.extend(_plan_stages(child))
+    return [stage for stage in stages if stage]
+
+
+async def explain_query_shapes(model: Type[Document] = UserInDB) -> Dict[str, dict]:
+    """Run `explain()` for every query shape in `QUERY_SHAPES` and report the stages of the winning plan. A shape is
+    flagged when its plan contains a COLLSCAN, which means no index serves it, and marked `expected` when it is one of
+    the `UNINDEXED_SHAPES`."""
+    collection = model.get_motor_collection()
+    report = {}
+    for name, (query, sort) in QUERY_SHAPES.items():
+        plan = await collection.find(query, sort=sort).explain()
+        stages = _plan_stages(plan["queryPlanner"]["winningPlan"])
+        report[name] = {"stages": stages, "collscan": "COLLSCAN" in stages}
+        if name in UNINDEXED_SHAPES:
+            report[name]["expected"] = True
+    return report
+
+
+async def main(rebuild_unique: bool = False):
+    from api.database import init_db
+
+    await init_db()
+    await sync_indexes(rebuild_unique=rebuild_unique)
+    for name, status in index_status.items():
+        print(f"{name}: {status}")
+    for name, result in (await explain_query_shapes()).items():
+        collscan = ("  COLLSCAN (expected)" if result.get("expected") else "  COLLSCAN!") if result["collscan"] else ""
+        print(f"{name}: {' <- '.join(result['stages'])}{collscan}")
+
+
+if __name__ == "__main__":
+    """Launched with `python -m api.indexes` at root level"""
+    parser = argparse.ArgumentParser(description="Sync the indexes of the users collection and explain the queries.")
+    parser.add_argument("--rebuild-unique", action="store_true",
+                        help="Also rebuild the outdated unique indexes. Duplicates can be inserted while they are "
+                             "rebuilt.")
+    asyncio.run(main(parser.parse_args().rebuild_unique))
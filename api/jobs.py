@@ -0,0 +1,92 @@
+import asyncio
+import contextvars
+import logging
+import uuid
+from datetime import datetime, timezone
+from typing import Optional
+
+from pymongo import ASCENDING, IndexModel
+
+from api.cache import user_cache
+from api.models import UserInDB
+from api.schemas import DeleteJob, JobStatus
+
+logger = logging.getLogger(__name__)
+
+DELETE_CHUNK_SIZE = 1000
+# Pause between two chunks, so that a large delete does not starve the primary.
+DELETE_CHUNK_PAUSE_SECONDS = 0.05
+# The finished jobs are removed by MongoDB this long after they finished.
+FINISHED_JOB_TTL_SECONDS = 24 * 60 * 60
+
+JOBS_COLLECTION = "jobs"
+JOB_INDEXES = [IndexModel([("finished_at", ASCENDING)], name="finished_at_ttl",
+                          expireAfterSeconds=FINISHED_JOB_TTL_SECONDS)]
+_tasks: set = set()
+
+
+def jobs_collection():
+    """The jobs are stored next to the users, so that every worker can report the progress of a job started by
+    another one."""
+    return UserInDB.get_motor_collection().database[JOBS_COLLECTION]
+
+
+async def create_job_indexes():
+    """Create the TTL index of the finished jobs. Failures are logged, it runs in the background at startup."""
+    try:
+        await jobs_collection().create_indexes(JOB_INDEXES)
+    except Exception:
+        logger.exception("Could not create the indexes of the %s collection", JOBS_COLLECTION)
+
+
+async def get_job(job_id: str) -> Optional[DeleteJob]:
+    document = await jobs_collection().find_one({"_id": job_id})
+    if document is None:
+        return None
+    return DeleteJob.parse_obj({**document, "id": document.pop("_id")})
+
+
+async def _save(job: DeleteJob):
+    document = job.dict(exclude={"id"})
+    await jobs_collection().replace_one({"_id": job.id}, document, upsert=True)
+
+
+async def start_delete_job(query: dict, chunk_size: int = DELETE_CHUNK_SIZE) -> DeleteJob:
+    """Register a delete job for the users matching `query` and run it in the background, in this worker."""
+    job = DeleteJob(id=uuid.uuid4().hex, created_at=datetime.now(timezone.utc))
+    await _save(job)
+    # Run in an empty context, the job outlives the request and must not inherit its deadline.
+    task = contextvars.Context().run(asyncio.create_task, _run_delete_job(job, query, chunk_size))
+    # Keep a reference to the task, otherwise it could be garbage collected before it is done.
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return job
+
+
+async def _run_delete_job(job: DeleteJob, query: dict, chunk_size: int):
+    collection = UserInDB.get_motor_collection()
+    job.status = JobStatus.running
+    try:
+        job.total = await collection.count_documents(query)
+        await _save(job)
+        while True:
+            ids = [document["_id"] async for document in
+                   collection.find(query, projection={"_id": 1}, sort=[("_id", 1)], limit=chunk_size)]
+            if not ids:
+                break
+            result = await collection.delete_many({"_id": {"$in": ids}})
+            job.deleted += result.deleted_count
+            user_cache.clear()
+            await _save(job)
+            await asyncio.sleep(DELETE_CHUNK_PAUSE_SECONDS)
+        job.status = JobStatus.completed
+    except Exception as e:
+        logger.exception("The delete job %s failed", job.id)
+        job.status = JobStatus.failed
+        job.error = str(e)
+    finally:
+        job.finished_at = datetime.now(timezone.utc)
+        try:
+            await _save(job)
+        except Exception:
+            logger.exception("Could not save the state of the delete job %s", job.id)
@@ -0,0 +1,97 @@
+import asyncio
+import contextvars
+from typing import Awaitable, Callable, Dict, Generic, Hashable, List, Optional, Set, TypeVar
+
+import pymongo
+
+from api.metrics import lookup_batch_size, lookup_coalesced
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class BatchLoader(Generic[K, V]):
+    """Coalesces the concurrent lookups of single keys into batches.
+
+    A lookup of a key that is already being looked up waits for the same result. The other keys looked up within
+    `window` seconds of the first one are fetched together, with one call of `fetch`, which takes the keys and returns
+    the values it found by key. A batch is sent as soon as it holds `max_batch_size` keys. Nothing is kept once a batch
+    is answered: a later lookup reads the database again."""
+
+    def __init__(self, name: str, fetch: Callable[[List[K]], Awaitable[Dict[K, V]]], window: float = 0.001,
+                 max_batch_size: int = 100, timeout: Optional[float] = None):
+        self.name = name
+        self.fetch = fetch
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.timeout = timeout
+        self.loads = self.coalesced = self.batches = 0
+        # The lookups not answered yet, by key, and the ones among them that are not sent yet.
+        self._futures: Dict[K, asyncio.Future] = {}
+        self._batch: Dict[K, asyncio.Future] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def load(self, key: K) -> Optional[V]:
+        """The value of `key`, or None when `fetch` did not find it. Raises the error of `fetch`."""
+        self.loads += 1
+        future = self._futures.get(key)
+        if future is not None:
+            self.coalesced += 1
+            lookup_coalesced.labels(self.name).inc()
+        else:
+            loop = asyncio.get_running_loop()
+            future = self._futures[key] = self._batch[key] = loop.create_future()
+            if len(self._batch) >= self.max_batch_size:
+                self._dispatch()
+            elif self._timer is None:
+                self._timer = loop.call_later(self.window, self._dispatch)
+        # Shielded, a caller that is cancelled, e.g. because its client disconnected, does not cancel the others.
+        return await asyncio.shield(future)
+
+    def forget(self, key: K):
+        """Make the next lookups of `key` read the database again, instead of waiting for the lookup in flight. Call
+        it after writing the value of `key`. A lookup that is not sent yet reads the new value already."""
+        if key not in self._batch:
+            self._futures.pop(key, None)
+
+    def clear(self):
+        for key in list(self._futures):
+            self.forget(key)
+
+    def stats(self) -> Dict[str, int]:
+        return {"loads": self.loads, "coalesced": self.coalesced, "batches": self.batches,
+                "in_flight": len(self._futures)}
+
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._batch = self._batch, {}
+        self.batches += 1
+        lookup_batch_size.labels(self.name).observe(len(batch))
+        # Run in an empty context, the batch is shared and must not inherit the deadline of the request that sent it.
+        task = contextvars.Context().run(asyncio.create_task, self._fetch(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _fetch(self, batch: Dict[K, asyncio.Future]):
+        try:
+            with pymongo.timeout(self.timeout):
+                values = await self.fetch(list(batch))
+        except asyncio.CancelledError:
+            for future in batch.values():
+                future.cancel()
+            raise
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for key, future in batch.items():
+                if not future.done():
+                    future.set_result(values.get(key))
+        finally:
+            for key, future in batch.items():
+                if self._futures.get(key) is future:
+                    del self._futures[key]
@@ -0,0 +1,49 @@
+from typing import FrozenSet, List, Tuple
+
+from beanie import PydanticObjectId
+
+from api.models import UserInDB
+from api.projection import projection_model
+from api.serialization import RAW_BSON_OPTIONS
+
+
+async def lookup_users(ids: List[PydanticObjectId], emails: List[str], fields: FrozenSet[str],
+                       raw: bool = False) -> Tuple[List[dict], List[str]]:
+    """Fetch the users matching `ids` or `emails` with a single `$in` query. Returns the documents in the order they
+    were requested, followed by the requested keys that matched no user. With `raw`, the documents are the raw BSON
+    received from MongoDB, and keep their email when they were looked up by email."""
+    ids = list(dict.fromkeys(ids))
+    emails = list(dict.fromkeys(emails))
+    conditions = []
+    if ids:
+        conditions.append({"_id": {"$in": ids}})
+    if emails:
+        conditions.append({"email": {"$in": emails}})
+    if not conditions:
+        return [], []
+
+    projection = dict(projection_model(fields).Settings.projection)
+    if emails:
+        # The email is needed to put the users looked up by email back in order.
+        projection["email"] = 1
+    query = conditions[0] if len(conditions) == 1 else {"$or": conditions}
+    collection = UserInDB.get_motor_collection()
+    if raw:
+        collection = collection.with_options(codec_options=RAW_BSON_OPTIONS)
+    cursor = collection.find(query, projection=projection)
+    documents = await cursor.to_list(None)
+
+    by_id = {document["_id"]: document for document in documents}
+    by_email = {document.get("email"): document for document in documents}
+    found, not_found, seen = [], [], set()
+    for key, document in [(str(doc_id), by_id.get(doc_id)) for doc_id in ids] + \
+                         [(email, by_email.get(email)) for email in emails]:
+        if document is None:
+            not_found.append(key)
+        elif document["_id"] not in seen:
+            seen.add(document["_id"])
+            found.append(document)
+    if emails and "email" not in fields and not raw:
+        for document in found:
+            document.pop("email", None)
+    return found, not_found
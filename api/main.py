@@ -1,13 +1,34 @@
-import uvicorn
+import asyncio
+import time
+from contextlib import asynccontextmanager, suppress
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
+from api.cache import user_cache
+from api.changes import change_feed
+from api.compression import CompressionMiddleware
+from api.config import get_settings
+from api.database import close_db, init_db
 from api.endpoints import router
+from api.hashing import password_hasher
+from api.health import router as health_router
+from api.metrics import MetricsMiddleware, mark_process_dead, router as metrics_router
+from api.profiling import ProfilingMiddleware
+from api.serve import report_startup
 
 tags_metadata = [
     {
         "name": "Users",
         "description": "All CRUD endpoints for the User entity."
+    },
+    {
+        "name": "Health",
+        "description": "Liveness and readiness probes."
+    },
+    {
+        "name": "Monitoring",
+        "description": "Prometheus metrics."
     }
 ]
 
@@ -24,6 +45,27 @@ You will be able to:
 * **Delete users**.
 """
 
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Open the database connection on startup and close it, and the password hashing pool, on shutdown. Every
+    worker process runs its own lifespan, and has its own Motor client and user cache."""
+    started = time.perf_counter()
+    settings = get_settings()
+    await init_db()
+    following = asyncio.create_task(user_cache.follow(change_feed, settings.changes_queue_size,
+                                                      required=settings.workers > 1))
+    report_startup(time.perf_counter() - started)
+    yield
+    following.cancel()
+    with suppress(asyncio.CancelledError):
+        await following
+    await close_db()
+    password_hasher.shutdown()
+    mark_process_dead()
+
+
 app = FastAPI(
     title="Daniel's API",
     description=description,
@@ -34,10 +76,13 @@ app = FastAPI(
         "url": "https://github.com/danieldimitriou",
         "email": "danieldimitriou1@gmail.com",
     },
-    openapi_tags=tags_metadata
+    openapi_tags=tags_metadata,
+    lifespan=lifespan
 )
 
 app.include_router(router, tags=['Users'])
+app.include_router(health_router, tags=['Health'])
+app.include_router(metrics_router, tags=['Monitoring'])
 origins = [
     "*",
 ]
@@ -49,7 +94,19 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+settings = get_settings()
+if settings.compression_min_bytes is not None:
+    app.add_middleware(CompressionMiddleware, minimum_size=settings.compression_min_bytes)
+# Only added when it is configured, a disabled profiler is not even in the middleware stack.
+if settings.profiling_token or settings.profiling_sample_rate:
+    app.add_middleware(ProfilingMiddleware, token=settings.profiling_token, sample_rate=settings.profiling_sample_rate,
+                       directory=settings.profiling_dir, max_files=settings.profiling_max_files)
+# Added last, so that it wraps the other middlewares and times the whole request.
+if settings.metrics_enabled:
+    app.add_middleware(MetricsMiddleware)
 
 if __name__ == "__main__":
-    """Launched with `poetry run start` at root level"""
+    """Launched with `python api/main.py` at root level, for development. Use the `serve` command in production."""
+    import uvicorn
+
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
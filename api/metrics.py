@@ -0,0 +1,184 @@
+import os
+import threading
+import time
+
+from fastapi import APIRouter, Response
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess)
+from pymongo import monitoring
+
+# Finer than the default buckets of prometheus_client, most commands and checkouts take well under 5ms.
+DATABASE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# The label of the requests that matched no route, so that scanned URLs do not create new series.
+UNMATCHED_ROUTE = "unmatched"
+
+http_request_duration = Histogram("http_request_duration_seconds", "The time spent handling HTTP requests.",
+                                  ["method", "route"])
+http_requests = Counter("http_requests", "The number of HTTP requests handled.", ["method", "route", "status"])
+http_requests_in_progress = Gauge("http_requests_in_progress", "The number of HTTP requests being handled.",
+                                  ["method"], multiprocess_mode="livesum")
+mongodb_command_duration = Histogram("mongodb_command_duration_seconds", "The duration of MongoDB commands.",
+                                     ["command", "collection"], buckets=DATABASE_BUCKETS)
+mongodb_command_failures = Counter("mongodb_command_failures", "The number of failed MongoDB commands.",
+                                   ["command", "collection"])
+mongodb_pool_checkout_wait = Histogram("mongodb_pool_checkout_wait_seconds",
+                                       "The time waited for a connection from the pool.", buckets=DATABASE_BUCKETS)
+mongodb_pool_checkout_failures = Counter("mongodb_pool_checkout_failures",
+                                         "The number of connection checkouts that failed.", ["reason"])
+mongodb_pool_connections_in_use = Gauge("mongodb_pool_connections_in_use",
+                                        "The number of pooled connections checked out.", multiprocess_mode="livesum")
+admission_queue_depth = Gauge("admission_queue_depth", "The number of requests waiting for a slot of their route.",
+                              ["route"], multiprocess_mode="livesum")
+admission_in_flight = Gauge("admission_in_flight", "The number of admitted requests being handled.", ["route"],
+                            multiprocess_mode="livesum")
+admission_shed = Counter("admission_shed", "The number of requests answered 503 by the admission control.",
+                         ["route", "reason"])
+change_feed_subscribers = Gauge("change_feed_subscribers", "The number of subscribers of the change feed.",
+                                multiprocess_mode="livesum")
+change_feed_events = Counter("change_feed_events", "The number of changes read from the change stream.")
+change_feed_resyncs = Counter("change_feed_resyncs", "The number of subscribers told to reload the users.")
+lookup_batch_size = Histogram("lookup_batch_size", "The number of users fetched by one query of the lookups by ID or "
+                              "email.", ["loader"], buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+lookup_coalesced = Counter("lookup_coalesced", "The number of lookups that waited for the same lookup in flight.",
+                           ["loader"])
+
+
+class MetricsMiddleware:
+    """ASGI middleware that records the latency, the status code and the number of in-flight requests. The route
+    label is the path template of the route, e.g. `/users/{doc_id}`, so that every user ID does not create a new
+    series."""
+
+    def __init__(self, app):
+        self.app = app
+        self._routes = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        in_progress = http_requests_in_progress.labels(method)
+        in_progress.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            in_progress.dec()
+            # The router sets the endpoint of the matched route in the scope.
+            route = self._route(scope)
+            http_request_duration.labels(method, route).observe(elapsed)
+            http_requests.labels(method, route, str(status)).inc()
+
+    def _route(self, scope) -> str:
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return UNMATCHED_ROUTE
+        if endpoint not in self._routes:
+            self._routes[endpoint] = next((route.path for route in scope["app"].routes
+                                           if getattr(route, "endpoint", None) is endpoint), UNMATCHED_ROUTE)
+        return self._routes[endpoint]
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """Times the MongoDB commands, per command name and collection. The collection is only known when a command
+    starts, so it is kept until the command succeeds or fails."""
+
+    def __init__(self):
+        self._collections = {}
+
+    def started(self, event):
+        collection = event.command.get("collection") if event.command_name == "getMore" else \
+            event.command.get(event.command_name)
+        self._collections[(event.connection_id, event.request_id)] = \
+            collection if isinstance(collection, str) else event.database_name
+
+    def succeeded(self, event):
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        mongodb_command_duration.labels(event.command_name, collection).observe(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        mongodb_command_duration.labels(event.command_name, collection).observe(event.duration_micros / 1e6)
+        mongodb_command_failures.labels(event.command_name, collection).inc()
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Records the time waited for a pooled connection, and the number of connections in use."""
+
+    def __init__(self):
+        # pymongo before 4.7 does not report the duration of a checkout, it is measured instead. The checkout
+        # starts and ends on the same thread.
+        self._local = threading.local()
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        duration = getattr(event, "duration", None)
+        mongodb_pool_checkout_wait.observe(duration if duration is not None else
+                                           time.perf_counter() - getattr(self._local, "started", time.perf_counter()))
+        mongodb_pool_connections_in_use.inc()
+
+    def connection_check_out_failed(self, event):
+        mongodb_pool_checkout_failures.labels(event.reason).inc()
+
+    def connection_checked_in(self, event):
+        mongodb_pool_connections_in_use.dec()
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
+
+
+def registry() -> CollectorRegistry:
+    """The registry to expose. With several worker processes, every worker writes its metrics to the directory in
+    `PROMETHEUS_MULTIPROC_DIR`, and the metrics of all the workers are collected from there."""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        collector_registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(collector_registry)
+        return collector_registry
+    return REGISTRY
+
+
+def mark_process_dead():
+    """Drop the live gauges of this worker from the metrics of the other workers, when it stops."""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+router = APIRouter()
+
+
+@router.get("/metrics", status_code=200, operation_id="metrics", responses={
+    200: {"description": "The metrics, in the Prometheus text format.", "content": {CONTENT_TYPE_LATEST: {}}}
+})
+async def metrics():
+    """Expose the HTTP and MongoDB metrics to Prometheus."""
+    return Response(generate_latest(registry()), media_type=CONTENT_TYPE_LATEST)
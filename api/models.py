@@ -1,12 +1,55 @@
-from typing import Annotated
+import unicodedata
+from typing import Annotated, List, Optional
 from beanie import Document, Indexed
 from datetime import date
-from pydantic import Field, constr
+from pydantic import Field, constr, root_validator
+from pymongo import ASCENDING, IndexModel
 from api.schemas import UserCreate
 
+# The indexes of the users collection. They are created and reconciled by `api.indexes.sync_indexes` in the
+# background at startup instead of by Beanie, so that building them on a large collection does not delay startup.
+# The list filters follow the equality, sort, range order: the equality filters (role, gender) come first, then the
+# field that is sorted or ranged on, then `_id`, which breaks the ties of the keyset pagination.
+USER_INDEXES = [
+    IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+    IndexModel([("role", ASCENDING), ("_id", ASCENDING)], name="role_id"),
+    IndexModel([("last_name", ASCENDING), ("_id", ASCENDING)], name="last_name_id"),
+    IndexModel([("date_of_birth", ASCENDING), ("_id", ASCENDING)], name="date_of_birth_id"),
+    IndexModel([("role", ASCENDING), ("gender", ASCENDING), ("date_of_birth", ASCENDING), ("_id", ASCENDING)],
+               name="role_gender_date_of_birth_id"),
+    IndexModel([("role", ASCENDING), ("last_name", ASCENDING), ("_id", ASCENDING)], name="role_last_name_id"),
+    IndexModel([("role", ASCENDING), ("date_of_birth", ASCENDING), ("_id", ASCENDING)], name="role_date_of_birth_id"),
+    IndexModel([("search_keys", ASCENDING)], name="search_keys"),
+]
+
+
+def normalize(text: str) -> str:
+    """Lowercase a text and strip its accents, so that `Élodie` is found by `elo`."""
+    decomposed = unicodedata.normalize("NFKD", text)
+    return " ".join("".join(char for char in decomposed if not unicodedata.combining(char)).casefold().split())
+
+
+def search_keys(first_name: str, last_name: str, email: str) -> List[str]:
+    """The normalized values a user can be found by, from the best match to the worst: the full name, the last name,
+    the first name and the email."""
+    first_name, last_name = normalize(first_name), normalize(last_name)
+    return [f"{first_name} {last_name}", last_name, first_name, normalize(email)]
+
 
 # Beanie Document (ODM) model
 class UserInDB(Document, UserCreate):
+    # Only the hash of the password is stored, see `api.hashing`.
+    password: Annotated[str, Field(description="The scrypt hash of the password of the user.")]
+    # Incremented by every update, and exposed as the ETag of the user for optimistic concurrency.
+    revision: Annotated[int, Field(description="The number of times the user has been updated.")] = 0
+    # Shadow field of the typeahead search, see `api.search`. It is derived from the names and the email.
+    search_keys: Annotated[Optional[List[str]], Field(description="The normalized names and email of the user.")]
+
+    @root_validator(skip_on_failure=True)
+    def set_search_keys(cls, values):
+        values["search_keys"] = search_keys(values["first_name"], values["last_name"], values["email"])
+        return values
+
     class Settings:
         # Set the collection name
         name = "users"
@@ -0,0 +1,89 @@
+import base64
+import binascii
+from typing import Any, AsyncIterator, List, Optional, Tuple
+
+import bson
+from beanie import PydanticObjectId
+from bson.errors import InvalidBSON, InvalidId
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 500
+
+
+def encode_cursor(last_id: PydanticObjectId) -> str:
+    """Encode the `_id` of the last document of a page into an opaque, url safe cursor."""
+    return base64.urlsafe_b64encode(last_id.binary).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> PydanticObjectId:
+    """Decode a cursor created by `encode_cursor`. Raises ValueError if the cursor is malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        return PydanticObjectId(raw)
+    except (binascii.Error, InvalidId, TypeError) as e:
+        raise ValueError("Invalid cursor.") from e
+
+
+def encode_sort_cursor(field: str, value: Any, last_id: PydanticObjectId) -> str:
+    """Encode the sort value and the `_id` of the last document of a page sorted on `field`."""
+    return base64.urlsafe_b64encode(bson.encode({"f": field, "v": value, "i": last_id})).decode("ascii").rstrip("=")
+
+
+def decode_sort_cursor(cursor: str, field: str) -> Tuple[Any, PydanticObjectId]:
+    """Decode a cursor created by `encode_sort_cursor` for the same sort field. Raises ValueError if the cursor is
+    malformed, or was created for another sort order."""
+    try:
+        document = bson.decode(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if document["f"] != field:
+            raise ValueError("The cursor was created for another sort order.")
+        return document["v"], PydanticObjectId(document["i"])
+    except (binascii.Error, InvalidBSON, InvalidId, KeyError, TypeError) as e:
+        raise ValueError("Invalid cursor.") from e
+
+
+def sort_spec(field: str = "_id", descending: bool = False) -> List[Tuple[str, int]]:
+    """The sort of a keyset scan on `field`. Ties are broken by `_id`, so that the order is total."""
+    direction = -1 if descending else 1
+    return [("_id", direction)] if field == "_id" else [(field, direction), ("_id", direction)]
+
+
+def keyset_filter(after: Optional[PydanticObjectId], descending: bool = False, field: str = "_id",
+                  value: Any = None) -> dict:
+    """Build the range filter that resumes a scan sorted by `sort_spec(field, descending)` right after the given
+    document. Missing values sort before every other value, and `$gt`/`$lt` never match them, so they get their own
+    branches."""
+    if after is None:
+        return {}
+    operator = "$lt" if descending else "$gt"
+    if field == "_id":
+        return {"_id": {operator: after}}
+    if value is None:
+        if descending:
+            return {field: None, "_id": {operator: after}}
+        return {"$or": [{field: {"$ne": None}}, {field: None, "_id": {operator: after}}]}
+    branches = [{field: {operator: value}}, {field: value, "_id": {operator: after}}]
+    if descending:
+        branches.append({field: None})
+    return {"$or": branches}
+
+
+def combine_filters(*queries: dict) -> dict:
+    """AND the non-empty filters together."""
+    queries = [query for query in queries if query]
+    if len(queries) <= 1:
+        return queries[0] if queries else {}
+    return {"$and": queries}
+
+
+async def iter_batches(cursor, batch_size: int = STREAM_BATCH_SIZE) -> AsyncIterator[List[dict]]:
+    """Read a Motor cursor and group its documents in lists of at most `batch_size` items, so that
+    callers never hold more than one batch in memory."""
+    batch = []
+    async for document in cursor:
+        batch.append(document)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,150 @@
+import asyncio
+import cProfile
+import hmac
+import io
+import os
+import pstats
+import random
+import secrets
+import time
+from typing import Optional, Tuple
+
+PROFILE_HEADER = b"x-profile"
+INLINE_HEADER = b"x-profile-inline"
+# The number of functions in the text report of a cProfile profile.
+PSTATS_LINES = 60
+PROFILE_SUFFIXES = (".speedscope.json", ".pstats")
+
+
+class RequestProfile:
+    """The profile of one request. pyinstrument, when it is installed, samples the call stack and attributes the time
+    a coroutine spends awaiting, for example a Motor query, to the line that awaits. It is rendered for speedscope.
+    Otherwise the deterministic cProfile is used, which only sees the time spent running Python code, and is saved
+    as pstats."""
+
+    def __init__(self):
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            self._profiler, self._cprofile = None, cProfile.Profile()
+        else:
+            self._profiler, self._cprofile = Profiler(interval=0.0005, async_mode="enabled"), None
+
+    def start(self):
+        if self._profiler is not None:
+            self._profiler.start()
+        else:
+            self._cprofile.enable()
+
+    def stop(self):
+        if self._profiler is not None:
+            self._profiler.stop()
+        else:
+            self._cprofile.disable()
+
+    @property
+    def profiler(self) -> str:
+        """The name of the profiler, returned in the `X-Profiler` header."""
+        return "pyinstrument" if self._profiler is not None else "cprofile"
+
+    @property
+    def suffix(self) -> str:
+        return ".speedscope.json" if self._profiler is not None else ".pstats"
+
+    def save(self, path: str):
+        if self._profiler is not None:
+            from pyinstrument.renderers import SpeedscopeRenderer
+            with open(path, "w") as file:
+                file.write(self._profiler.output(SpeedscopeRenderer()))
+        else:
+            self._cprofile.dump_stats(path)
+
+    def render(self) -> Tuple[bytes, str]:
+        """The profile to return in place of the response, with its media type."""
+        if self._profiler is not None:
+            from pyinstrument.renderers import SpeedscopeRenderer
+            return self._profiler.output(SpeedscopeRenderer()).encode(), "application/json"
+        report = io.StringIO()
+        pstats.Stats(self._cprofile, stream=report).sort_stats("cumulative").print_stats(PSTATS_LINES)
+        return report.getvalue().encode(), "text/plain; charset=utf-8"
+
+
+class ProfilingMiddleware:
+    """ASGI middleware that profiles a request when it carries the `X-Profile` header with the profiling token, or
+    for a random sample of the requests. The profile is saved in `directory`, which keeps the last `max_files`
+    profiles. The file name, and the profiler used in `X-Profiler`, are returned in the headers of the requests with
+    the token only, and with `X-Profile-Inline: 1` as well, the profile is returned instead of the response.
+
+    Only one request is profiled at a time, the others are served as usual. The profile covers everything the
+    event loop runs meanwhile, including the other requests. The middleware is only added when profiling is
+    configured, so it costs nothing otherwise."""
+
+    def __init__(self, app, token: Optional[str] = None, sample_rate: float = 0, directory: str = "profiles",
+                 max_files: int = 100):
+        self.app = app
+        self.token = token.encode() if token else None
+        self.sample_rate = sample_rate
+        self.directory = directory
+        self.max_files = max_files
+        self._busy = False
+
+    def _authorized(self, scope) -> bool:
+        if self.token is None:
+            return False
+        value = next((value for name, value in scope["headers"] if name == PROFILE_HEADER), None)
+        return value is not None and hmac.compare_digest(value, self.token)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self._busy:
+            await self.app(scope, receive, send)
+            return
+        authorized = self._authorized(scope)
+        if not authorized and not (self.sample_rate and random.random() < self.sample_rate):
+            await self.app(scope, receive, send)
+            return
+
+        inline = authorized and (INLINE_HEADER, b"1") in scope["headers"]
+        name = f"{time.strftime('%Y%m%dT%H%M%S')}-{secrets.token_hex(3)}-{scope['method']}" \
+               f"{scope['path'][:100].replace('/', '_')}"
+        profile = RequestProfile()
+        file_name = name + profile.suffix
+        buffered = []
+
+        async def send_wrapper(message):
+            if inline:
+                buffered.append(message)
+                return
+            if message["type"] == "http.response.start" and authorized:
+                message["headers"] = [*message.get("headers", []), (b"x-profile-file", file_name.encode()),
+                                      (b"x-profiler", profile.profiler.encode())]
+            await send(message)
+
+        self._busy = True
+        profile.start()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            profile.stop()
+            self._busy = False
+
+        await asyncio.to_thread(self._save, profile, file_name)
+        if inline:
+            body, media_type = await asyncio.to_thread(profile.render)
+            await send({"type": "http.response.start", "status": 200, "headers": [
+                (b"content-type", media_type.encode()), (b"content-length", str(len(body)).encode()),
+                (b"x-profile-file", file_name.encode()), (b"x-profiler", profile.profiler.encode())]})
+            await send({"type": "http.response.body", "body": body})
+
+    def _save(self, profile: RequestProfile, file_name: str):
+        """Save the profile, and remove the oldest profiles beyond `max_files`."""
+        os.makedirs(self.directory, exist_ok=True)
+        profile.save(os.path.join(self.directory, file_name))
+        profiles = sorted((entry for entry in os.scandir(self.directory)
+                           if entry.is_file() and entry.name.endswith(PROFILE_SUFFIXES)),
+                          key=lambda entry: entry.stat().st_mtime)
+        for entry in profiles[:-self.max_files]:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                # Removed by another worker sharing the directory.
+                pass
@@ -0,0 +1,56 @@
+from functools import lru_cache
+from typing import FrozenSet, List, Optional, Type
+
+from pydantic import create_model
+
+from api.models import UserInDB
+from api.schemas import UserOut
+
+# Fields that are never returned by the read endpoints, only exported when they are requested explicitly.
+SENSITIVE_FIELDS = frozenset({"password"})
+USER_FIELDS = frozenset(field.alias for field in UserOut.__fields__.values())
+DEFAULT_FIELDS = USER_FIELDS - SENSITIVE_FIELDS
+
+
+class SensitiveFieldError(ValueError):
+    """A sensitive field was requested where it can not be returned."""
+
+
+def ordered_fields(fields: FrozenSet[str]) -> List[str]:
+    """The requested fields, in the order of `UserOut`."""
+    return [field.alias for field in UserOut.__fields__.values() if field.alias in fields]
+
+
+def parse_fields(fields: Optional[str], allow_sensitive: bool = False) -> FrozenSet[str]:
+    """Parse the comma separated `fields=` parameter. The `_id` is always returned. Raises ValueError for unknown
+    fields, and SensitiveFieldError for the sensitive ones unless `allow_sensitive` is set."""
+    if not fields:
+        return DEFAULT_FIELDS
+    requested = frozenset(field.strip() for field in fields.split(",") if field.strip()) | {"_id"}
+    unknown = requested - USER_FIELDS
+    if unknown:
+        raise ValueError(f"Unknown field(s): {', '.join(sorted(unknown))}.")
+    sensitive = requested & SENSITIVE_FIELDS
+    if sensitive and not allow_sensitive:
+        raise SensitiveFieldError(f"The field(s) {', '.join(sorted(sensitive))} can not be requested here.")
+    return requested
+
+
+@lru_cache(maxsize=256)
+def projection_model(fields: FrozenSet[str]) -> Type[UserOut]:
+    """Generate a `UserOut` model whose Beanie projection only reads `fields` from MongoDB."""
+    settings = type("Settings", (), {"projection": {field: 1 for field in sorted(fields)}})
+    model = create_model(f"UserOut_{'_'.join(sorted(fields))}", __base__=UserOut)
+    model.Settings = settings
+    return model
+
+
+def project_user_dict(user: UserInDB, fields: FrozenSet[str]) -> dict:
+    """Keep only `fields` of a user that is already in memory, keyed like the documents in MongoDB."""
+    include = {name for name, field in UserInDB.__fields__.items() if field.alias in fields}
+    return user.dict(by_alias=True, include=include)
+
+
+def project_user(user: UserInDB, fields: FrozenSet[str]) -> UserOut:
+    """Build the response of a user that is already in memory, keeping only `fields`."""
+    return projection_model(fields).parse_obj(project_user_dict(user, fields))
@@ -1,7 +1,9 @@
 from enum import Enum
-from pydantic import BaseModel, Field, EmailStr, constr
-from typing import Optional, Annotated
-from datetime import date
+from beanie import PydanticObjectId
+from bson import ObjectId
+from pydantic import BaseModel, Field, EmailStr, conlist, constr
+from typing import List, Optional, Annotated
+from datetime import date, datetime
 
 
 class Role(str, Enum):
@@ -9,12 +11,58 @@ class Role(str, Enum):
     user = "user"
 
 
+class JobStatus(str, Enum):
+    pending = "pending"
+    running = "running"
+    completed = "completed"
+    failed = "failed"
+
+
+class BulkItemStatus(str, Enum):
+    created = "created"
+    invalid = "invalid"
+    conflict = "conflict"
+    error = "error"
+
+
 class Gender(str, Enum):
     male = "male"
     female = "female"
     other = "other"
 
 
+class ExportFormat(str, Enum):
+    ndjson = "ndjson"
+    csv = "csv"
+
+
+# The formats of the list and batch responses, by media type, negotiated with the `Accept` header.
+class ResponseFormat(str, Enum):
+    json = "application/json"
+    ndjson = "application/x-ndjson"
+    msgpack = "application/msgpack"
+    bson = "application/bson"
+    columnar = "application/vnd.fastcrudapi.columnar+json"
+
+
+# The sort orders of the users list. A leading `-` sorts in descending order; ties are broken by `_id`.
+class UserSort(str, Enum):
+    id = "_id"
+    id_desc = "-_id"
+    last_name = "last_name"
+    last_name_desc = "-last_name"
+    date_of_birth = "date_of_birth"
+    date_of_birth_desc = "-date_of_birth"
+
+    @property
+    def field(self) -> str:
+        return self.value.lstrip("-")
+
+    @property
+    def descending(self) -> bool:
+        return self.value.startswith("-")
+
+
 # Common Base Model
 class UserBase(BaseModel):
     email: Annotated[
@@ -50,6 +98,103 @@ class UserUpdate(BaseModel):
                                    example="strong_!#~password1!#~")]
 
 
-# Pydantic model for the response
-class UserOut(UserCreate):
-    pass
+# Pydantic model for the response of the read endpoints. Every field is optional, because only the fields
+# requested with `fields=` are returned.
+class UserOut(BaseModel):
+    id: Annotated[Optional[PydanticObjectId], Field(alias="_id", description="The document ID of the user.")] = None
+    email: Annotated[Optional[str], Field(example="email@provider.com", description="The email of the user.")]
+    first_name: Annotated[Optional[str], Field(example="Daniel")]
+    last_name: Annotated[Optional[str], Field(example="Dimitriou")]
+    role: Annotated[Optional[Role], Field(description="The role of the user(can be either admin or user).",
+                                          example="user")]
+    gender: Annotated[Optional[Gender], Field(description="The users gender", example="male")]
+    date_of_birth: Annotated[Optional[date], Field(description="The date of birth of the user.", example="1997-11-19")]
+    password: Annotated[Optional[str], Field(description="The password of the user. Only exported when requested.")]
+
+    class Config:
+        allow_population_by_field_name = True
+        json_encoders = {ObjectId: str}
+
+
+# Pydantic model for the /populate summary
+class PopulateSummary(BaseModel):
+    inserted: Annotated[int, Field(description="The number of users that were created.", example=10000)]
+    duplicates: Annotated[int, Field(description="The number of generated users skipped because of a duplicate email.",
+                                     example=3)]
+    elapsed_seconds: Annotated[float, Field(description="The time it took to populate the database.", example=1.52)]
+    docs_per_second: Annotated[float, Field(description="The insert throughput.", example=6578.9)]
+    error: Annotated[Optional[str], Field(description="Why the populate stopped before creating every user.")] = None
+
+
+# Pydantic model for the progress of a background delete
+class DeleteJob(BaseModel):
+    id: Annotated[str, Field(description="The ID of the job.")]
+    status: Annotated[JobStatus, Field(description="The state of the job.")] = JobStatus.pending
+    total: Annotated[int, Field(description="The number of users that matched the filter when the job started.")] = 0
+    deleted: Annotated[int, Field(description="The number of users deleted so far.")] = 0
+    error: Annotated[Optional[str], Field(description="The reason the job failed.")] = None
+    created_at: datetime
+    finished_at: Optional[datetime] = None
+
+
+# Pydantic models for the result of a bulk create
+class BulkItemResult(BaseModel):
+    index: Annotated[int, Field(description="The position of the item in the request.")]
+    status: Annotated[BulkItemStatus, Field(description="Whether the user was created, or why it was not.")]
+    id: Annotated[Optional[PydanticObjectId], Field(description="The document ID of the created user.")] = None
+    errors: Annotated[Optional[List[str]], Field(description="The validation errors or the conflict.")] = None
+
+    class Config:
+        json_encoders = {ObjectId: str}
+
+
+class BulkCreateResult(BaseModel):
+    created: Annotated[int, Field(description="The number of users that were created.")]
+    failed: Annotated[int, Field(description="The number of items that were rejected.")]
+    results: List[BulkItemResult]
+
+    class Config:
+        json_encoders = {ObjectId: str}
+
+
+# Pydantic models for the progress of an import
+class ImportRejectedRow(BaseModel):
+    line: Annotated[int, Field(description="The line of the file where the row starts.")]
+    errors: Annotated[List[str], Field(description="The validation errors or the conflict.")]
+
+
+class ImportProgress(BaseModel):
+    processed: Annotated[int, Field(description="The number of rows read so far.", example=10000)]
+    inserted: Annotated[int, Field(description="The number of users that were created.", example=9998)]
+    rejected: Annotated[int, Field(description="The number of rows that were rejected.", example=2)]
+    elapsed_seconds: Annotated[float, Field(description="The time spent importing so far.", example=1.52)]
+    docs_per_second: Annotated[float, Field(description="The insert throughput.", example=6578.9)]
+    rejected_rows: Annotated[List[ImportRejectedRow], Field(
+        description="The rejected rows, at most 1000. When the progress is streamed, only the rows of the last "
+                    "chunk.")] = []
+    error: Annotated[Optional[str], Field(description="Why the import stopped before the end of the file.")] = None
+
+
+class UserCount(BaseModel):
+    count: Annotated[int, Field(description="The number of users that match the filters.")]
+    estimated: Annotated[bool, Field(description="Whether the count was read from the collection metadata, which "
+                                                 "is only done when no filter is given.")]
+
+
+MAX_LOOKUP_KEYS = 1000
+
+
+# Pydantic models for the batch lookup of users
+class UserLookup(BaseModel):
+    ids: Annotated[conlist(PydanticObjectId, max_items=MAX_LOOKUP_KEYS), Field(
+        description="The document IDs of the users to fetch.")] = []
+    emails: Annotated[conlist(str, max_items=MAX_LOOKUP_KEYS), Field(
+        description="The emails of the users to fetch.")] = []
+
+
+class UserLookupResult(BaseModel):
+    users: Annotated[List[UserOut], Field(description="The users that were found, in the order they were requested.")]
+    not_found: Annotated[List[str], Field(description="The requested IDs and emails that match no user.")]
+
+    class Config:
+        json_encoders = {ObjectId: str}
@@ -0,0 +1,66 @@
+import asyncio
+import re
+from typing import FrozenSet, List
+
+from pymongo import UpdateOne
+
+from api.models import UserInDB, normalize, search_keys
+from api.projection import projection_model
+
+# The number of users read from the index for every search, before they are ranked.
+SEARCH_CANDIDATES = 100
+MAX_SEARCH_RESULTS = 50
+BACKFILL_BATCH_SIZE = 1000
+
+
+def _rank(document: dict, query: str) -> tuple:
+    keys = document.get("search_keys") or []
+    matches = [(key != query, len(key), position) for position, key in enumerate(keys) if key.startswith(query)]
+    return min(matches) if matches else (True, float("inf"), len(keys))
+
+
+async def search_users(q: str, limit: int, fields: FrozenSet[str]) -> List[dict]:
+    """Find the users whose name or email starts with `q`, ignoring case and accents. The candidates are read with an
+    anchored regex on the `search_keys` index, and ranked: exact matches first, then the shortest matching names."""
+    query = normalize(q)
+    if not query:
+        return []
+    projection = dict(projection_model(fields).Settings.projection)
+    projection["search_keys"] = 1
+    candidates = await UserInDB.get_motor_collection().find(
+        {"search_keys": {"$regex": f"^{re.escape(query)}"}}, projection=projection, limit=SEARCH_CANDIDATES
+    ).to_list(None)
+    candidates.sort(key=lambda document: _rank(document, query))
+    for document in candidates:
+        del document["search_keys"]
+    return candidates[:limit]
+
+
+async def backfill_search_keys(batch_size: int = BACKFILL_BATCH_SIZE) -> int:
+    """Set the `search_keys` of the users created before they existed. Returns the number of users updated."""
+    collection = UserInDB.get_motor_collection()
+    cursor = collection.find({"search_keys": {"$exists": False}},
+                             projection={"first_name": 1, "last_name": 1, "email": 1}, batch_size=batch_size)
+    updated = 0
+    operations = []
+    async for document in cursor:
+        keys = search_keys(document["first_name"], document["last_name"], document["email"])
+        operations.append(UpdateOne({"_id": document["_id"]}, {"$set": {"search_keys": keys}}))
+        if len(operations) >= batch_size:
+            updated += (await collection.bulk_write(operations, ordered=False)).modified_count
+            operations = []
+    if operations:
+        updated += (await collection.bulk_write(operations, ordered=False)).modified_count
+    return updated
+
+
+async def main():
+    from api.database import init_db
+
+    await init_db()
+    print(f"{await backfill_search_keys()} users updated")
+
+
+if __name__ == "__main__":
+    """Launched with `python -m api.search` at root level, once, to index the users created before the search"""
+    asyncio.run(main())
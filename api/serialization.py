@@ -0,0 +1,149 @@
+import importlib.util
+from datetime import date
+from functools import lru_cache
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+import bson
+import orjson
+from bson import ObjectId
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+from api.projection import ordered_fields
+from api.schemas import ResponseFormat
+
+# Read the documents as the raw bytes sent by MongoDB, a field is only decoded when it is accessed.
+RAW_BSON_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+# The media types of the `Accept` header that are answered with each format, besides their own.
+MEDIA_TYPE_ALIASES = {"application/x-msgpack": ResponseFormat.msgpack, "application/*": ResponseFormat.json,
+                      "*/*": ResponseFormat.json}
+
+
+def orjson_default(obj: Any) -> Any:
+    """Encode the BSON types orjson does not know. Dates, datetimes and enums are handled natively by orjson."""
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def dumps(content: Any) -> bytes:
+    return orjson.dumps(content, default=orjson_default)
+
+
+def dumps_ndjson(documents: Iterable[Any]) -> bytes:
+    return b"".join(orjson.dumps(document, default=orjson_default, option=orjson.OPT_APPEND_NEWLINE)
+                    for document in documents)
+
+
+def msgpack_default(obj: Any) -> Any:
+    """Encode the types msgpack does not know as they are in the JSON responses: the ObjectIds and the dates as
+    strings."""
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, date):
+        return obj.isoformat()
+    raise TypeError(f"Type is not MessagePack serializable: {type(obj).__name__}")
+
+
+def dumps_msgpack(content: Any) -> bytes:
+    # Imported here, msgpack is optional, see `msgpack_available`.
+    import msgpack
+
+    return msgpack.packb(content, default=msgpack_default)
+
+
+@lru_cache
+def msgpack_available() -> bool:
+    return importlib.util.find_spec("msgpack") is not None
+
+
+def columns(documents: List[Any], fields: FrozenSet[str]) -> Dict[str, list]:
+    """Turn documents into one array per field, in the order of `UserOut`. A missing field is a `null`."""
+    return {field: [document.get(field) for document in documents] for field in ordered_fields(fields)}
+
+
+def parse_accept(header: Optional[str]) -> List[Tuple[str, float]]:
+    """The values of an `Accept` or `Accept-Encoding` header, lower case, with their quality."""
+    values = []
+    for item in (header or "").split(","):
+        value, *parameters = [part.strip() for part in item.split(";")]
+        quality = 1.0
+        for parameter in parameters:
+            name, _, number = parameter.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(number)
+                except ValueError:
+                    quality = 0
+        if value:
+            values.append((value.lower(), quality))
+    return values
+
+
+def negotiate(accept: Optional[str], offered: Tuple[ResponseFormat, ...] = tuple(ResponseFormat)) -> ResponseFormat:
+    """The format of a response: the offered media type of the `Accept` header with the highest quality, or the
+    first one listed on a tie. JSON when there is no header, or it lists nothing else that can be produced."""
+    candidates = []
+    for position, (media_type, quality) in enumerate(parse_accept(accept)):
+        response_format = MEDIA_TYPE_ALIASES.get(media_type) or next(
+            (response_format for response_format in ResponseFormat if response_format.value == media_type), None)
+        if response_format not in offered or quality <= 0 or \
+                (response_format == ResponseFormat.msgpack and not msgpack_available()):
+            continue
+        candidates.append((-quality, position, response_format))
+    return min(candidates)[2] if candidates else ResponseFormat.json
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON response rendered with orjson, straight from the BSON decoded documents. It skips the validation of
+    the `response_model`, so it must only be given data that was read from the database."""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+class MsgpackResponse(Response):
+    """MessagePack response, rendered straight from the documents read from MongoDB like `FastJSONResponse`."""
+    media_type = ResponseFormat.msgpack.value
+
+    def render(self, content: Any) -> bytes:
+        return dumps_msgpack(content)
+
+
+class BSONResponse(Response):
+    """BSON response. A list of documents read with `RAW_BSON_OPTIONS` is sent as a sequence of BSON documents, like
+    the files of mongodump, with the bytes received from MongoDB; anything else is encoded as one document."""
+    media_type = ResponseFormat.bson.value
+
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, list):
+            return b"".join(document.raw for document in content)
+        return bson.encode(content)
+
+
+class ColumnarJSONResponse(FastJSONResponse):
+    media_type = ResponseFormat.columnar.value
+
+
+RESPONSE_CLASSES = {ResponseFormat.json: FastJSONResponse, ResponseFormat.msgpack: MsgpackResponse,
+                    ResponseFormat.bson: BSONResponse, ResponseFormat.columnar: ColumnarJSONResponse}
+
+
+def users_response(users: List[Any], response_format: ResponseFormat, fields: FrozenSet[str],
+                   headers: Optional[Dict[str, str]] = None, **extra: Any) -> Response:
+    """Encode the users read from MongoDB in a negotiated format, without validation. The users are the response,
+    or its `users` field when there are `extra` fields. In columnar JSON, the users are one array per field."""
+    content = columns(users, fields) if response_format == ResponseFormat.columnar else users
+    return RESPONSE_CLASSES[response_format]({"users": content, **extra} if extra else content, headers=headers)
+
+
+class UploadStreamingResponse(StreamingResponse):
+    """Streaming response of an endpoint that is still reading the request body while it responds. Starlette's
+    `StreamingResponse` waits for the client to disconnect by reading from the same channel as the body, which
+    steals its chunks. A client that disconnects while uploading is noticed by the reads of the body instead."""
+
+    async def __call__(self, scope, receive, send) -> None:
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
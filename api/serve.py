@@ -0,0 +1,95 @@
+import argparse
+import importlib.util
+import logging
+import os
+import shutil
+import tempfile
+import time
+from typing import List, Optional
+
+APP = "api.main:app"
+# Set by the serve command, so that every worker can report how long it took to be ready.
+STARTED_AT_ENV = "API_SERVE_STARTED_AT"
+
+logger = logging.getLogger("uvicorn.error")
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="serve", description="Serve the API in production.")
+    parser.add_argument("--host", default="0.0.0.0", help="The address to bind to.")
+    parser.add_argument("--port", type=int, default=8000, help="The port to bind to.")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("WEB_CONCURRENCY", 0)) or os.cpu_count(),
+                        help="The number of worker processes. Defaults to $WEB_CONCURRENCY, or the number of CPUs. "
+                             "With several workers, the user cache of every worker is only used while it follows the "
+                             "change feed, which needs a replica set.")
+    parser.add_argument("--loop", choices=["auto", "asyncio", "uvloop"], default="auto",
+                        help="The event loop. `auto` uses uvloop when it is installed.")
+    parser.add_argument("--http", choices=["auto", "h11", "httptools"], default="auto",
+                        help="The HTTP parser. `auto` uses httptools when it is installed.")
+    parser.add_argument("--timeout-keep-alive", type=int, default=5,
+                        help="Close the idle keep-alive connections after this many seconds.")
+    parser.add_argument("--backlog", type=int, default=2048,
+                        help="The number of connections waiting to be accepted before new ones are refused.")
+    parser.add_argument("--limit-concurrency", type=int, default=None,
+                        help="Respond 503 once a worker has this many connections or tasks in flight.")
+    parser.add_argument("--timeout-graceful-shutdown", type=int, default=30,
+                        help="On SIGTERM, wait this many seconds for the requests in flight before closing them.")
+    parser.add_argument("--no-access-log", dest="access_log", action="store_false",
+                        help="Do not log every request.")
+    parser.add_argument("--reload", action="store_true", help="Restart on code changes, in a single process. "
+                                                              "Only for development.")
+    args = parser.parse_args(argv)
+    for option, module in (("loop", "uvloop"), ("http", "httptools")):
+        if getattr(args, option) == module and importlib.util.find_spec(module) is None:
+            parser.error(f"--{option} {module} needs the `{module}` package, install it with `uvicorn[standard]`.")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1.")
+    return args
+
+
+def prepare_environment(workers: int) -> Optional[str]:
+    """Set the environment shared by the worker processes, before they start. The workers are spawned, and every one
+    imports the app and creates its own Motor client in the lifespan, so no connection is shared between them.
+    Returns the metrics directory it created, if any."""
+    os.environ[STARTED_AT_ENV] = str(time.time())
+    if workers == 1:
+        return None
+    # Every worker has its own user cache, which must learn about the writes of the others, see `UserCache.follow`.
+    os.environ["API_WORKERS"] = str(workers)
+    # Each worker has its own hashing pool, they share the CPUs instead of each starting one thread per CPU.
+    os.environ.setdefault("API_PASSWORD_HASH_WORKERS", str(max(1, (os.cpu_count() or 1) // workers)))
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        return None
+    # Every worker writes its metrics to this directory, see `api.metrics.registry`.
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="fastcrudapi-metrics-")
+    return os.environ["PROMETHEUS_MULTIPROC_DIR"]
+
+
+def report_startup(database_seconds: float):
+    """Log how long the worker took to be ready, since the serve command started when it did."""
+    started_at = os.environ.get(STARTED_AT_ENV)
+    since_start = f", {time.time() - float(started_at):.2f}s after the serve command started" if started_at else ""
+    logger.info(f"Worker {os.getpid()} ready: database initialized in {database_seconds:.2f}s{since_start}")
+
+
+def main(argv: Optional[List[str]] = None):
+    """The `serve` console script."""
+    # Imported here rather than at the top, so that the workers, which only import `report_startup`, do not load
+    # the server twice.
+    import uvicorn
+
+    args = parse_args(argv)
+    workers = 1 if args.reload else args.workers
+    metrics_dir = prepare_environment(workers)
+    try:
+        uvicorn.run(APP, host=args.host, port=args.port, workers=None if args.reload else workers, loop=args.loop,
+                    http=args.http, timeout_keep_alive=args.timeout_keep_alive, backlog=args.backlog,
+                    limit_concurrency=args.limit_concurrency, timeout_graceful_shutdown=args.timeout_graceful_shutdown,
+                    access_log=args.access_log, reload=args.reload)
+    finally:
+        if metrics_dir is not None:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from typing import Dict, List, NamedTuple
+
+APP_MODULE = "api.main"
+# Modules that the API only needs for some requests, and must not load at startup. zstandard is not one of them:
+# pymongo imports it, when it is installed, to offer the zstd wire compression.
+LAZY_MODULES = ("faker", "uvicorn", "pyinstrument", "msgpack")
+
+
+def _run(command: List[str]) -> subprocess.CompletedProcess:
+    """Run a fresh interpreter that can import the same modules as this one."""
+    result = subprocess.run(command, capture_output=True, text=True,
+                            env={**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)})
+    if result.returncode:
+        raise RuntimeError(f"{' '.join(command)} failed:\n{result.stderr[-2000:]}")
+    return result
+
+
+class ImportTime(NamedTuple):
+    module: str
+    self_us: int
+    cumulative_us: int
+
+
+def import_times(module: str = APP_MODULE) -> List[ImportTime]:
+    """Import `module` in a fresh interpreter with `-X importtime`, and return the time spent importing every module,
+    in microseconds, in the order they finished importing."""
+    result = _run([sys.executable, "-X", "importtime", "-c", f"import {module}"])
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        times.append(ImportTime(name.strip(), int(self_us), int(cumulative_us)))
+    return times
+
+
+def package_times(times: List[ImportTime]) -> Dict[str, int]:
+    """The time spent importing every top-level package, the sum of the self times of its modules."""
+    packages = defaultdict(int)
+    for time_ in times:
+        packages[time_.module.split(".")[0]] += time_.self_us
+    return dict(sorted(packages.items(), key=lambda item: -item[1]))
+
+
+async def _first_request(in_memory: bool = False) -> Dict[str, float]:
+    from httpx import AsyncClient
+
+    started = time.perf_counter()
+    from api.main import app
+    imported = time.perf_counter()
+    if in_memory:
+        # After the import of the app, which is measured as it is in production.
+        import motor.motor_asyncio
+        import mongomock_motor
+        motor.motor_asyncio.AsyncIOMotorClient = mongomock_motor.AsyncMongoMockClient
+    async with app.router.lifespan_context(app):
+        ready = time.perf_counter()
+        async with AsyncClient(app=app, base_url="http://startup") as client:
+            response = await client.get("/healthz")
+        response.raise_for_status()
+        answered = time.perf_counter()
+    return {"import_seconds": imported - started, "lifespan_seconds": ready - imported,
+            "first_request_seconds": answered - ready, "total_seconds": answered - started,
+            "lazy_modules_loaded": [module for module in LAZY_MODULES if module in sys.modules]}
+
+
+def measure_startup(in_memory: bool = False) -> Dict[str, float]:
+    """Time the import of the app, its lifespan startup and its first request, in a fresh interpreter, with the
+    database of the settings, or with mongomock-motor, an in-memory stand-in, when `in_memory` is set."""
+    result = _run([sys.executable, "-m", "api.startup", "--measure", *(["--in-memory"] if in_memory else [])])
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Report the import time and the time to first request of the API.")
+    parser.add_argument("--top", type=int, default=20, help="The number of modules and packages to list.")
+    parser.add_argument("--in-memory", action="store_true",
+                        help="Start the app with mongomock-motor instead of the database of the settings.")
+    parser.add_argument("--measure", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.measure:
+        # Run by `measure_startup` in a fresh interpreter, prints the timings as JSON.
+        print(json.dumps(asyncio.run(_first_request(args.in_memory))))
+        return
+
+    times = import_times()
+    print(f"Slowest imports of {APP_MODULE} (cumulative):")
+    for time_ in sorted(times, key=lambda time_: -time_.cumulative_us)[:args.top]:
+        print(f"{time_.cumulative_us / 1000:>10.1f} ms  {time_.module}")
+    print("\nImport time per package (self):")
+    for package, self_us in list(package_times(times).items())[:args.top]:
+        print(f"{self_us / 1000:>10.1f} ms  {package}")
+
+    timings = measure_startup(args.in_memory)
+    print("\nTime to first request:")
+    for name in ("import_seconds", "lifespan_seconds", "first_request_seconds", "total_seconds"):
+        print(f"{timings[name] * 1000:>10.1f} ms  {name.replace('_seconds', '').replace('_', ' ')}")
+    if timings["lazy_modules_loaded"]:
+        print(f"\nLoaded at startup, but should not be: {', '.join(timings['lazy_modules_loaded'])}")
+
+
+if __name__ == "__main__":
+    """Launched with `python -m api.startup` at root level"""
+    main()
@@ -0,0 +1,214 @@
+import asyncio
+import csv
+import io
+import time
+import zlib
+from typing import AsyncIterator, FrozenSet, List, Optional, Tuple
+
+import orjson
+from beanie import PydanticObjectId
+from bson import ObjectId
+from pydantic import ValidationError
+
+from api.bulk import insert_users
+from api.hashing import is_password_hash, password_hasher
+from api.models import UserInDB, search_keys
+from api.pagination import STREAM_BATCH_SIZE, iter_batches
+from api.projection import ordered_fields
+from api.schemas import ExportFormat, ImportProgress, ImportRejectedRow, UserBase, UserCreate
+from api.serialization import dumps_ndjson
+
+IMPORT_CHUNK_SIZE = 1000
+MAX_IMPORT_CHUNK_SIZE = 10000
+# The rejected rows returned at the end of an import that is not streamed.
+MAX_REPORTED_REJECTED_ROWS = 1000
+# A line longer than this is not a user, the import stops instead of buffering it.
+MAX_LINE_BYTES = 64 * 1024
+# The most data a gzip chunk of the request is decompressed to at once, so that a small body that inflates to
+# gigabytes is read like any other.
+MAX_INFLATED_BYTES = 1024 * 1024
+GZIP_LEVEL = 6
+
+
+async def export_users(query: dict, fields: FrozenSet[str], export_format: ExportFormat) -> AsyncIterator[bytes]:
+    """Yield the users matching `query` as NDJSON or CSV, one chunk per batch read from the Motor cursor. The
+    documents are written as they are stored, without validation, in the order of their `_id`."""
+    columns = ordered_fields(fields)
+    cursor = UserInDB.get_motor_collection().find(query, projection={column: 1 for column in columns},
+                                                  sort=[("_id", 1)], batch_size=STREAM_BATCH_SIZE)
+    if export_format == ExportFormat.csv:
+        yield _csv_rows([columns])
+    async for batch in iter_batches(cursor):
+        if export_format == ExportFormat.csv:
+            yield _csv_rows([["" if document.get(column) is None else str(document[column]) for column in columns]
+                             for document in batch])
+        else:
+            yield dumps_ndjson(batch)
+
+
+def _csv_rows(rows: List[List[str]]) -> bytes:
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator="\n").writerows(rows)
+    return buffer.getvalue().encode()
+
+
+async def gzip_chunks(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """Compress a stream of chunks into a single gzip member, without holding more than one chunk in memory."""
+    compressor = zlib.compressobj(GZIP_LEVEL, wbits=31)
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+async def read_records(chunks: AsyncIterator[bytes], gzipped: bool, quoted: bool,
+                       chunk_size: int) -> AsyncIterator[List[Tuple[int, bytes]]]:
+    """Split a request body into records, and yield them in lists of at most `chunk_size`, with the line where every
+    record starts. Blank lines are skipped. With `quoted`, a record continues on the next line while it has an odd
+    number of `"`, which is how a CSV field with a line break is written. Raises ValueError when the body is not
+    valid gzip data or a line is too long."""
+    decompressor = zlib.decompressobj(wbits=47) if gzipped else None
+    pending = b""
+    line_number = 0
+    records = []
+    record, record_line = b"", 0
+
+    async def inflate() -> AsyncIterator[bytes]:
+        async for data in chunks:
+            if decompressor is None:
+                yield data
+                continue
+            try:
+                while data:
+                    yield decompressor.decompress(data, MAX_INFLATED_BYTES)
+                    data = decompressor.unconsumed_tail
+            except zlib.error:
+                raise ValueError("The request body is not valid gzip data.")
+        if decompressor is not None and not decompressor.eof:
+            raise ValueError("The request body is not valid gzip data.")
+
+    async for data in inflate():
+        *lines, pending = (pending + data).split(b"\n")
+        if len(pending) > MAX_LINE_BYTES:
+            raise ValueError(f"Line {line_number + len(lines) + 1} is longer than {MAX_LINE_BYTES} bytes.")
+        for line in lines:
+            line_number += 1
+            if not record:
+                if not line.strip():
+                    continue
+                record_line = line_number
+            record += line if not record else b"\n" + line
+            if quoted and record.count(b'"') % 2:
+                if len(record) > MAX_LINE_BYTES:
+                    raise ValueError(f"The record of line {record_line} is longer than {MAX_LINE_BYTES} bytes.")
+                continue
+            records.append((record_line, record.rstrip(b"\r")))
+            record = b""
+            if len(records) >= chunk_size:
+                yield records
+                records = []
+
+    if pending.strip() or record:
+        records.append((record_line if record else line_number + 1,
+                        b"\n".join(part for part in (record, pending) if part).rstrip(b"\r")))
+    if records:
+        yield records
+
+
+def parse_rows(records: List[Tuple[int, bytes]], header: Optional[List[str]]
+               ) -> Tuple[List[Tuple[int, UserInDB, bool]], List[ImportRejectedRow]]:
+    """Decode and validate a chunk of records, NDJSON when there is no `header`, CSV otherwise. Returns the valid
+    users with their line and whether their password still has to be hashed, and the rejected rows. An empty CSV
+    value is a missing field."""
+    users, rejected = [], []
+    for line, record in records:
+        try:
+            if header is None:
+                item = orjson.loads(record)
+            else:
+                values = next(csv.reader([record.decode()]))
+                item = {column: value for column, value in zip(header, values) if value != ""}
+            users.append((line, *parse_user(item)))
+        except ValidationError as e:
+            rejected.append(ImportRejectedRow(
+                line=line, errors=[f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors()]))
+        except (ValueError, csv.Error) as e:
+            # orjson.JSONDecodeError and UnicodeDecodeError are ValueErrors as well
+            rejected.append(ImportRejectedRow(line=line, errors=[str(e)]))
+    return users, rejected
+
+
+def parse_user(item) -> Tuple[UserInDB, bool]:
+    """Validate an imported row against `UserCreate`. A row exported with its password keeps the hash, only the
+    other fields are validated, if the hash costs at least as much as the ones this server makes; any other
+    password is hashed. The `_id` is kept when there is one."""
+    if not isinstance(item, dict):
+        raise ValueError("The row must be a JSON object.")
+    password = item.get("password")
+    hashed = isinstance(password, str) and is_password_hash(password, password_hasher.n, password_hasher.r,
+                                                             password_hasher.p)
+    user = (UserBase if hashed else UserCreate).parse_obj(item)
+    doc_id = item.get("_id")
+    if doc_id is not None and not (isinstance(doc_id, str) and ObjectId.is_valid(doc_id)):
+        raise ValueError("_id: invalid ObjectId")
+    # Already validated, it is not validated again.
+    return UserInDB.construct(**user.dict(), **({"password": password} if hashed else {}),
+                              id=PydanticObjectId(doc_id) if doc_id else None,
+                              search_keys=search_keys(user.first_name, user.last_name, user.email)), not hashed
+
+
+async def _write_chunk(users: List[Tuple[int, UserInDB, bool]]) -> Tuple[int, List[ImportRejectedRow]]:
+    plain = [user for _, user, needs_hash in users if needs_hash]
+    for user, hashed in zip(plain, await password_hasher.hash_many([user.password for user in plain])):
+        user.password = hashed
+    outcome = await insert_users([user for _, user, _ in users])
+    rejected = [ImportRejectedRow(line=users[position][0], errors=["There is already a user with this email or ID."])
+                for position in outcome.duplicates]
+    rejected += [ImportRejectedRow(line=users[position][0], errors=["The user could not be written to the database."])
+                 for position in outcome.errors]
+    return outcome.inserted, rejected
+
+
+async def _written(progress: ImportProgress, write: asyncio.Task, processed: int, rejected: List[ImportRejectedRow],
+                   started: float) -> ImportProgress:
+    """Wait for the write of a chunk and add it to the running totals."""
+    inserted, conflicts = await write
+    progress.processed += processed
+    progress.inserted += inserted
+    progress.rejected_rows = sorted(rejected + conflicts, key=lambda row: row.line)
+    progress.rejected += len(progress.rejected_rows)
+    progress.elapsed_seconds = round(time.perf_counter() - started, 3)
+    progress.docs_per_second = round(progress.inserted / progress.elapsed_seconds, 1) if progress.elapsed_seconds else 0
+    return progress.copy()
+
+
+async def import_users(chunks: AsyncIterator[bytes], import_format: ExportFormat, gzipped: bool = False,
+                       chunk_size: int = IMPORT_CHUNK_SIZE) -> AsyncIterator[ImportProgress]:
+    """Import the users of an NDJSON or CSV body, yielding the running totals after every chunk. The body is read
+    incrementally, and the next chunk is read and validated while the current one is written with an unordered
+    `insert_many`. When the body cannot be read any further, the last progress has an `error`."""
+    started = time.perf_counter()
+    progress = ImportProgress(processed=0, inserted=0, rejected=0, elapsed_seconds=0, docs_per_second=0)
+    header = None
+    # The chunk being written: the task, the number of rows and the rows rejected by the validation.
+    write: Optional[Tuple[asyncio.Task, int, List[ImportRejectedRow]]] = None
+    try:
+        async for records in read_records(chunks, gzipped, import_format == ExportFormat.csv, chunk_size):
+            if import_format == ExportFormat.csv and header is None:
+                header = [column.strip() for column in next(csv.reader([records[0][1].decode("utf-8-sig")]))]
+                records = records[1:]
+            users, rejected = await asyncio.to_thread(parse_rows, records, header)
+            if write is not None:
+                yield await _written(progress, *write, started)
+            write = (asyncio.create_task(_write_chunk(users)), len(records), rejected)
+        if write is not None:
+            progress, write = await _written(progress, *write, started), None
+        yield progress
+    except (ValueError, csv.Error) as e:
+        if write is not None:
+            progress, write = await _written(progress, *write, started), None
+        yield progress.copy(update={"error": str(e), "elapsed_seconds": round(time.perf_counter() - started, 3)})
+    finally:
+        if write is not None:
+            write[0].cancel()
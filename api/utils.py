@@ -1,27 +1,145 @@
-from typing import List
-from faker import Faker
-from api.schemas import UserCreate, Role
-
-
-def generate_users(count: int) -> List[UserCreate]:
-    faker = Faker()
-    users_create = []
-    for _ in range(count):
-        email = faker.email()
-        first_name = faker.first_name()
-        last_name = faker.last_name()
-        password = faker.password(length=12, special_chars=True, digits=True, upper_case=True, lower_case=True)
-        role = faker.random_element(elements=(Role.user, Role.admin))
-        gender = faker.random_element(elements=("male", "female"))
-        date_of_birth = faker.date_of_birth(minimum_age=18, maximum_age=70)
-        user = UserCreate(
-            email=email,
-            first_name=first_name,
-            last_name=last_name,
-            password=password,
-            role=role,
-            gender=gender,
-            date_of_birth=date_of_birth,
-        )
-        users_create.append(user)
-    return users_create
+import argparse
+import concurrent.futures
+import functools
+import random
+import re
+import secrets
+import string
+import sys
+from datetime import date
+from typing import Iterator, List, Optional
+
+import bson
+import orjson
+from api.schemas import Gender, Role, UserCreate
+
+POOL_SIZE = 2000
+DEFAULT_BATCH_SIZE = 10000
+ROLES = (Role.user.value, Role.admin.value)
+GENDERS = (Gender.male.value, Gender.female.value)
+PASSWORD_LENGTH = 12
+PASSWORD_ALPHABET = string.ascii_letters + string.digits + "!#$%&*+-=?@^_~"
+MIN_AGE, MAX_AGE = 18, 70
+
+
+class UserGenerator:
+    """Generate dummy users in batches, as plain dicts that are valid `UserCreate` data.
+
+    Names and email domains are drawn from pools built once per locale with Faker, and every field of a batch is
+    sampled in bulk. Emails are made unique with the position of the user in the run, so no database round trip is
+    needed to avoid duplicates. With a `seed`, the output is reproducible for a given batch size, whatever the number
+    of workers."""
+
+    def __init__(self, seed: Optional[int] = None, locale: str = "en_US"):
+        self.seed = seed
+        # Tags the emails of this run, so that two unseeded runs do not generate the same emails.
+        self.run = format(seed, "x") if seed is not None else secrets.token_hex(3)
+        self.first_names, self.last_names, self.domains = _pools(locale)
+        today = date.today()
+        self.oldest = date(today.year - MAX_AGE - 1, today.month, min(today.day, 28)).toordinal() + 1
+        self.youngest = date(today.year - MIN_AGE, today.month, min(today.day, 28)).toordinal()
+
+    def batch(self, start: int, size: int) -> List[dict]:
+        """Generate the users at positions `start` to `start + size` of the run."""
+        rng = random.Random(f"{self.seed}-{start}") if self.seed is not None else random.Random()
+        first_names = rng.choices(self.first_names, k=size)
+        last_names = rng.choices(self.last_names, k=size)
+        domains = rng.choices(self.domains, k=size)
+        roles = rng.choices(ROLES, k=size)
+        genders = rng.choices(GENDERS, k=size)
+        birthdays = rng.choices(range(self.oldest, self.youngest + 1), k=size)
+        password_chars = "".join(rng.choices(PASSWORD_ALPHABET, k=size * PASSWORD_LENGTH))
+        return [
+            {
+                "email": f"{_local_part(first_name)}.{_local_part(last_name)}.{self.run}-{position:x}@{domain}",
+                "first_name": first_name,
+                "last_name": last_name,
+                "password": password_chars[i * PASSWORD_LENGTH:(i + 1) * PASSWORD_LENGTH],
+                "role": role,
+                "gender": gender,
+                "date_of_birth": date.fromordinal(birthday).isoformat(),
+            }
+            for i, (position, first_name, last_name, domain, role, gender, birthday) in enumerate(
+                zip(range(start, start + size), first_names, last_names, domains, roles, genders, birthdays))
+        ]
+
+    def batches(self, count: int, batch_size: int = DEFAULT_BATCH_SIZE) -> Iterator[List[dict]]:
+        """Lazily yield `count` users in lists of at most `batch_size`."""
+        for start in range(0, count, batch_size):
+            yield self.batch(start, min(batch_size, count - start))
+
+    def encoded_batches(self, count: int, batch_size: int = DEFAULT_BATCH_SIZE, file_format: str = "ndjson",
+                        workers: int = 1) -> Iterator[bytes]:
+        """Lazily yield `count` users encoded as NDJSON or BSON, one chunk of bytes per batch. With more than one
+        worker, the batches are generated and encoded by a process pool, at most two batches per worker ahead of the
+        consumer. Only the encoded bytes travel back from the workers, which keeps the pool worth its overhead."""
+        starts = range(0, count, batch_size)
+        if workers <= 1:
+            for start in starts:
+                yield _encode_batch(self, start, min(batch_size, count - start), file_format)
+            return
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = []
+            for start in starts:
+                pending.append(executor.submit(_encode_batch, self, start, min(batch_size, count - start), file_format))
+                if len(pending) >= workers * 2:
+                    yield pending.pop(0).result()
+            for future in pending:
+                yield future.result()
+
+
+@functools.lru_cache
+def _pools(locale: str) -> tuple:
+    """Build the pools of first names, last names and email domains. They are seeded, so that the same seed always
+    draws from the same pools."""
+    # Faker and its providers take longer to import than the rest of the API, they are only loaded when users are
+    # generated for the first time.
+    from faker import Faker
+
+    faker = Faker(locale)
+    faker.seed_instance(0)
+    first_names = sorted({faker.first_name() for _ in range(POOL_SIZE)})
+    last_names = sorted({faker.last_name() for _ in range(POOL_SIZE)})
+    domains = sorted({faker.free_email_domain() for _ in range(POOL_SIZE // 10)} |
+                     {faker.domain_name() for _ in range(POOL_SIZE // 10)})
+    return first_names, last_names, domains
+
+
+def _encode_batch(generator: UserGenerator, start: int, size: int, file_format: str) -> bytes:
+    if file_format == "bson":
+        return b"".join(bson.encode(user) for user in generator.batch(start, size))
+    return b"".join(orjson.dumps(user, option=orjson.OPT_APPEND_NEWLINE) for user in generator.batch(start, size))
+
+
+def _local_part(name: str) -> str:
+    return re.sub(r"[^a-z0-9]", "", name.lower()) or "user"
+
+
+def generate_users(count: int, seed: Optional[int] = None) -> List[UserCreate]:
+    return [UserCreate(**user) for batch in UserGenerator(seed).batches(count) for user in batch]
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Write dummy users to an NDJSON or BSON file.")
+    parser.add_argument("--count", type=int, required=True, help="The number of users to generate.")
+    parser.add_argument("--output", default="-", help="The file to write, `-` for stdout.")
+    parser.add_argument("--format", choices=("ndjson", "bson"), default="ndjson",
+                        help="NDJSON, or concatenated BSON documents that mongorestore can read.")
+    parser.add_argument("--seed", type=int, help="Generate the same users on every run.")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=1, help="Generate the batches in a pool of processes.")
+    args = parser.parse_args(argv)
+
+    output = sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+    try:
+        generator = UserGenerator(args.seed)
+        for chunk in generator.encoded_batches(args.count, args.batch_size, args.format, args.workers):
+            output.write(chunk)
+    finally:
+        if output is not sys.stdout.buffer:
+            output.close()
+
+
+if __name__ == "__main__":
+    """Launched with `python -m api.utils --count 1000000 --output users.ndjson` at root level"""
+    main()
@@ -0,0 +1,90 @@
+"""Compare the size and the encode and decode time of the response formats of GET /users, for a page of 10k users.
+
+Runs offline: the users are generated, and turned into the documents that Motor returns for them. The JSON of the
+default response path, with validation, is the baseline. Every format is also compressed with gzip, and with zstd
+when `zstandard` is installed. MessagePack is skipped when `msgpack` is not installed.
+
+    python -m benchmarks.bench_formats --count 10000
+"""
+import argparse
+import json
+import time
+import zlib
+from datetime import datetime
+
+import bson
+import orjson
+from bson import ObjectId
+from bson.raw_bson import RawBSONDocument
+from fastapi.encoders import jsonable_encoder
+
+from api.compression import GZIP_LEVEL, ZSTD_LEVEL, zstd_available
+from api.projection import DEFAULT_FIELDS, projection_model
+from api.schemas import ResponseFormat
+from api.serialization import msgpack_available, users_response
+from api.utils import UserGenerator
+
+
+def documents(count: int) -> list:
+    """The users as they are read from MongoDB: with an ObjectId, and the date of birth as a datetime."""
+    users = UserGenerator(seed=0).batch(0, count)
+    return [{"_id": ObjectId(), **{field: value for field, value in user.items() if field in DEFAULT_FIELDS},
+             "date_of_birth": datetime.fromisoformat(user["date_of_birth"])} for user in users]
+
+
+def timed(function, rounds: int):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        result = function()
+    return result, (time.perf_counter() - started) / rounds
+
+
+def default_json(users: list) -> bytes:
+    """The body of the default path: validate every user, then encode with the standard library."""
+    model = projection_model(DEFAULT_FIELDS)
+    return json.dumps(jsonable_encoder([model.parse_obj(user) for user in users], by_alias=True,
+                                       exclude_unset=True), separators=(",", ":")).encode()
+
+
+def main(count: int, rounds: int):
+    users = documents(count)
+    # BSON is passed through as received from MongoDB, the documents are raw bytes already.
+    raw = [RawBSONDocument(bson.encode(user)) for user in users]
+    cases = {"json (default)": (lambda: default_json(users), json.loads),
+             "json (fast)": (lambda: users_response(users, ResponseFormat.json, DEFAULT_FIELDS).body, orjson.loads),
+             "columnar json": (lambda: users_response(users, ResponseFormat.columnar, DEFAULT_FIELDS).body,
+                               orjson.loads),
+             "bson": (lambda: users_response(raw, ResponseFormat.bson, DEFAULT_FIELDS).body, bson.decode_all)}
+    if msgpack_available():
+        import msgpack
+        cases["msgpack"] = (lambda: users_response(users, ResponseFormat.msgpack, DEFAULT_FIELDS).body,
+                            msgpack.unpackb)
+    compressors = {"gzip": lambda body: zlib.compress(body, GZIP_LEVEL, wbits=31)}
+    if zstd_available():
+        import zstandard
+        compressors["zstd"] = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress
+
+    print(f"{count} users, {rounds} rounds")
+    header = f"{'format':<16}{'KB':>9}{'vs json':>9}{'encode ms':>11}{'decode ms':>11}"
+    for name in compressors:
+        header += f"{name + ' KB':>10}{name + ' ms':>10}"
+    print(header)
+    baseline = None
+    for name, (encode, decode) in cases.items():
+        body, encode_seconds = timed(encode, rounds)
+        _, decode_seconds = timed(lambda: decode(body), rounds)
+        baseline = baseline or len(body)
+        line = f"{name:<16}{len(body) / 1024:>9.1f}{len(body) / baseline:>9.2f}{encode_seconds * 1000:>11.2f}" \
+               f"{decode_seconds * 1000:>11.2f}"
+        for compress in compressors.values():
+            compressed, compress_seconds = timed(lambda: compress(body), rounds)
+            line += f"{len(compressed) / 1024:>10.1f}{compress_seconds * 1000:>10.2f}"
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=10000, help="The number of users in the page.")
+    parser.add_argument("--rounds", type=int, default=5, help="The number of times every step is timed.")
+    args = parser.parse_args()
+    main(args.count, args.rounds)
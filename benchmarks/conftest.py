@@ -0,0 +1,123 @@
+"""Fixtures of the microbenchmark suite.
+
+The suite runs offline: Motor is replaced by mongomock-motor, an in-memory stand-in, unless `--mongodb-uri` is
+given. Its numbers are only meaningful relative to each other, and between two commits measured on the same machine.
+
+    python -m pytest benchmarks --benchmark-autosave
+    python -m pytest benchmarks --benchmark-compare --benchmark-compare-fail=median:10%
+    python -m pytest benchmarks -k search --mongodb-uri mongodb://localhost:27017 --sizes 1000000
+
+`--benchmark-autosave` saves the results as JSON under `.benchmarks/`, named after the commit, and
+`--benchmark-compare` compares a run with the last saved one.
+"""
+import asyncio
+import itertools
+import os
+
+import motor.motor_asyncio
+import pytest
+from httpx import AsyncClient
+
+# The cost of hashing would hide the cost of everything else, it is only measured by `test_get_user_while_hashing`.
+os.environ.setdefault("API_PASSWORD_HASH_N", "16")
+
+from api import database
+from api.cache import user_cache
+from api.config import Settings, get_settings
+from api.hashing import password_hasher
+from api.indexes import sync_indexes
+from api.main import app
+from api.models import UserInDB
+
+DATABASE_NAME = "benchmarks"
+# The number of users in the collection while an endpoint is measured, unless `--sizes` is given.
+SIZES = [1, 1000, 10000]
+SEED = 1
+# The email domain of the users created by the benchmarks themselves.
+BENCH_DOMAIN = "bench.com"
+
+
+def pytest_addoption(parser):
+    parser.addoption("--mongodb-uri", help="Run the benchmarks against this MongoDB server instead of in memory.")
+    parser.addoption("--sizes", type=lambda value: [int(size) for size in value.split(",")], default=SIZES,
+                     help="The numbers of users in the collection, comma separated, e.g. 1000000 against a real "
+                          "server.")
+
+
+def pytest_generate_tests(metafunc):
+    if "collection_size" in metafunc.fixturenames:
+        # Module scoped, so that pytest runs all the benchmarks of one size before populating the next one.
+        metafunc.parametrize("collection_size", metafunc.config.getoption("--sizes"), indirect=True, scope="module",
+                             ids=lambda size: f"{size}docs")
+
+
+@pytest.fixture(scope="session")
+def bench_loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture(scope="session")
+def run(bench_loop):
+    """Run a coroutine to completion, on the loop the database client was created on."""
+    return bench_loop.run_until_complete
+
+
+@pytest.fixture(scope="session")
+def client(request, run):
+    mongodb_uri = request.config.getoption("--mongodb-uri")
+    if mongodb_uri is None:
+        import mongomock_motor
+        monkeypatch = pytest.MonkeyPatch()
+        monkeypatch.setattr(motor.motor_asyncio, "AsyncIOMotorClient", mongomock_motor.AsyncMongoMockClient)
+    settings = Settings(**{**get_settings().dict(), "database_name": DATABASE_NAME,
+                           **({"mongodb_uri": mongodb_uri} if mongodb_uri else {})})
+    run(database.init_db(settings))
+    run(sync_indexes(UserInDB))
+    async_client = AsyncClient(app=app, base_url="http://bench", timeout=None)
+    yield async_client
+    run(async_client.aclose())
+    run(database.client.drop_database(DATABASE_NAME))
+    run(database.close_db())
+    password_hasher.shutdown()
+    if mongodb_uri is None:
+        monkeypatch.undo()
+
+
+async def fill(async_client: AsyncClient, size: int):
+    """Make the collection hold exactly the `size` users of the seeded run. The users created by the benchmarks
+    are removed, and the collection is only populated again when users of the run are missing."""
+    collection = UserInDB.get_motor_collection()
+    await collection.delete_many({"email": {"$regex": f"@{BENCH_DOMAIN}$"}})
+    user_cache.clear()
+    if await collection.count_documents({}) == size:
+        return
+    await collection.delete_many({})
+    response = await async_client.get("/populate", params={"count": size, "batch_size": 5000, "seed": SEED})
+    response.raise_for_status()
+
+
+@pytest.fixture(scope="module")
+def collection_size(request):
+    return request.param
+
+
+@pytest.fixture
+def size(collection_size, client, run):
+    """The number of users in the collection, restored before every benchmark."""
+    run(fill(client, collection_size))
+    return collection_size
+
+
+@pytest.fixture
+def refill(size, client, run):
+    """Restore the collection, for the benchmarks that delete it."""
+    return lambda: run(fill(client, size))
+
+
+@pytest.fixture(scope="session")
+def new_email():
+    """Return a new email for every user created by the benchmarks, which `fill` knows to remove."""
+    emails = (f"bench{i}@{BENCH_DOMAIN}" for i in itertools.count())
+    return lambda: next(emails)
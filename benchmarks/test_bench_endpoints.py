@@ -0,0 +1,216 @@
+"""Full in-process round trips through the ASGI app, for every endpoint, with 1, 1k and 10k users in the
+collection."""
+import asyncio
+import itertools
+import json
+
+import pytest
+
+from api.cache import user_cache
+from api.config import Settings, get_settings
+from api.hashing import hash_password_sync, password_hasher
+from api.models import UserInDB
+from api.pagination import MAX_PAGE_SIZE
+
+NEW_USER = {"first_name": "first", "last_name": "last", "password": "strong_password"}
+LOOKUP_KEYS = 100
+BULK_ITEMS = 100
+# The benchmarks that rewrite the whole collection are slow with 10k users in memory, mongomock checks the unique
+# index of every insert against every document.
+WRITE_ROUNDS = 3
+PROJECTIONS = {"all": "email,first_name,last_name,role,gender,date_of_birth", "default": None,
+               "names": "email,first_name,last_name", "id": "_id"}
+# The password hashes can only be exported.
+EXPORT_FIELDS = "password," + PROJECTIONS["all"]
+PREFIX_LENGTHS = [1, 2, 3, 5, 8]
+SEARCH_SAMPLE = 100
+# The users created at the same time while the lookups are measured. With the hashes on the loop, a lookup can wait
+# for the hash of every writer.
+HASHING_WRITERS = 8
+HASHING_ROUNDS = 20
+
+
+@pytest.fixture
+def user(size, run):
+    return run(UserInDB.get_motor_collection().find_one({}, sort=[("_id", -1)]))
+
+
+def request(run, client, method, url, **kwargs):
+    def send():
+        response = run(client.request(method, url, **kwargs))
+        assert response.status_code < 400, response.text
+        return response
+    return send
+
+
+@pytest.mark.parametrize("fields", PROJECTIONS.values(), ids=PROJECTIONS.keys())
+def test_get_all_users(benchmark, run, client, size, fields):
+    params = {"limit": min(size, MAX_PAGE_SIZE), **({"fields": fields} if fields else {})}
+    response = benchmark(request(run, client, "GET", "/users", params=params))
+    benchmark.extra_info["bytes"] = len(response.content)
+
+
+def test_get_all_users_fast(benchmark, run, client, size, monkeypatch):
+    monkeypatch.setattr(get_settings(), "fast_responses", True)
+    benchmark(request(run, client, "GET", "/users", params={"limit": min(size, MAX_PAGE_SIZE)}))
+
+
+def test_get_all_users_columnar(benchmark, run, client, size):
+    benchmark(request(run, client, "GET", "/users", params={"limit": min(size, MAX_PAGE_SIZE)},
+                      headers={"Accept": "application/vnd.fastcrudapi.columnar+json"}))
+
+
+@pytest.mark.parametrize("fields", PROJECTIONS.values(), ids=PROJECTIONS.keys())
+def test_stream_all_users(benchmark, run, client, size, fields):
+    response = benchmark(request(run, client, "GET", "/users", params={"fields": fields} if fields else {},
+                                 headers={"Accept": "application/x-ndjson"}))
+    benchmark.extra_info["bytes"] = len(response.content)
+
+
+@pytest.mark.parametrize("compressed", [False, True], ids=["plain", "gzip"])
+@pytest.mark.parametrize("export_format", ["ndjson", "csv"])
+def test_export_users(benchmark, run, client, size, export_format, compressed):
+    response = benchmark(request(run, client, "GET", "/users/export", params={
+        "format": export_format, "gzip": compressed, "fields": EXPORT_FIELDS}))
+    benchmark.extra_info["bytes"] = len(response.content)
+
+
+@pytest.mark.parametrize("compressed", [False, True], ids=["plain", "gzip"])
+@pytest.mark.parametrize("export_format", ["ndjson", "csv"])
+def test_import_users(benchmark, run, client, size, export_format, compressed):
+    # Exported with the password hashes, which are not computed again.
+    body = run(client.get("/users/export", params={"format": export_format, "gzip": compressed,
+                                                   "fields": EXPORT_FIELDS})).content
+    headers = {"Content-Type": "text/csv" if export_format == "csv" else "application/x-ndjson",
+               **({"Content-Encoding": "gzip"} if compressed else {})}
+
+    def setup():
+        run(UserInDB.get_motor_collection().delete_many({}))
+    # Leaves the same `size` users in the collection.
+    response = benchmark.pedantic(request(run, client, "POST", "/users/import", content=body, headers=headers),
+                                  setup=setup, rounds=WRITE_ROUNDS)
+    assert response.json()["inserted"] == size, response.text
+
+
+def test_lookup_users(benchmark, run, client, size):
+    documents = run(UserInDB.get_motor_collection().find({}, projection={"email": 1}).to_list(None))
+    body = {"ids": [str(document["_id"]) for document in documents[:LOOKUP_KEYS // 2]],
+            "emails": [document["email"] for document in documents[-LOOKUP_KEYS // 2:]]}
+    benchmark(request(run, client, "POST", "/users/lookup", content=json.dumps(body)))
+
+
+def test_get_user_by_id_cached(benchmark, run, client, user):
+    benchmark(request(run, client, "GET", f"/users/{user['_id']}"))
+
+
+def test_get_user_by_id_uncached(benchmark, run, client, user):
+    benchmark.pedantic(request(run, client, "GET", f"/users/{user['_id']}"), setup=user_cache.clear, rounds=100)
+
+
+def test_get_user_by_email(benchmark, run, client, user):
+    benchmark.pedantic(request(run, client, "GET", "/user", params={"email": user["email"]}),
+                       setup=user_cache.clear, rounds=100)
+
+
+@pytest.mark.parametrize("length", PREFIX_LENGTHS)
+def test_search_users(benchmark, run, client, size, length):
+    # The prefixes of the names and emails of some users, as they are typed.
+    documents = run(UserInDB.get_motor_collection().find({}, projection={"search_keys": 1}).to_list(SEARCH_SAMPLE))
+    prefixes = itertools.cycle(sorted({key[:length] for document in documents for key in document["search_keys"]}))
+    results = []
+
+    def search():
+        response = request(run, client, "GET", "/users/search", params={"q": next(prefixes)})()
+        results.append(len(response.json()))
+    benchmark(search)
+    benchmark.extra_info["mean_results"] = sum(results) / len(results)
+
+
+@pytest.mark.parametrize("hashing", ["pool", "loop"])
+def test_get_user_while_hashing(benchmark, run, bench_loop, client, user, new_email, hashing, monkeypatch):
+    """Lookups while users are created with the scrypt cost of production, with the hashes running on the pool, or
+    on the event loop, as they would without it. Compare with `test_get_user_by_id_uncached`."""
+    monkeypatch.setattr(password_hasher, "n", Settings.__fields__["password_hash_n"].default)
+    if hashing == "loop":
+        async def hash_on_loop(password: str) -> str:
+            return hash_password_sync(password, password_hasher.n, password_hasher.r, password_hasher.p)
+        monkeypatch.setattr(password_hasher, "hash", hash_on_loop)
+    stop = asyncio.Event()
+
+    async def create_users():
+        while not stop.is_set():
+            await client.post("/users", content=json.dumps({**NEW_USER, "email": new_email()}))
+            # Give the lookups a chance between two requests, even if nothing in the request had to wait.
+            await asyncio.sleep(0)
+    # The writers only run while the loop runs the lookups, they fill the hashing queue first.
+    writers = [bench_loop.create_task(create_users()) for _ in range(HASHING_WRITERS)]
+    run(asyncio.sleep(0.5))
+    try:
+        benchmark.pedantic(request(run, client, "GET", f"/users/{user['_id']}"), setup=user_cache.clear,
+                           rounds=HASHING_ROUNDS)
+    finally:
+        stop.set()
+        run(asyncio.gather(*writers))
+
+
+def test_create_user(benchmark, run, client, size, new_email):
+    def send():
+        response = run(client.post("/users", content=json.dumps({**NEW_USER, "email": new_email()})))
+        assert response.status_code == 201
+    benchmark(send)
+
+
+def test_create_users_bulk(benchmark, run, client, size, new_email):
+    def send():
+        items = [{**NEW_USER, "email": new_email()} for _ in range(BULK_ITEMS)]
+        response = run(client.post("/users/bulk", content=json.dumps(items)))
+        assert response.json()["created"] == BULK_ITEMS
+    benchmark(send)
+
+
+@pytest.mark.parametrize("with_email", [False, True], ids=["names", "email"])
+def test_update_user(benchmark, run, client, user, with_email, pytestconfig):
+    # Without the email, its search key is computed by MongoDB in the update pipeline, from an array of expressions
+    # that mongomock stores without evaluating them.
+    if not with_email and pytestconfig.getoption("--mongodb-uri") is None:
+        pytest.skip("mongomock does not evaluate the expressions of the update pipeline")
+    update = {"first_name": "updated_first", "last_name": "updated_last", "password": "strong_password",
+              **({"email": user["email"]} if with_email else {})}
+    benchmark(request(run, client, "PATCH", f"/users/{user['_id']}", content=json.dumps(update)))
+
+
+def test_delete_user(benchmark, run, client, size, new_email):
+    def setup():
+        response = run(client.post("/users", content=json.dumps({**NEW_USER, "email": new_email()})))
+        return (response.json()["_id"],), {}
+    benchmark.pedantic(lambda user_id: request(run, client, "DELETE", f"/users/{user_id}")(), setup=setup,
+                       rounds=100)
+
+
+def test_delete_all_users(benchmark, run, client, refill):
+    benchmark.pedantic(request(run, client, "DELETE", "/users"), setup=refill, rounds=WRITE_ROUNDS)
+
+
+def test_populate(benchmark, run, client, size):
+    def setup():
+        run(UserInDB.get_motor_collection().delete_many({}))
+    # Runs after test_delete_all_users, and leaves `size` users in the collection for the next benchmarks.
+    benchmark.pedantic(request(run, client, "GET", "/populate", params={"count": size, "batch_size": 5000}),
+                       setup=setup, rounds=WRITE_ROUNDS)
+
+
+def test_get_job(benchmark, run, client):
+    # A background delete that matches no user.
+    job = run(client.delete("/users", params={"background": True, "created_before": "2000-01-01T00:00:00"})).json()
+    benchmark(request(run, client, "GET", job["status_url"]))
+
+
+@pytest.mark.parametrize("url", ["/diagnostics/cache", "/diagnostics/hashing", "/healthz"])
+def test_diagnostics(benchmark, run, client, url):
+    benchmark(request(run, client, "GET", url))
+
+
+def test_diagnose_indexes(benchmark, run, client, size, pytestconfig):
+    if pytestconfig.getoption("--mongodb-uri") is None:
+        pytest.skip("The in-memory database does not support explain().")
+    benchmark(request(run, client, "GET", "/diagnostics/indexes"))
@@ -0,0 +1,28 @@
+import pytest
+
+from api.utils import UserGenerator, generate_users
+
+COUNT = 10000
+
+
+@pytest.fixture(scope="module")
+def generator():
+    # Building the name pools once, outside of the measured code.
+    return UserGenerator(seed=1)
+
+
+def test_generator_batch(benchmark, generator):
+    users = benchmark(generator.batch, 0, COUNT)
+    assert len(users) == COUNT
+
+
+@pytest.mark.parametrize("file_format", ["ndjson", "bson"])
+def test_generator_encoded(benchmark, generator, file_format):
+    chunks = benchmark(lambda: list(generator.encoded_batches(COUNT, file_format=file_format)))
+    assert chunks
+
+
+def test_generate_users(benchmark):
+    # Includes the validation of every user as UserCreate.
+    users = benchmark(generate_users, 1000, 1)
+    assert len(users) == 1000
@@ -0,0 +1,84 @@
+import json
+
+import pytest
+from beanie import PydanticObjectId
+from beanie.odm.utils.encoder import Encoder
+from fastapi.encoders import jsonable_encoder
+from pydantic import ValidationError
+
+from api.models import UserInDB
+from api.schemas import UserCreate, UserOut, UserUpdate
+from api.serialization import dumps
+from api.utils import UserGenerator
+
+COUNT = 1000
+# Beanie documents can only be created once Beanie is initialized.
+pytestmark = pytest.mark.usefixtures("client")
+
+
+@pytest.fixture(scope="module")
+def users():
+    return UserGenerator(seed=1).batch(0, COUNT)
+
+
+@pytest.fixture(scope="module")
+def documents(users):
+    return [{**user, "_id": PydanticObjectId(), "revision": 0} for user in users]
+
+
+def test_user_create_validation(benchmark, users):
+    benchmark(lambda: [UserCreate.parse_obj(user) for user in users])
+
+
+def test_user_create_invalid_email(benchmark, users):
+    # The email regex has to reject the value, the slowest path of the `constr`.
+    invalid = [{**user, "email": user["email"].replace("@", "-at-") + "." * 32} for user in users]
+
+    def validate():
+        for user in invalid:
+            try:
+                UserCreate.parse_obj(user)
+            except ValidationError:
+                pass
+            else:
+                raise AssertionError("The email should not be valid.")
+
+    benchmark(validate)
+
+
+def test_user_update_validation(benchmark, users):
+    updates = [{"first_name": user["first_name"], "last_name": user["last_name"], "password": user["password"]}
+               for user in users]
+    benchmark(lambda: [UserUpdate.parse_obj(update) for update in updates])
+
+
+def test_user_in_db_validation(benchmark, documents):
+    benchmark(lambda: [UserInDB.parse_obj(document) for document in documents])
+
+
+def test_user_in_db_construct(benchmark, documents):
+    # What `/populate` does, the generated users are valid by construction.
+    benchmark(lambda: [UserInDB.construct(**document) for document in documents])
+
+
+def test_user_in_db_to_bson(benchmark, documents):
+    encoder = Encoder(custom_encoders=UserInDB.get_settings().bson_encoders, to_db=True)
+    users = [UserInDB.parse_obj(document) for document in documents]
+    benchmark(lambda: [encoder.encode(user) for user in users])
+
+
+def test_user_in_db_to_json(benchmark, documents):
+    # What FastAPI does with the response model of POST /users and PATCH /users/{id}.
+    users = [UserInDB.parse_obj(document) for document in documents]
+    benchmark(lambda: json.dumps(jsonable_encoder(users)))
+
+
+def test_user_out_to_json(benchmark, documents):
+    # The default path of the read endpoints.
+    benchmark(lambda: json.dumps(jsonable_encoder([UserOut.parse_obj(document) for document in documents],
+                                                  by_alias=True, exclude_unset=True)))
+
+
+def test_documents_to_json_orjson(benchmark, documents):
+    # The `fast_responses` path of the read endpoints.
+    benchmark(dumps, documents)
@@ -1,15 +1,26 @@
-import motor
+import os
+
 import pytest
-from beanie import init_beanie
 from httpx import AsyncClient
+
+# A cheap scrypt cost, so that the tests do not spend their time hashing passwords. It must be set before the
+# settings are first read.
+os.environ.setdefault("API_PASSWORD_HASH_N", "16")
+
+from api import database
+from api.cache import user_cache
+from api.hashing import password_hasher
+from api.config import Settings
+from api.indexes import sync_indexes
 from api.main import app
 from api.models import UserInDB
 
 
 async def test_init_db():
-    client = motor.motor_asyncio.AsyncIOMotorClient("mongodb://localhost:27017/test")
-    await init_beanie(database=client["test_db"], document_models=[UserInDB])
-    return client
+    await database.init_db(Settings(mongodb_uri="mongodb://localhost:27017/test", database_name="test_db"))
+    # The indexes are built in the background by init_db, the tests need them right away.
+    await sync_indexes(UserInDB)
+    return database.client
 
 
 @pytest.fixture(scope="function")
@@ -24,11 +35,13 @@ def anyio_backend():
     return "asyncio"
 
 
-@pytest.fixture(scope="function", autouse=True)
+@pytest.fixture(scope="function")
 async def initialized_db():
-    # Initialize the database and return the client
+    # Initialize the database and return the client. Only the tests that use the database request it.
     client = await test_init_db()
     yield client
     # Teardown - clean up the database after each test
     await client.drop_database("test_db")
-    client.close()
+    await database.close_db()
+    user_cache.clear()
+    password_hasher.shutdown()
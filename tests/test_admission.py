@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+from pymongo.errors import AutoReconnect, ExecutionTimeout
+
+from api.admission import AdmissionController, Overloaded, is_timeout
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_admits_up_to_the_limit():
+    controller = AdmissionController("/users", limit=2, max_queue=0, queue_timeout=1)
+    await controller.acquire()
+    await controller.acquire()
+    with pytest.raises(Overloaded) as error:
+        await controller.acquire()
+    assert error.value.reason == "queue_full"
+    controller.release()
+    await controller.acquire()
+    assert controller.stats() == {"limit": 2, "max_queue": 0, "running": 2, "waiting": 0, "admitted": 3,
+                                  "shed": {"queue_full": 1, "queue_timeout": 0, "deadline": 0}}
+
+
+async def test_queued_requests_are_admitted_in_order():
+    controller = AdmissionController("/users", limit=1, max_queue=2, queue_timeout=1)
+    await controller.acquire()
+    admitted = []
+
+    async def request(name):
+        await controller.acquire()
+        admitted.append(name)
+
+    waiting = [asyncio.create_task(request(name)) for name in ("first", "second")]
+    await asyncio.sleep(0)
+    assert controller.waiting == 2
+    with pytest.raises(Overloaded):
+        await controller.acquire()
+    controller.release()
+    await asyncio.sleep(0.01)
+    assert admitted == ["first"]
+    controller.release()
+    await asyncio.gather(*waiting)
+    assert admitted == ["first", "second"]
+    # The slot is handed over, it is never free in between
+    assert controller.running == 1 and controller.waiting == 0
+
+
+async def test_queue_timeout():
+    controller = AdmissionController("/users", limit=1, max_queue=1, queue_timeout=1)
+    await controller.acquire()
+    with pytest.raises(Overloaded) as error:
+        # The deadline of the request is shorter than the queue timeout
+        await controller.acquire(timeout=0.01)
+    assert error.value.reason == "queue_timeout"
+    assert controller.waiting == 0
+    controller.release()
+    assert controller.running == 0
+
+
+async def test_cancelled_request_leaves_the_queue():
+    controller = AdmissionController("/users", limit=1, max_queue=1, queue_timeout=1)
+    await controller.acquire()
+    waiting = asyncio.create_task(controller.acquire())
+    await asyncio.sleep(0)
+    waiting.cancel()
+    await asyncio.gather(waiting, return_exceptions=True)
+    assert controller.waiting == 0
+    controller.release()
+    assert controller.running == 0
+
+
+def test_is_timeout():
+    assert is_timeout(ExecutionTimeout("operation exceeded time limit", 50))
+    assert not is_timeout(AutoReconnect("connection closed"))
+    assert not is_timeout(ValueError("not a database error"))
+    assert not is_timeout(None)
@@ -0,0 +1,266 @@
+import asyncio
+from typing import List, Optional
+
+import pytest
+from bson import ObjectId
+from fastapi.testclient import TestClient
+from pymongo import MongoClient
+from pymongo.errors import OperationFailure, PyMongoError
+
+from api.cache import UserCache
+from api.changes import RESYNC, ChangeFeed, ChangeFeedUnavailable, change_event, format_sse
+from api.config import get_settings
+from api.models import UserInDB
+
+USER = {"_id": ObjectId(), "email": "ada@gmail.com", "first_name": "Ada", "last_name": "Lovelace", "role": "admin",
+        "revision": 0}
+
+
+class FakeOplog:
+    """The changes of the users collection, as a MongoDB server would stream them."""
+
+    def __init__(self):
+        self.changes: List[dict] = []
+        self.error: Optional[Exception] = None
+
+    def append(self, operation: str, **fields) -> dict:
+        user = {**USER, **fields}
+        change = {"_id": {"_data": f"{len(self.changes):016x}"}, "operationType": operation,
+                  "documentKey": {"_id": user["_id"]}}
+        if operation != "delete":
+            change["fullDocument"] = user
+        if operation == "update":
+            change["updateDescription"] = {"updatedFields": {"first_name": "Ada"}, "removedFields": []}
+        self.changes.append(change)
+        return change
+
+
+class FakeStream:
+    def __init__(self, oplog: FakeOplog, resume_after: Optional[str]):
+        self.oplog = oplog
+        self.resume_after = resume_after
+        self.position = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def try_next(self) -> Optional[dict]:
+        if self.oplog.error:
+            raise self.oplog.error
+        if self.position is None:
+            # Opened by the first read
+            if self.resume_after is None:
+                self.position = len(self.oplog.changes)
+            else:
+                tokens = [change["_id"]["_data"] for change in self.oplog.changes]
+                if self.resume_after not in tokens:
+                    raise OperationFailure("cannot resume stream; the resume token was not found.", 286)
+                self.position = tokens.index(self.resume_after) + 1
+        await asyncio.sleep(0.001)
+        if self.position < len(self.oplog.changes):
+            self.position += 1
+            return self.oplog.changes[self.position - 1]
+        return None
+
+
+class FakeFeed(ChangeFeed):
+    def __init__(self, oplog: FakeOplog):
+        super().__init__()
+        self.oplog = oplog
+        self.opened = 0
+
+    def open_stream(self, resume_after: Optional[str] = None):
+        self.opened += 1
+        return FakeStream(self.oplog, resume_after)
+
+
+async def received(subscription, count: int) -> List[dict]:
+    events = []
+    async for event in subscription.events():
+        events.append(event)
+        if len(events) == count:
+            break
+    return events
+
+
+def operations(events: List[dict]) -> List[str]:
+    return [event["operation"] for event in events]
+
+
+def test_change_event():
+    oplog = FakeOplog()
+    insert = change_event(oplog.append("insert", password="scrypt$...", search_keys=["ada lovelace"]))
+    assert insert == {"id": f"{0:016x}", "operation": "insert", "user_id": str(USER["_id"]),
+                      "user": {key: value for key, value in USER.items() if key != "revision"}}
+    update = oplog.append("update")
+    update["updateDescription"] = {"updatedFields": {"email": "ada@lovelace.com", "search_keys": [], "revision": 1},
+                                   "removedFields": ["gender"]}
+    assert change_event(update)["changed_fields"] == ["email", "gender"]
+    delete = {"_id": {"_data": "2"}, "operationType": "delete", "documentKey": {"_id": USER["_id"]}}
+    assert change_event(delete) == {"id": "2", "operation": "delete", "user_id": str(USER["_id"])}
+
+
+def test_format_sse():
+    event = {"id": "0a", "operation": "delete", "user_id": "64b7d6f1"}
+    assert format_sse(event) == b'id: 0a\nevent: delete\ndata: {"id":"0a","operation":"delete","user_id":"64b7d6f1"}' \
+                                b'\n\n'
+    assert format_sse({"id": None, "operation": RESYNC, "reason": "behind"}).startswith(b"event: resync\n")
+
+
+@pytest.mark.anyio
+async def test_subscribers_share_one_stream():
+    oplog = FakeOplog()
+    feed = FakeFeed(oplog)
+    first, second = await feed.subscribe(10), await feed.subscribe(10)
+    oplog.append("insert")
+    oplog.append("delete")
+    assert operations(await received(first, 2)) == ["insert", "delete"]
+    assert operations(await received(second, 2)) == ["insert", "delete"]
+    assert feed.opened == 1
+    feed.unsubscribe(first)
+    feed.unsubscribe(second)
+    # Closed after the last subscriber left
+    assert feed._task is None
+
+
+@pytest.mark.anyio
+async def test_slow_subscriber_is_resynced():
+    oplog = FakeOplog()
+    feed = FakeFeed(oplog)
+    slow, fast = await feed.subscribe(2), await feed.subscribe(10)
+    for _ in range(3):
+        oplog.append("update")
+    assert operations(await received(fast, 3)) == ["update"] * 3
+    # The backlog is replaced by the resync, and the slow subscriber no longer holds the stream
+    assert operations(await received(slow, 5)) == [RESYNC]
+    assert feed.subscribers == {fast}
+    oplog.append("delete")
+    assert operations(await received(fast, 1)) == ["delete"]
+    feed.unsubscribe(fast)
+
+
+@pytest.mark.anyio
+async def test_resume_after_token():
+    oplog = FakeOplog()
+    feed = FakeFeed(oplog)
+    subscription = await feed.subscribe(10)
+    oplog.append("insert")
+    oplog.append("update")
+    last = (await received(subscription, 1))[-1]
+    # Disconnected after the first event, while the other subscribers keep the stream open
+    other = await feed.subscribe(10)
+    feed.unsubscribe(subscription)
+    oplog.append("delete")
+    await received(other, 1)
+
+    resuming = asyncio.create_task(feed.subscribe(10, resume_after=last["id"]))
+    await asyncio.sleep(0.002)
+    # Read by the shared stream and by the catch up
+    oplog.append("insert")
+    resumed = await resuming
+    oplog.append("delete")
+    events = await received(resumed, 4)
+    # No change is missed or sent twice
+    assert [event["id"] for event in events] == [change["_id"]["_data"] for change in oplog.changes[1:]]
+    feed.unsubscribe(resumed)
+    feed.unsubscribe(other)
+
+
+@pytest.mark.anyio
+async def test_resume_after_unknown_token():
+    feed = FakeFeed(FakeOplog())
+    subscription = await feed.subscribe(10, resume_after="ff")
+    assert operations(await received(subscription, 1)) == [RESYNC]
+    feed.unsubscribe(subscription)
+
+
+@pytest.mark.anyio
+async def test_stream_errors():
+    oplog = FakeOplog()
+    oplog.error = OperationFailure("The $changeStream stage is only supported on replica sets", 40573)
+    feed = FakeFeed(oplog)
+    with pytest.raises(ChangeFeedUnavailable):
+        await feed.subscribe(10)
+    assert not feed.subscribers
+
+    # An interrupted stream tells every subscriber to start over
+    oplog.error = None
+    subscription = await feed.subscribe(10)
+    oplog.error = OperationFailure("interrupted", 11601)
+    assert operations(await received(subscription, 1)) == [RESYNC]
+    assert not feed.subscribers
+
+
+async def eventually(condition, timeout: float = 1):
+    """Wait until `condition()` holds, while the change feed runs."""
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "Timed out"
+        await asyncio.sleep(0.001)
+
+
+@pytest.mark.anyio
+async def test_cache_follows_the_changes(initialized_db):
+    user = await UserInDB(email="ada@gmail.com", first_name="Ada", last_name="Lovelace", password="scrypt").insert()
+    oplog = FakeOplog()
+    cache = UserCache(enabled=False)
+    following = asyncio.create_task(cache.follow(FakeFeed(oplog), 10, required=True))
+    await eventually(lambda: cache.enabled)
+    assert (await cache.get_by_email("ada@gmail.com")).first_name == "Ada"
+
+    # Written by another worker, this one only learns about it from the change feed
+    collection = UserInDB.get_motor_collection()
+    await collection.update_one({"_id": user.id}, {"$set": {"first_name": "Augusta"}})
+    assert (await cache.get_by_id(user.id)).first_name == "Ada"
+    oplog.append("update", _id=user.id, email=user.email, first_name="Augusta")
+    await eventually(lambda: cache.backend.get(f"id:{user.id}") is None)
+    assert (await cache.get_by_id(user.id)).first_name == "Augusta"
+
+    # The delete event only has the ID, the email entry points to it
+    await collection.delete_one({"_id": user.id})
+    oplog.append("delete", _id=user.id)
+    await eventually(lambda: cache.backend.get(f"id:{user.id}") is None)
+    assert await cache.get_by_email("ada@gmail.com") is None
+
+    # The cache is disabled until the feed is subscribed to again
+    oplog.error = OperationFailure("interrupted", 11601)
+    await eventually(lambda: not cache.enabled)
+    following.cancel()
+
+
+@pytest.fixture
+def replica_set(monkeypatch):
+    """The settings of a test database on the configured server, when it is a replica set."""
+    settings = get_settings()
+    try:
+        with MongoClient(settings.mongodb_uri, serverSelectionTimeoutMS=1000) as client:
+            hello = client.admin.command("hello")
+    except PyMongoError:
+        hello = {}
+    if "setName" not in hello:
+        pytest.skip("Change streams need a replica set, e.g. `mongod --replSet rs0`.")
+    monkeypatch.setattr(settings, "database_name", "test_changes")
+    yield settings
+    with MongoClient(settings.mongodb_uri) as client:
+        client.drop_database("test_changes")
+
+
+def test_websocket_changes(replica_set):
+    from api.main import app
+
+    with TestClient(app) as client:
+        with client.websocket_connect("/users/changes") as websocket:
+            created = client.post("/users", json={"email": "ada@gmail.com", "first_name": "Ada",
+                                                  "last_name": "Lovelace", "password": "strong_password"}).json()
+            inserted = websocket.receive_json()
+            assert inserted["operation"] == "insert" and inserted["user_id"] == created["_id"]
+            assert "password" not in inserted["user"]
+        assert client.delete(f"/users/{created['_id']}").status_code == 200
+
+        # The delete happened while disconnected
+        with client.websocket_connect(f"/users/changes?resume_after={inserted['id']}") as websocket:
+            deleted = websocket.receive_json()
+            assert deleted["operation"] == "delete" and deleted["user_id"] == created["_id"]
@@ -0,0 +1,22 @@
+from datetime import date
+
+import pytest
+
+from api.filters import user_filter
+from api.schemas import Gender, Role
+
+
+def test_user_filter():
+    assert user_filter() == {}
+    assert user_filter(role=Role.admin, gender=Gender.female, name_prefix="O'Br.") == {
+        "role": "admin", "gender": "female", "last_name": {"$regex": r"^O'Br\."}}
+
+
+@pytest.mark.parametrize("today, min_age, max_age, expected", [
+    # Users aged 18 to 30 were born after the 31st birthday of the oldest, up to the 18th birthday of the youngest
+    (date(2024, 5, 17), 18, 30, {"$lte": "2006-05-17", "$gt": "1993-05-17"}),
+    # There is no February 29th 18 years earlier
+    (date(2024, 2, 29), 18, None, {"$lte": "2006-02-28"}),
+])
+def test_user_filter_age_range(today, min_age, max_age, expected):
+    assert user_filter(min_age=min_age, max_age=max_age, today=today) == {"date_of_birth": expected}
@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+
+from api.hashing import PasswordHasher, hash_password_sync, is_password_hash, verify_password_sync
+
+
+def test_hash_password_verifies():
+    hashed = hash_password_sync("strong_password", n=16, r=8, p=1)
+    assert hashed.startswith("scrypt$16$8$1$")
+    assert verify_password_sync("strong_password", hashed)
+    assert not verify_password_sync("wrong_password", hashed)
+    # Every hash has its own salt
+    assert hashed != hash_password_sync("strong_password", n=16, r=8, p=1)
+    assert not verify_password_sync("strong_password", "strong_password")
+    # An `n` that is not a power of 2 is rejected by scrypt
+    assert not verify_password_sync("strong_password", hashed.replace("scrypt$16$", "scrypt$15$"))
+
+
+def test_is_password_hash():
+    hashed = hash_password_sync("strong_password", n=32, r=8, p=1)
+    assert is_password_hash(hashed, n=16, r=8, p=1)
+    assert is_password_hash(hashed, n=32, r=8, p=1)
+    # Cheaper than the configured cost
+    assert not is_password_hash(hashed, n=64, r=8, p=1)
+    assert not is_password_hash(hashed, n=16, r=4, p=1)
+    assert not is_password_hash(hashed.replace("scrypt$32$", "scrypt$48$"), n=16, r=8, p=1)
+    # Plaintext passwords that look like a hash
+    assert not is_password_hash("scrypt$1$1$1$ab$cd", n=16, r=8, p=1)
+    assert not is_password_hash(hashed.rsplit("$", 1)[0] + "$aGFzaA", n=16, r=8, p=1)
+
+
+@pytest.mark.anyio
+async def test_password_hasher_limits_concurrency():
+    hasher = PasswordHasher(workers=2, n=16)
+    try:
+        hashes = await asyncio.gather(*[hasher.hash(f"password{i}") for i in range(8)])
+        assert all(verify_password_sync(f"password{i}", hashed) for i, hashed in enumerate(hashes))
+        stats = hasher.stats()
+        assert stats["completed"] == 8
+        assert stats["waiting"] == stats["running"] == 0
+    finally:
+        hasher.shutdown()
+
+
+@pytest.mark.anyio
+async def test_password_hasher_hashes_batches_in_order():
+    hasher = PasswordHasher(workers=2, n=16)
+    try:
+        passwords = [f"password{i}" for i in range(150)]
+        hashes = await hasher.hash_many(passwords)
+        assert len(hashes) == len(passwords)
+        assert await hasher.verify(passwords[-1], hashes[-1])
+        assert not await hasher.verify(passwords[0], hashes[-1])
+        # 150 passwords are hashed in 3 jobs, plus the 2 verifications
+        assert hasher.stats()["completed"] == 5
+    finally:
+        hasher.shutdown()
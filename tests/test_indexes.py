@@ -0,0 +1,37 @@
+import pytest
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import ServerSelectionTimeoutError
+
+from api.indexes import index_status, sync_indexes
+from api.models import UserInDB
+
+
+@pytest.mark.anyio
+async def test_sync_indexes_when_the_server_is_unreachable(initialized_db, monkeypatch):
+    async def index_information():
+        raise ServerSelectionTimeoutError("localhost:27017: connection refused")
+
+    monkeypatch.setattr(UserInDB.get_motor_collection(), "index_information", index_information)
+    # Runs in the background at startup, it must not raise
+    status = await sync_indexes(UserInDB)
+    assert status["email_unique"].startswith("error: localhost:27017")
+    index_status.clear()
+
+
+@pytest.mark.anyio
+async def test_outdated_unique_index_is_not_dropped(initialized_db):
+    collection = UserInDB.get_motor_collection()
+    declared = [IndexModel([("email", ASCENDING), ("role", ASCENDING)], name="email_unique", unique=True),
+                IndexModel([("role", ASCENDING)], name="role_id")]
+    status = await sync_indexes(UserInDB, declared)
+    assert status["email_unique"] == "outdated"
+    assert status["role_id"] == "rebuilt"
+    existing = await collection.index_information()
+    # The unique index of the live collection is kept as it was
+    assert list(existing["email_unique"]["key"]) == [("email", ASCENDING)]
+    assert list(existing["role_id"]["key"]) == [("role", ASCENDING)]
+
+    assert (await sync_indexes(UserInDB, declared, rebuild_unique=True))["email_unique"] == "rebuilt"
+    existing = await collection.index_information()
+    assert list(existing["email_unique"]["key"]) == [("email", ASCENDING), ("role", ASCENDING)]
+    index_status.clear()
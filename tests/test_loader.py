@@ -0,0 +1,87 @@
+import asyncio
+from typing import Dict, List
+
+import pytest
+
+from api.loader import BatchLoader
+
+
+class FakeStore:
+    def __init__(self, values: Dict[str, int]):
+        self.values = values
+        self.queries: List[List[str]] = []
+        self.error = None
+
+    async def fetch(self, keys: List[str]) -> Dict[str, int]:
+        self.queries.append(keys)
+        found = {key: self.values[key] for key in keys if key in self.values}
+        await asyncio.sleep(0.01)
+        if self.error:
+            raise self.error
+        return found
+
+
+@pytest.mark.anyio
+async def test_concurrent_lookups_share_one_query():
+    store = FakeStore({"a": 1, "b": 2, "c": 3})
+    loader = BatchLoader("test", store.fetch, window=0.005)
+    results = await asyncio.gather(*[loader.load(key) for key in ["a", "b", "a", "x", "c", "a"]])
+    assert results == [1, 2, 1, None, 3, 1]
+    assert store.queries == [["a", "b", "x", "c"]]
+    assert loader.stats() == {"loads": 6, "coalesced": 2, "batches": 1, "in_flight": 0}
+
+    # Nothing is kept after the answer
+    assert await loader.load("a") == 1
+    assert len(store.queries) == 2
+
+
+@pytest.mark.anyio
+async def test_lookups_join_the_query_in_flight():
+    store = FakeStore({"a": 1, "b": 2})
+    loader = BatchLoader("test", store.fetch, window=0)
+    first = asyncio.create_task(loader.load("a"))
+    await asyncio.sleep(0.005)
+    # Sent already, "a" waits for it and "b" starts a new batch.
+    assert await asyncio.gather(loader.load("a"), loader.load("b"), first) == [1, 2, 1]
+    assert store.queries == [["a"], ["b"]]
+
+
+@pytest.mark.anyio
+async def test_max_batch_size():
+    store = FakeStore({str(key): key for key in range(5)})
+    loader = BatchLoader("test", store.fetch, window=10, max_batch_size=2)
+    # The full batches are sent without waiting for the window, the last one waits for the others to fill it.
+    results = await asyncio.wait_for(asyncio.gather(*[loader.load(str(key)) for key in range(4)]), 1)
+    assert results == [0, 1, 2, 3]
+    assert store.queries == [["0", "1"], ["2", "3"]]
+
+
+@pytest.mark.anyio
+async def test_forget_after_a_write():
+    store = FakeStore({"a": 1})
+    loader = BatchLoader("test", store.fetch, window=0)
+    before = asyncio.create_task(loader.load("a"))
+    await asyncio.sleep(0.005)
+    store.values["a"] = 2
+    loader.forget("a")
+    # The lookups that start after the write do not wait for the query that may have read the old value
+    assert await asyncio.gather(before, loader.load("a")) == [1, 2]
+    assert len(store.queries) == 2
+
+
+@pytest.mark.anyio
+async def test_errors_and_cancellation():
+    store = FakeStore({"a": 1})
+    store.error = RuntimeError("connection closed")
+    loader = BatchLoader("test", store.fetch, window=0)
+    results = await asyncio.gather(loader.load("a"), loader.load("b"), return_exceptions=True)
+    assert [str(result) for result in results] == ["connection closed"] * 2
+
+    # A caller that gives up does not cancel the lookup of the others
+    store.error = None
+    cancelled = asyncio.create_task(loader.load("a"))
+    waiting = asyncio.create_task(loader.load("a"))
+    await asyncio.sleep(0)
+    cancelled.cancel()
+    assert await waiting == 1
+    assert store.queries[-1] == ["a"]
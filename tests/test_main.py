@@ -1,7 +1,19 @@
 import asyncio
+import gzip
 import json
 from typing import List
+import bson
 import pytest
+from pymongo import _csot
+from pymongo.errors import AutoReconnect, ExecutionTimeout
+
+from api import endpoints
+from api.admission import AdmissionController, controllers
+from api.cache import user_cache
+from api.config import get_settings
+from api.hashing import verify_password_sync
+from api.jobs import jobs_collection
+from api.models import UserInDB
 
 # from beanie.exceptions import
 pytestmark = [pytest.mark.endpoint]
@@ -26,11 +38,291 @@ async def test_get_all_users(test_client, initialized_db):
         assert user_data["_id"] is not None
         assert user_data["first_name"] is not None
         assert user_data["last_name"] is not None
-        assert user_data["password"] is not None
+        # the password is a sensitive field, it is only returned when requested
+        assert "password" not in user_data
         assert user_data["role"] is not None
         assert user_data["date_of_birth"] is not None
 
 
+# GET ALL USERS - CURSOR PAGINATION
+@pytest.mark.endpoint
+@pytest.mark.anyio
+async def test_get_all_users_pagination(test_client, initialized_db):
+    await test_client.get("/populate?count=5")
+    # Follow the cursors until the last page, and ensure that every user is returned exactly once, in order.
+    ids = []
+    response = await test_client.get("/users?limit=2")
+    while True:
+        assert response.status_code == 200
+        assert len(response.json()) <= 2
+        ids.extend(user["_id"] for user in response.json())
+        if "X-Next-Cursor" not in response.headers:
+            break
+        response = await test_client.get(f'/users?limit=2&after={response.headers["X-Next-Cursor"]}')
+    assert len(ids) == 5
+    assert ids == sorted(set(ids))
+
+
+@pytest.mark.endpoint
+@pytest.mark.anyio
+async def test_get_all_users_invalid_cursor(test_client, initialized_db):
+    response = await test_client.get("/users?after=not-a-cursor")
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Invalid cursor."}
+
+
+# GET ALL USERS - FILTERS AND SORT ORDERS
+FILTER_USERS = [
+    {"email": "ada@gmail.com", "first_name": "Ada", "last_name": "Lovelace", "role": "admin", "gender": "female",
+     "date_of_birth": "1990-12-10"},
+    {"email": "alan@gmail.com", "first_name": "Alan", "last_name": "Turing", "role": "user", "gender": "male",
+     "date_of_birth": "1980-06-23"},
+    {"email": "grace@gmail.com", "first_name": "Grace", "last_name": "Hopper", "role": "user", "gender": "female",
+     "date_of_birth": "2000-12-09"},
+    {"email": "linus@gmail.com", "first_name": "Linus", "last_name": "Torvalds", "role": "user", "gender": "male"},
+]
+
+
+@pytest.mark.endpoint
+@pytest.mark.anyio
+@pytest.mark.parametrize("params, expected", [
+    ("role=admin", ["ada@gmail.com"]),
+    ("gender=male", ["alan@gmail.com", "linus@gmail.com"]),
+    ("role=user&gender=female", ["grace@gmail.com"]),
+    ("born_after=1985-01-01&born_before=2000-12-09", ["ada@gmail.com"]),
+    ("name_prefix=T", ["alan@gmail.com", "linus@gmail.com"]),
+    ("name_prefix=t", []),
+    ("sort=last_name", ["grace@gmail.com", "ada@gmail.com", "linus@gmail.com", "alan@gmail.com"]),
+    ("sort=-last_name", ["alan@gmail.com", "linus@gmail.com", "ada@gmail.com", "grace@gmail.com"]),
+    # A user without a date of birth comes first in ascending order, and last in descending order
+    ("sort=date_of_birth", ["linus@gmail.com", "alan@gmail.com", "ada@gmail.com", "grace@gmail.com"]),
+    ("sort=-date_of_birth", ["grace@gmail.com", "ada@gmail.com", "alan@gmail.com", "linus@gmail.com"]),
+])
+async def test_get_all_users_filtered_and_sorted(params, expected, test_client, initialized_db):
+    for user in FILTER_USERS:
+        await test_client.post("/users", content=json.dumps({**user, "password": "strong_password"}))
+    response = await test_client.get(f"/users?{params}")
+    assert [user["email"] for user in response.json()] == expected
+    # The same users are returned one by one, following the cursors
+    emails, url = [], f"/users?{params}&limit=1&fields=email"
+    while url:
+        response = await test_client.get(url)
+        for user in response.json():
+            # The sort field is read for the cursor, but only the requested fields are returned
+            assert set(user) == {"_id", "email"}
+            emails.append(user["email"])
+        cursor = response.headers.get("X-Next-Cursor")
+        url = f"/users?{params}&limit=1&fields=email&after={cursor}" if cursor else None
+    assert emails == expected
+    streamed = await test_client.get(f"/users?{params}", headers={"Accept": "application/x-ndjson"})
+    assert [json.loads(line)["email"] for line in streamed.text.splitlines()] == expected
+
+
+@pytest.mark.endpoint
+@pytest.mark.anyio
+async def test_get_all_users_cursor_of_another_sort(test_client, initialized_db):
+    for user in FILTER_USERS:
+        await test_client.post("/users", content=json.dumps({**user, "password": "strong_password"}))
+    cursor = (await test_client.get("/users?sort=last_name&limit=1")).headers["X-Next-Cursor"]
+    response = await test_client.get(f"/users?sort=date_of_birth&after={cursor}")
+    assert response.status_code == 400
+    assert response.json() == {"detail": "The cursor was created for another sort order."}
+
+
+# COUNT USERS
+@pytest.mark.endpoint
+@pytest.mark.anyio
+async def test_count_users(test_client, initialized_db):
+    for user in FILTER_USERS:
+        await test_client.post("/users", content=json.dumps({**user, "password": "strong_password"}))
+    assert (await test_client.get("/users/count")).json() == {"count": 4, "estimated": True}
+    assert (await test_client.get("/users/count?gender=female")).json() == {"count": 2, "estimated": False}
+    assert (await test_client.get("/users/count?min_age=200")).status_code == 422
+
+
+# ADMISSION CONTROL
+@pytest.mark.endpoint
+@pytest.mark.anyio
+async def test_admission_sheds_when_the_queue_is_full(test_client, initialized_db, monkeypatch):
+    controller = AdmissionController("/users/count", limit=1, max_queue=0, queue_timeout=1)
+    monkeypatch.setitem(controllers, "/users/count", controller)
+    await controller.acquire()
+    response = await test_client.get("/users/count")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(get_settings().admission_retry_after_seconds)
+    # The diagnostics still answer when a route is overloaded
+    stats = (await test_client.get("/diagnostics/admission")).json()
+    assert stats["/users/count"]["shed"]["queue_full"] == 1
+    controller.release()
+    assert (await test_client.get("/users/count")).status_code == 200
+    assert controller.running == 0
+
+
+@pytest.mark.endpoint
+@pytest.mark.anyio
+# Only the stream of GET /users lifts the deadline, not the header on its own
+@pytest.mark.parametrize("headers", [{}, {"Accept": "application/x-ndjson"}])
+async def test_admission_deadline(headers, test_client, initialized_db, monkeypatch):
+    collection = UserInDB.get_motor_collection()
+    timeouts = []
+
+    async def count(*args, **kwargs):
+        # The time left, that pymongo sends as maxTimeMS
+        timeouts.append(_csot.remaining())
+        raise ExecutionTimeout("operation exceeded time limit", 50)
+
+    monkeypatch.setattr(collection, "estimated_document_count", count)
+    response = await test_client.get("/users/count", headers=headers)
+    assert response.status_code == 503
+    assert "Retry-After" in response.headers
+    assert 0 < timeouts[0] <= get_settings().request_timeout_ms / 1000
+    assert controllers["/users/count"].shed["deadline"] >= 1
+
+
+# SEARCH USERS
+@pytest.mark.endpoint
+@pytest.mark.anyio
+async def test_search_users(test_client, initialized_db):
+    for user in [*FILTER_USERS, {"email": "elodie@gmail.com", "first_name": "Élodie", "last_name": "Adam"}]:
+        response = await test_client.post("/users", content=json.dumps({**user, "password": "strong_password"}))
+        # The search keys are internal, they are not returned
+        assert "search_keys" not in response.json()
+
+    async def search(q, **params):
+        response = await test_client.get("/users/search", params={"q": q, "fields": "email", **params})
+        assert response.status_code == 200
+        return [user["email"] for user in response.json()]
+
+    # Case and accents are ignored
+    assert await search("ÉLO") == ["elodie@gmail.com"]
+    assert await search("elodie adam") == ["elodie@gmail.com"]
+    # An exact first name ranks before a longer last name
+    assert await search("ada") == ["ada@gmail.com", "elodie@gmail.com"]
+    assert await search("adam") == ["elodie@gmail.com"]
+    assert await search("a", limit=2) == ["ada@gmail.com", "elodie@gmail.com"]
+    assert await search("grace@") == ["grace@gmail.com"]
+    assert await search("x") == []
+    assert (await test_client.get("/users/search?q=")).status_code == 422
+
+
+@pytest.mark.endpoint
+@pytest.mark.anyio
+async def test_search_users_after_update(test_client, initialized_db):
+    user = (await test_client.post("/users", content=json.dumps({**FILTER_USERS[0], "password": "strong_password"}))
+            ).json()
+    update = {"first_name": "Augusta", "last_name": "King", "password": "strong_password"}
+    response = await test_client.patch(f"/users/{user['_id']}", content=json.dumps(update))
+    assert "search_keys" not in response.json()
+    assert [found["_id"] for found in (await test_client.get("/users/search?q=augusta king")).json()] == [user["_id"]]
+    assert (await test_client.get("/users/search?q=lovelace")).json() == []
+    # The search key of the email that was not updated is kept
+    assert [found["_id"] for found in (await test_client.get("/users/search?q=ada@")).json()] == [user["_id"]]
+    # The email is updated as well
+    update["email"] = "countess@gmail.com"
+    await test_client.patch(f"/users/{user['_id']}", content=json.dumps(update))
+    assert [found["_id"] for found in (await test_client.get("/users/search?q=countess")).json()] == [user["_id"]]
+    assert (await test_client.get("/users/search?q=ada@")).json() == []
+
+
+# EXPORT AND IMPORT USERS
+@pytest.mark.endpoint
+@pytest.mark.anyio
+@pytest.mark.parametrize("export_format, compressed", [("ndjson", False), ("csv", False), ("csv", True)])
+async def test_export_import_users(export_format, compressed, test_client, initialized_db):
+    for user in FILTER_USERS:
+        await test_client.post("/users", content=json.dumps({**user, "password": "strong_password"}))
+    before = await UserInDB.get_motor_collection().find({}, projection={"search_keys": 0, "revision": 0},
+                                                       sort=[("_id", 1)]).to_list(None)
+    response = await test_client.get("/users/export", params={
+        "format": export_format, "gzip": compressed,
+        "fields": "email,first_name,last_name,role,gender,date_of_birth,password"})
+    assert response.status_code == 200
+    assert response.headers["content-disposition"] == \
+        f'attachment; filename="users.{export_format}{".gz" if compressed else ""}"'
+    body = response.content
+    if compressed:
+        assert response.headers["content-type"] == "application/gzip"
+        assert gzip.decompress(body).startswith(b"_id,email,first_name,last_name,role,gender,date_of_birth,password\n")
+
+    await test_client.delete("/users")
+    response = await test_client.post("/users/import", content=body, headers={
+        "Content-Type": "text/csv" if export_format == "csv" else "application/x-ndjson",
+        **({"Content-Encoding": "gzip"} if compressed else {})})
+    assert response.status_code == 200
+    assert response.json()["inserted"] == 4
+    # The IDs and the password hashes are restored as they were
+    assert await UserInDB.get_motor_collection().find({}, projection={"search_keys": 0, "revision": 0},
+                                                      sort=[("_id", 1)]).to_list(None) == before
+    assert [user["email"] for user in (await test_client.get("/users/search?q=ada")).json()] == ["ada@gmail.com"]
+
+
+@pytest.mark.endpoint
+@pytest.mark.anyio
+async def test_export_users_filtered(test_client, initialized_db):
+    for user in FILTER_USERS:
+        await test_client.post("/users", content=json.dumps({**user, "password": "strong_password"}))
+    response = await test_client.get("/users/export", params={"gender": "female", "fields": "email"})
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    assert [json.loads(line) for line in response.text.splitlines()] == [
+        {"_id": user["_id"], "email": user["email"]} for user in (await test_client.get("/users?gender=female")).json()]
+    assert (await test_client.get("/users/export?fields=age")).status_code == 400
+
+
+@pytest.mark.endpoint
+@pytest.mark.anyio
+async def test_import_users_rejected_rows(test_client, initialized_db):
+    await test_client.post("/users", content=json.dumps({**FILTER_USERS[0], "password": "strong_password"}))
+    body = "\n".join([
+        json.dumps({**FILTER_USERS[1], "password": "strong_password"}),
+        json.dumps({**FILTER_USERS[0], "password": "strong_password"}),
+        "",
+        json.dumps({**FILTER_USERS[2], "email": "grace"}),
+        "{not json",
+        json.dumps({**FILTER_USERS[3], "password": "strong_password"}),
+    ])
+    response = await test_client.post("/users/import?chunk_size=2", content=body,
+                                      headers={"Content-Type": "application/x-ndjson",
+                                               "Accept": "application/x-ndjson"})
+    progress = [json.loads(line) for line in response.text.splitlines()]
+    assert [(chunk["processed"], chunk["inserted"], chunk["rejected"]) for chunk in progress] == [
+        (2, 1, 1), (4, 1, 3), (5, 2, 3)]
+    assert [[row["line"] for row in chunk["rejected_rows"]] for chunk in progress] == [[2], [4, 5], []]
+    assert progress[0]["rejected_rows"][0]["errors"] == ["There is already a user with this email or ID."]
+
+    response = await test_client.post("/users/import", content=body, headers={"Content-Type": "application/x-ndjson"})
+    assert response.json()["inserted"] == 0
+    assert [row["line"] for row in response.json()["rejected_rows"]] == [1, 2, 4, 5, 6]
+    # The imported passwords are hashed
+    user = await UserInDB.get_motor_collection().find_one({"email": "alan@gmail.com"})
+    assert verify_password_sync("strong_password", user["password"])
+
+
+@pytest.mark.endpoint
+@pytest.mark.anyio
+async def test_import_users_errors(test_client, initialized_db):
+    response = await test_client.post("/users/import", content=b"[]", headers={"Content-Type": "application/json"})
+    assert response.status_code == 415
+    response = await test_client.post("/users/import", content=b"not gzip",
+                                      headers={"Content-Type": "text/csv", "Content-Encoding": "gzip"})
+    assert response.status_code == 400
+    assert response.json() == {"detail": "The request body is not valid gzip data. 0 users were imported."}
+
+
+# GET ALL USERS - NDJSON STREAM
+@pytest.mark.endpoint
+@pytest.mark.anyio
+async def test_get_all_users_stream(test_client, initialized_db):
+    await test_client.get("/populate?count=5")
+    response = await test_client.get("/users", headers={"Accept": "application/x-ndjson"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    users = [json.loads(line) for line in response.text.splitlines()]
+    assert len(users) == 5
+    for user_data in users:
+        assert user_data["_id"] is not None
+        assert user_data["email"] is not None
+
+
 # DELETE ALL USERS
 @pytest.mark.endpoint
 @pytest.mark.anyio
@@ -38,7 +330,46 @@ async def test_delete_all_users(test_client, initialized_db):
     await test_generate_users_endpoint(10, test_client, initialized_db)
     response = await test_client.delete("/users")
     assert response.status_code == 200
-    assert response.json() == {"message": "All users have been deleted."}
+    assert response.json() == {"message": "All users have been deleted.", "deleted": 10}
+
+
+# DELETE USERS MATCHING A FILTER
+@pytest.mark.endpoint
+@pytest.mark.anyio
+async def test_delete_users_by_role(test_client, initialized_db):
+    await test_client.get("/populate?count=20")
+    admins = [user for user in (await test_client.get("/users")).json() if user["role"] == "admin"]
+    response = await test_client.delete("/users?role=admin")
+    if not admins:
+        assert response.status_code == 404
+        return
+    assert response.status_code == 200
+    assert response.json() == {"message": f"{len(admins)} users have been deleted.", "deleted": len(admins)}
+    remaining = (await test_client.get("/users")).json()
+    assert len(remaining) == 20 - len(admins)
+    assert all(user["role"] == "user" for user in remaining)
+
+
+# DELETE ALL USERS IN THE BACKGROUND
+@pytest.mark.endpoint
+@pytest.mark.anyio
+async def test_delete_all_users_background(test_client, initialized_db):
+    await test_client.get("/populate?count=10")
+    response = await test_client.delete("/users?background=true")
+    assert response.status_code == 202
+    status_url = response.json()["status_url"]
+    for _ in range(100):
+        job = (await test_client.get(status_url)).json()
+        if job["status"] in ("completed", "failed"):
+            break
+        await asyncio.sleep(0.05)
+    assert job["status"] == "completed"
+    assert job["total"] == 10
+    assert job["deleted"] == 10
+    assert (await test_client.get("/users")).json() == []
+    # The job is stored in the database, where every worker can read it
+    assert (await jobs_collection().find_one({"_id": job["id"]}))["deleted"] == 10
+    assert (await test_client.get("/jobs/unknown")).status_code == 404
 
 
 # Check that the response is correct when trying to delete all users but the DB is empty.
@@ -81,21 +412,217 @@ async def test_delete_all_users_xfail(test_client, initialized_db):
 async def test_create_user(user, test_client, initialized_db):
     created_user = await test_client.post("users", data=json.dumps(user))
     # Check that all the users attributes are returned + the generated ID, and that the status code is 201(created)
-    for attr in user:
+    for attr in user.keys() - {"password"}:
         print(user)
         print(created_user.json())
         assert user[attr] in created_user.json()[attr]
+    # The password hash is not returned, only the hash of the password is stored
+    assert "password" not in created_user.json()
+    stored = await UserInDB.get(created_user.json()["_id"])
+    assert stored.password != user["password"]
+    assert verify_password_sync(user["password"], stored.password)
     assert "_id" in created_user.json()
     assert created_user.status_code == 201
 
 
+# CREATE USER WITH AN EMAIL THAT IS ALREADY TAKEN
+@pytest.mark.endpoint
+@pytest.mark.anyio
+@pytest.mark.parametrize("user", [
+    {
+        "email": "email@gmail.com",
+        "first_name": "first",
+        "last_name": "last",
+        "password": "strong_password",
+        "role": "user",
+        "gender": "male",
+        "date_of_birth": "2022-12-12"
+    }
+])
+async def test_create_user_duplicate_email(user, test_client, initialized_db):
+    await test_client.post("users", data=json.dumps(user))
+    response = await test_client.post("users", data=json.dumps(user))
+    assert response.status_code == 409
+
+
+# BULK CREATE
+@pytest.mark.endpoint
+@pytest.mark.anyio
+async def test_create_users_bulk(test_client, initialized_db):
+    user = {"email": "email@gmail.com", "first_name": "first", "last_name": "last", "password": "strong_password"}
+    items = [user, {**user, "email": "not-an-email"}, {**user, "email": "other@gmail.com"}, user]
+    response = await test_client.post("/users/bulk", content=json.dumps(items))
+    assert response.status_code == 200
+    body = response.json()
+    assert (body["created"], body["failed"]) == (2, 2)
+    assert [result["status"] for result in body["results"]] == ["created", "invalid", "created", "conflict"]
+    assert [result["index"] for result in body["results"]] == [0, 1, 2, 3]
+    assert body["results"][1]["errors"][0].startswith("email:")
+    created = await test_client.get(f'/users/{body["results"][2]["id"]}')
+    assert created.json()["email"] == "other@gmail.com"
+
+
+@pytest.mark.endpoint
+@pytest.mark.anyio
+async def test_create_users_bulk_ndjson(test_client, initialized_db):
+    user = {"email": "email@gmail.com", "first_name": "first", "last_name": "last", "password": "strong_password"}
+    body = json.dumps(user) + "\n{not json\n" + json.dumps({**user, "email": "other@gmail.com"}) + "\n"
+    response = await test_client.post("/users/bulk", content=body, headers={"Content-Type": "application/x-ndjson"})
+    assert response.status_code == 200
+    assert [result["status"] for result in response.json()["results"]] == ["created", "invalid", "created"]
+
+
+@pytest.mark.endpoint
+@pytest.mark.anyio
+async def test_create_users_bulk_limits(test_client, initialized_db, monkeypatch):
+    assert (await test_client.post("/users/bulk", content=json.dumps({"email": "x"}))).status_code == 400
+    monkeypatch.setattr(get_settings(), "bulk_max_items", 1)
+    response = await test_client.post("/users/bulk", content=json.dumps([{}, {}]))
+    assert response.status_code == 413
+    monkeypatch.setattr(get_settings(), "bulk_max_body_bytes", 10)
+    response = await test_client.post("/users/bulk", content=json.dumps([{}, {}, {}, {}]))
+    assert response.status_code == 413
+
+
+# BATCH LOOKUP
+@pytest.mark.endpoint
+@pytest.mark.anyio
+@pytest.mark.parametrize("fast", [False, True])
+async def test_lookup_users(fast, test_client, initialized_db, monkeypatch):
+    monkeypatch.setattr(get_settings(), "fast_responses", fast)
+    await test_client.get("/populate?count=5")
+    users = (await test_client.get("/users")).json()
+    missing_id = "5f1d7b1c2a3b4c5d6e7f8a9b"
+    lookup = {"ids": [users[3]["_id"], missing_id, users[1]["_id"]], "emails": [users[4]["email"], "nobody@gmail.com"]}
+    response = await test_client.post("/users/lookup?fields=first_name", content=json.dumps(lookup))
+    assert response.status_code == 200
+    assert response.json() == {
+        "users": [{"_id": users[i]["_id"], "first_name": users[i]["first_name"]} for i in (3, 1, 4)],
+        "not_found": [missing_id, "nobody@gmail.com"],
+    }
+
+
+# LIST AND LOOKUP USERS - RESPONSE FORMATS
+@pytest.mark.endpoint
+@pytest.mark.anyio
+async def test_columnar_responses(test_client, initialized_db):
+    await test_client.get("/populate?count=3")
+    users = (await test_client.get("/users")).json()
+    response = await test_client.get("/users?fields=first_name,email",
+                                     headers={"Accept": "application/vnd.fastcrudapi.columnar+json"})
+    assert response.headers["Content-Type"] == "application/vnd.fastcrudapi.columnar+json"
+    assert response.json() == {"_id": [user["_id"] for user in users], "email": [user["email"] for user in users],
+                               "first_name": [user["first_name"] for user in users]}
+    response = await test_client.post("/users/lookup?fields=first_name",
+                                      content=json.dumps({"ids": [users[2]["_id"]], "emails": ["nobody@gmail.com"]}),
+                                      headers={"Accept": "application/vnd.fastcrudapi.columnar+json"})
+    assert response.json() == {"users": {"_id": [users[2]["_id"]], "first_name": [users[2]["first_name"]]},
+                               "not_found": ["nobody@gmail.com"]}
+
+
+@pytest.mark.endpoint
+@pytest.mark.anyio
+async def test_msgpack_responses(test_client, initialized_db):
+    msgpack = pytest.importorskip("msgpack")
+    await test_client.get("/populate?count=3")
+    users = (await test_client.get("/users")).json()
+    response = await test_client.get("/users", headers={"Accept": "application/msgpack"})
+    assert response.headers["Content-Type"] == "application/msgpack"
+    assert msgpack.unpackb(response.content) == users
+
+
+@pytest.mark.endpoint
+@pytest.mark.anyio
+async def test_bson_responses(test_client, initialized_db):
+    await test_client.get("/populate?count=3")
+    users = (await test_client.get("/users?limit=2&sort=last_name&fields=email")).json()
+    response = await test_client.get("/users?limit=2&sort=last_name&fields=email",
+                                     headers={"Accept": "application/bson"})
+    assert response.headers["Content-Type"] == "application/bson"
+    assert "X-Next-Cursor" in response.headers
+    # The documents are sent as they were read, with the field of the sort order
+    documents = bson.decode_all(response.content)
+    assert [(str(document["_id"]), document["email"]) for document in documents] == \
+           [(user["_id"], user["email"]) for user in users]
+    assert all("last_name" in document for document in documents)
+
+    response = await test_client.post("/users/lookup", content=json.dumps({"ids": [users[1]["_id"]]}),
+                                      headers={"Accept": "application/bson"})
+    result = bson.decode(response.content)
+    assert [str(user["_id"]) for user in result["users"]] == [users[1]["_id"]]
+    assert result["not_found"] == []
+
+
+# COMPRESSION
+@pytest.mark.endpoint
+@pytest.mark.anyio
+async def test_compression(test_client, initialized_db, monkeypatch):
+    await test_client.get("/populate?count=20")
+    response = await test_client.get("/users", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["Vary"]
+    assert len(response.json()) == 20
+    # Small responses and clients that do not accept it are not compressed
+    response = await test_client.get("/users?limit=1", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in response.headers
+    response = await test_client.get("/users", headers={"Accept-Encoding": "identity"})
+    assert "Content-Encoding" not in response.headers
+    # A stream is compressed whatever its size, and read incrementally
+    response = await test_client.get("/users", headers={"Accept": "application/x-ndjson", "Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert len(response.text.splitlines()) == 20
+    # An export compressed by the endpoint is not compressed again
+    response = await test_client.get("/users/export?gzip=true", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in response.headers
+    assert len(gzip.decompress(response.content).splitlines()) == 20
+
+
 # GENERATE USERS ENDPOINT
 @pytest.mark.endpoint
 @pytest.mark.anyio
 @pytest.mark.parametrize('count', [1, 2, 3])
 async def test_generate_users_endpoint(count, test_client, initialized_db):
-    returned_users_data = await test_client.get(f"/populate?count={count}")
-    assert len(returned_users_data.json()) == count
+    summary = await test_client.get(f"/populate?count={count}")
+    assert summary.status_code == 201
+    assert summary.json()["inserted"] == count
+    assert summary.json()["duplicates"] == 0
+    users = await test_client.get("/users")
+    assert len(users.json()) == count
+
+
+# GENERATE USERS ENDPOINT - MULTIPLE BATCHES, STREAMED PROGRESS
+@pytest.mark.endpoint
+@pytest.mark.anyio
+async def test_generate_users_endpoint_stream(test_client, initialized_db):
+    response = await test_client.get("/populate?count=25&batch_size=10", headers={"Accept": "application/x-ndjson"})
+    assert response.status_code == 201
+    progress = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["inserted"] for line in progress] == [10, 20, 25]
+
+
+# GENERATE USERS ENDPOINT - A BATCH THAT CANNOT BE WRITTEN
+@pytest.mark.endpoint
+@pytest.mark.anyio
+async def test_generate_users_endpoint_errors(test_client, initialized_db, monkeypatch):
+    insert_users = endpoints.insert_users
+    batches = []
+
+    async def fail_second_batch(users):
+        batches.append(users)
+        if len(batches) % 2 == 0:
+            raise AutoReconnect("connection closed")
+        return await insert_users(users)
+    monkeypatch.setattr(endpoints, "insert_users", fail_second_batch)
+
+    response = await test_client.get("/populate?count=25&batch_size=10", headers={"Accept": "application/x-ndjson"})
+    progress = [json.loads(line) for line in response.text.splitlines()]
+    # The stream ends with the totals so far and the error, instead of stopping silently
+    assert [line["inserted"] for line in progress] == [10, 10]
+    assert progress[0]["error"] is None
+    assert progress[-1]["error"] == "An internal error occurred while writing the users to the database."
+
+    response = await test_client.get("/populate?count=25&batch_size=10")
+    assert response.status_code == 500
 
 
 # DELETE USER BY ID
@@ -103,7 +630,8 @@ async def test_generate_users_endpoint(count, test_client, initialized_db):
 @pytest.mark.anyio
 async def test_delete_user_by_id(test_client, initialized_db):
     # Populate the DB and get the newly created users IDs in order to test the delete function
-    returned_users_data = await test_client.get("/populate?count=10")
+    await test_client.get("/populate?count=10")
+    returned_users_data = await test_client.get("/users")
     list_of_ids = []
     for user in returned_users_data.json():
         list_of_ids.append(user["_id"])
@@ -135,7 +663,8 @@ async def test_get_user_by_email(user, test_client, initialized_db):
     response = await test_client.get(f'user?email={user["email"]}')
     print(response.json())
     assert response.status_code == 200
-    for attr in user:
+    assert "password" not in response.json()
+    for attr in user.keys() - {"password"}:
         assert user[attr] in response.json()[attr]
 
 
@@ -159,10 +688,136 @@ async def test_get_user_by_id(user, test_client, initialized_db):
     assert response.status_code == 200
     print(user)
     print(response.json())
-    for attr in user:
+    assert "password" not in response.json()
+    for attr in user.keys() - {"password"}:
         assert user[attr] in response.json()[attr]
 
 
+# SPARSE RESPONSES
+@pytest.mark.endpoint
+@pytest.mark.anyio
+@pytest.mark.parametrize("user", [
+    {
+        "email": "email@gmail.com",
+        "first_name": "first",
+        "last_name": "last",
+        "password": "strong_password",
+        "role": "user",
+        "gender": "male",
+        "date_of_birth": "2022-12-12"
+    }
+])
+async def test_get_users_with_fields(user, test_client, initialized_db):
+    created_user = await test_client.post("users", data=json.dumps(user))
+    user_id = created_user.json()["_id"]
+    expected = {"_id": user_id, "email": user["email"], "role": user["role"]}
+    assert (await test_client.get("users?fields=email,role")).json() == [expected]
+    assert (await test_client.get(f"users/{user_id}?fields=email,role")).json() == expected
+    assert (await test_client.get(f'user?email={user["email"]}&fields=email,role')).json() == expected
+    response = await test_client.get("users?fields=email,role", headers={"Accept": "application/x-ndjson"})
+    assert json.loads(response.text) == expected
+
+
+# THE PASSWORD HASH CAN ONLY BE EXPORTED
+@pytest.mark.endpoint
+@pytest.mark.anyio
+@pytest.mark.parametrize("method, url, headers, body", [
+    ("GET", "/users", {}, None),
+    ("GET", "/users", {"Accept": "application/x-ndjson"}, None),
+    ("GET", "/users/{user_id}", {}, None),
+    ("GET", "/user?email=ada@gmail.com", {}, None),
+    ("GET", "/users/search?q=ada", {}, None),
+    ("POST", "/users/lookup", {}, {"emails": ["ada@gmail.com"]}),
+])
+async def test_get_users_with_password_field(method, url, headers, body, test_client, initialized_db):
+    user_id = (await test_client.post("/users", content=json.dumps({**FILTER_USERS[0], "password": "strong_password"}))
+               ).json()["_id"]
+    response = await test_client.request(method, url.format(user_id=user_id), params={"fields": "email,password"},
+                                         headers=headers, json=body)
+    assert response.status_code == 422
+    assert response.json() == {"detail": "The field(s) password can not be requested here."}
+
+    response = await test_client.get("/users/export", params={"fields": "email,password"})
+    assert response.status_code == 200
+    assert verify_password_sync("strong_password", json.loads(response.text)["password"])
+
+
+# FAST RESPONSES MUST RETURN THE SAME DATA
+@pytest.mark.endpoint
+@pytest.mark.anyio
+@pytest.mark.parametrize("fields", [None, "email,role"])
+async def test_fast_responses(fields, test_client, initialized_db, monkeypatch):
+    await test_client.get("/populate?count=5")
+    user = (await test_client.get("/users?limit=1")).json()[0]
+    params = {"fields": fields} if fields else {}
+    urls = ["/users", "/users?limit=2", f'/users/{user["_id"]}', f'/user?email={user["email"]}']
+    expected = [await test_client.get(url, params=params) for url in urls]
+    expected_stream = await test_client.get("/users", params=params, headers={"Accept": "application/x-ndjson"})
+
+    monkeypatch.setattr(get_settings(), "fast_responses", True)
+    for url, expected_response in zip(urls, expected):
+        response = await test_client.get(url, params=params)
+        assert response.status_code == 200
+        assert response.json() == expected_response.json()
+        assert response.headers.get("X-Next-Cursor") == expected_response.headers.get("X-Next-Cursor")
+    stream = await test_client.get("/users", params=params, headers={"Accept": "application/x-ndjson"})
+    assert [json.loads(line) for line in stream.text.splitlines()] == \
+           [json.loads(line) for line in expected_stream.text.splitlines()]
+
+
+@pytest.mark.endpoint
+@pytest.mark.anyio
+async def test_get_users_with_unknown_fields(test_client, initialized_db):
+    response = await test_client.get("users?fields=email,age")
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Unknown field(s): age."}
+
+
+# A CACHED USER MUST NOT BE RETURNED AFTER IT IS DELETED
+@pytest.mark.endpoint
+@pytest.mark.anyio
+@pytest.mark.parametrize("user", [
+    {
+        "email": "email@gmail.com",
+        "first_name": "first",
+        "last_name": "last",
+        "password": "strong_password",
+        "role": "user",
+        "gender": "male",
+        "date_of_birth": "2022-12-12"
+    }
+])
+async def test_get_user_after_delete(user, test_client, initialized_db):
+    created_user = await test_client.post("users", data=json.dumps(user))
+    user_id = created_user.json()["_id"]
+    # Read the user twice so that it is served from the cache, then delete it.
+    assert (await test_client.get(f"users/{user_id}")).status_code == 200
+    assert (await test_client.get(f'user?email={user["email"]}')).status_code == 200
+    await test_client.delete(f"users/{user_id}")
+    assert (await test_client.get(f"users/{user_id}")).status_code == 404
+    assert (await test_client.get(f'user?email={user["email"]}')).status_code == 404
+
+
+@pytest.mark.endpoint
+@pytest.mark.anyio
+async def test_concurrent_lookups_are_batched(test_client, initialized_db, monkeypatch):
+    # Wider than the default, so that all the requests of the test client reach the handlers within it.
+    monkeypatch.setattr(user_cache.by_id, "window", 0.1)
+    monkeypatch.setattr(user_cache.by_email, "window", 0.1)
+    await test_client.get("/populate?count=10")
+    users = (await test_client.get("/users")).json()
+    before = (await test_client.get("/diagnostics/lookups")).json()
+    urls = [f'/users/{user["_id"]}' for user in users] * 2 + [f'/user?email={user["email"]}' for user in users]
+    responses = await asyncio.gather(*[test_client.get(url) for url in urls])
+    assert [response.json() for response in responses] == users * 3
+    stats = (await test_client.get("/diagnostics/lookups")).json()
+    # The cache was empty: 20 lookups by ID of 10 users, and 10 lookups by email, with one query each.
+    assert stats["id"]["loads"] - before["id"]["loads"] == 20
+    assert stats["id"]["batches"] - before["id"]["batches"] == 1
+    assert stats["email"]["batches"] - before["email"]["batches"] == 1
+    assert (await test_client.get("/users/5f1d7b1c2a3b4c5d6e7f8a9b")).status_code == 404
+
+
 @pytest.mark.endpoint
 @pytest.mark.anyio
 @pytest.mark.parametrize("user", [
@@ -193,8 +848,98 @@ async def test_update_user(user, updated_user, test_client, initialized_db):
     print(created_user.json())
     updated_user_data = await test_client.patch(f'/users/{created_user.json()["_id"]}', data=json.dumps(updated_user))
     print(updated_user_data.json())
-    for attr in updated_user:
+    for attr in updated_user.keys() - {"password"}:
         assert updated_user[attr] == updated_user_data.json()[attr]
+    assert "password" not in updated_user_data.json()
+    stored = await UserInDB.get(created_user.json()["_id"])
+    assert verify_password_sync(updated_user["password"], stored.password)
+
+
+
+# OPTIMISTIC CONCURRENCY
+@pytest.mark.endpoint
+@pytest.mark.anyio
+async def test_update_user_if_match(test_client, initialized_db):
+    user = {"email": "email@gmail.com", "first_name": "first", "last_name": "last", "password": "strong_password"}
+    update = {"first_name": "updated_first", "last_name": "last", "password": "strong_password"}
+    user_id = (await test_client.post("/users", content=json.dumps(user))).json()["_id"]
+    read = await test_client.get(f"/users/{user_id}")
+    assert read.headers["ETag"] == '"0"'
+
+    updated = await test_client.patch(f"/users/{user_id}", content=json.dumps(update),
+                                      headers={"If-Match": read.headers["ETag"]})
+    assert updated.status_code == 200
+    assert updated.headers["ETag"] == '"1"'
+    assert updated.json()["first_name"] == "updated_first"
+    assert updated.json()["email"] == user["email"]
+
+    # A second update based on the stale revision is rejected, and does not overwrite the first one.
+    stale = await test_client.patch(f"/users/{user_id}", content=json.dumps({**update, "first_name": "stale"}),
+                                    headers={"If-Match": read.headers["ETag"]})
+    assert stale.status_code == 412
+    assert (await test_client.get(f"/users/{user_id}")).json()["first_name"] == "updated_first"
+
+
+@pytest.mark.endpoint
+@pytest.mark.anyio
+async def test_update_user_with_dollar_values(test_client, initialized_db):
+    user = {"email": "email@gmail.com", "first_name": "first", "last_name": "last", "password": "strong_password"}
+    user_id = (await test_client.post("/users", content=json.dumps(user))).json()["_id"]
+    # The update is a pipeline, where the values are expressions unless they are wrapped in $literal
+    update = {"first_name": "$email", "last_name": "$last_name", "password": "strong_password"}
+    await test_client.patch(f"/users/{user_id}", content=json.dumps(update))
+    stored = await UserInDB.get_motor_collection().find_one({"_id": bson.ObjectId(user_id)})
+    assert (stored["first_name"], stored["last_name"]) == ("$email", "$last_name")
+    assert stored["search_keys"] == ["$email $last_name", "$last_name", "$email", "email@gmail.com"]
+
+
+@pytest.mark.endpoint
+@pytest.mark.anyio
+async def test_update_user_errors(test_client, initialized_db):
+    user = {"email": "email@gmail.com", "first_name": "first", "last_name": "last", "password": "strong_password"}
+    update = {"first_name": "first", "last_name": "last", "password": "strong_password"}
+    missing = await test_client.patch("/users/5f1d7b1c2a3b4c5d6e7f8a9b", content=json.dumps(update))
+    assert missing.status_code == 404
+    await test_client.post("/users", content=json.dumps(user))
+    other_id = (await test_client.post("/users", content=json.dumps({**user, "email": "other@gmail.com"}))).json()["_id"]
+    conflict = await test_client.patch(f"/users/{other_id}", content=json.dumps({**update, "email": user["email"]}))
+    assert conflict.status_code == 409
+    # The email of a user that was updated must not be served from the cache under the old value.
+    assert (await test_client.get("/user?email=other@gmail.com")).status_code == 200
+    await test_client.patch(f"/users/{other_id}", content=json.dumps({**update, "email": "new@gmail.com"}))
+    assert (await test_client.get("/user?email=other@gmail.com")).status_code == 404
+
+# HEALTH CHECKS
+@pytest.mark.endpoint
+@pytest.mark.anyio
+async def test_healthz(test_client, initialized_db):
+    response = await test_client.get("/healthz")
+    assert response.status_code == 200
+    assert response.json() == {"status": "ok"}
+
+
+@pytest.mark.endpoint
+@pytest.mark.anyio
+async def test_readyz(test_client, initialized_db):
+    response = await test_client.get("/readyz")
+    assert response.status_code == 200
+    assert response.json() == {"status": "ready"}
+
+
+# METRICS
+@pytest.mark.endpoint
+@pytest.mark.anyio
+async def test_metrics(test_client, initialized_db):
+    await test_client.get("/users/5f1d7b1c2a3b4c5d6e7f8a9b")
+    await test_client.get("/no-such-route")
+    response = await test_client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    # The route is labelled with its template, not with the requested path
+    assert 'http_requests_total{method="GET",route="/users/{doc_id}",status="404"}' in response.text
+    assert 'http_request_duration_seconds_count{method="GET",route="/users/{doc_id}"}' in response.text
+    assert 'route="unmatched",status="404"' in response.text
+    assert "5f1d7b1c2a3b4c5d6e7f8a9b" not in response.text
 
 # -----------------------------------------------------------------------------------
 #   Test the random user generator helper function
@@ -0,0 +1,44 @@
+from types import SimpleNamespace
+
+import pytest
+
+from api.metrics import CommandMetrics, PoolMetrics, mongodb_command_duration, mongodb_command_failures, \
+    mongodb_pool_checkout_wait, mongodb_pool_connections_in_use
+
+
+def command_event(command_name, request_id, command=None, duration_micros=1500):
+    return SimpleNamespace(command_name=command_name, request_id=request_id, connection_id=("localhost", 27017),
+                           database_name="user_db", command=command or {}, duration_micros=duration_micros)
+
+
+def test_command_metrics_labels_the_collection():
+    listener = CommandMetrics()
+    find = mongodb_command_duration.labels("find", "users")
+    get_more = mongodb_command_duration.labels("getMore", "users")
+    ping_failures = mongodb_command_failures.labels("ping", "admin")
+    counts = find._sum.get(), get_more._sum.get(), ping_failures._value.get()
+
+    listener.started(command_event("find", 1, {"find": "users", "filter": {}}))
+    listener.succeeded(command_event("find", 1))
+    listener.started(command_event("getMore", 2, {"getMore": 1234, "collection": "users"}))
+    listener.succeeded(command_event("getMore", 2))
+    # Commands that do not target a collection are labelled with the database
+    listener.started(SimpleNamespace(**{**vars(command_event("ping", 3, {"ping": 1})), "database_name": "admin"}))
+    listener.failed(command_event("ping", 3))
+
+    assert find._sum.get() == pytest.approx(counts[0] + 0.0015)
+    assert get_more._sum.get() == pytest.approx(counts[1] + 0.0015)
+    assert ping_failures._value.get() == counts[2] + 1
+    assert not listener._collections
+
+
+def test_pool_metrics():
+    listener = PoolMetrics()
+    in_use = mongodb_pool_connections_in_use._value.get()
+    waits = mongodb_pool_checkout_wait._sum.get()
+    listener.connection_check_out_started(SimpleNamespace())
+    listener.connection_checked_out(SimpleNamespace(duration=0.25))
+    assert mongodb_pool_connections_in_use._value.get() == in_use + 1
+    assert mongodb_pool_checkout_wait._sum.get() == pytest.approx(waits + 0.25)
+    listener.connection_checked_in(SimpleNamespace())
+    assert mongodb_pool_connections_in_use._value.get() == in_use
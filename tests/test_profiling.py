@@ -0,0 +1,72 @@
+import json
+import os
+import sys
+
+import pytest
+from httpx import AsyncClient
+
+from api.main import app
+from api.profiling import ProfilingMiddleware
+
+
+def client(tmp_path, **kwargs) -> AsyncClient:
+    return AsyncClient(app=ProfilingMiddleware(app, directory=str(tmp_path), **kwargs), base_url="http://test")
+
+
+@pytest.mark.anyio
+async def test_profiling_requires_the_token(tmp_path):
+    async with client(tmp_path, token="secret") as test_client:
+        for headers in ({}, {"X-Profile": "wrong"}):
+            response = await test_client.get("/healthz", headers=headers)
+            assert response.json() == {"status": "ok"}
+            assert "x-profile-file" not in response.headers
+    assert not os.listdir(tmp_path)
+
+
+@pytest.mark.anyio
+async def test_profiling_saves_the_profile(tmp_path):
+    async with client(tmp_path, token="secret") as test_client:
+        response = await test_client.get("/healthz", headers={"X-Profile": "secret"})
+    assert response.json() == {"status": "ok"}
+    assert os.listdir(tmp_path) == [response.headers["x-profile-file"]]
+    assert response.headers["x-profiler"] == "pyinstrument"
+
+
+@pytest.mark.anyio
+async def test_profiling_inline(tmp_path):
+    async with client(tmp_path, token="secret") as test_client:
+        response = await test_client.get("/healthz", headers={"X-Profile": "secret", "X-Profile-Inline": "1"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/json"
+    assert response.headers["x-profiler"] == "pyinstrument"
+    assert "speedscope" in json.loads(response.content)["$schema"]
+
+
+@pytest.mark.anyio
+async def test_profiling_inline_without_pyinstrument(tmp_path, monkeypatch):
+    monkeypatch.setitem(sys.modules, "pyinstrument", None)
+    async with client(tmp_path, token="secret") as test_client:
+        response = await test_client.get("/healthz", headers={"X-Profile": "secret", "X-Profile-Inline": "1"})
+    assert response.status_code == 200
+    # The pstats report
+    assert response.headers["x-profiler"] == "cprofile"
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "function calls" in response.text
+
+
+@pytest.mark.anyio
+async def test_profiling_sample_rate_without_pyinstrument(tmp_path, monkeypatch):
+    monkeypatch.setitem(sys.modules, "pyinstrument", None)
+    async with client(tmp_path, sample_rate=1) as test_client:
+        response = await test_client.get("/healthz")
+    # The file name is only returned to the requests with the token
+    assert "x-profile-file" not in response.headers and "x-profiler" not in response.headers
+    assert [name.endswith(".pstats") for name in os.listdir(tmp_path)] == [True]
+
+
+@pytest.mark.anyio
+async def test_profiling_keeps_the_last_profiles(tmp_path):
+    async with client(tmp_path, sample_rate=1, max_files=3) as test_client:
+        for _ in range(5):
+            await test_client.get("/healthz")
+    assert len(os.listdir(tmp_path)) == 3
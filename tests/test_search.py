@@ -0,0 +1,27 @@
+import pytest
+
+from api.models import normalize, search_keys
+from api.search import _rank
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Élodie", "elodie"),
+    ("  Zoë   O'Brien ", "zoe o'brien"),
+    ("STRASSE", "strasse"),
+    ("Straße", "strasse"),
+    ("Ångström", "angstrom"),
+])
+def test_normalize(text, expected):
+    assert normalize(text) == expected
+
+
+def test_search_keys():
+    assert search_keys("Ada", "Lovelace", "Ada@Gmail.com") == ["ada lovelace", "lovelace", "ada", "ada@gmail.com"]
+
+
+def test_rank():
+    ada = {"search_keys": search_keys("Ada", "Lovelace", "ada@gmail.com")}
+    adam = {"search_keys": search_keys("Élodie", "Adam", "elodie@gmail.com")}
+    adams = {"search_keys": search_keys("Adams", "Smith", "adams@gmail.com")}
+    assert sorted([adams, ada, adam], key=lambda document: _rank(document, "ada")) == [ada, adam, adams]
+    assert sorted([adams, ada, adam], key=lambda document: _rank(document, "adam"))[:2] == [adam, adams]
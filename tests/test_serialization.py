@@ -0,0 +1,122 @@
+import asyncio
+import zlib
+from datetime import datetime
+
+import bson
+import orjson
+import pytest
+from bson import ObjectId
+from bson.raw_bson import RawBSONDocument
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from httpx import AsyncClient
+
+from api.compression import CompressionMiddleware, choose_encoding
+from api.schemas import ResponseFormat
+from api.serialization import (BSONResponse, columns, msgpack_available, msgpack_default, negotiate, parse_accept,
+                               users_response)
+
+DOCUMENTS = [{"_id": ObjectId(), "email": "ada@gmail.com", "first_name": "Ada",
+              "date_of_birth": datetime(1990, 12, 10)},
+             {"_id": ObjectId(), "email": "alan@gmail.com"}]
+
+
+def test_parse_accept():
+    assert parse_accept("application/JSON, application/msgpack;q=0.5, */*; q=0") == [
+        ("application/json", 1.0), ("application/msgpack", 0.5), ("*/*", 0.0)]
+    assert parse_accept(None) == []
+    assert parse_accept("gzip;q=bad") == [("gzip", 0)]
+
+
+def test_negotiate():
+    assert negotiate(None) == ResponseFormat.json
+    assert negotiate("text/html, */*") == ResponseFormat.json
+    assert negotiate("application/x-ndjson") == ResponseFormat.ndjson
+    assert negotiate("application/json;q=0.5, application/bson") == ResponseFormat.bson
+    assert negotiate("application/bson;q=0, application/vnd.fastcrudapi.columnar+json") == ResponseFormat.columnar
+    # Not offered by the endpoint
+    assert negotiate("application/x-ndjson", (ResponseFormat.json, ResponseFormat.bson)) == ResponseFormat.json
+    expected = ResponseFormat.msgpack if msgpack_available() else ResponseFormat.json
+    assert negotiate("application/x-msgpack") == expected
+
+
+def test_columns():
+    assert columns(DOCUMENTS, frozenset({"_id", "first_name", "email"})) == {
+        "_id": [DOCUMENTS[0]["_id"], DOCUMENTS[1]["_id"]], "email": ["ada@gmail.com", "alan@gmail.com"],
+        "first_name": ["Ada", None]}
+
+
+def test_msgpack_default():
+    assert msgpack_default(DOCUMENTS[0]["_id"]) == str(DOCUMENTS[0]["_id"])
+    # As in the JSON responses
+    assert msgpack_default(DOCUMENTS[0]["date_of_birth"]) == orjson.loads(orjson.dumps(DOCUMENTS[0]["date_of_birth"]))
+    with pytest.raises(TypeError):
+        msgpack_default(object())
+
+
+def test_bson_response():
+    raw = [RawBSONDocument(bson.encode(document)) for document in DOCUMENTS]
+    # A list is the sequence of the raw documents
+    response = users_response(raw, ResponseFormat.bson, frozenset())
+    assert response.body == b"".join(document.raw for document in raw)
+    assert bson.decode_all(response.body) == DOCUMENTS
+    # Anything else is one document
+    body = BSONResponse({"users": raw, "not_found": ["nobody@gmail.com"]}).body
+    assert bson.decode(body) == {"users": DOCUMENTS, "not_found": ["nobody@gmail.com"]}
+
+
+def test_choose_encoding(monkeypatch):
+    monkeypatch.setattr("api.compression.zstd_available", lambda: True)
+    assert choose_encoding("gzip, zstd") == "zstd"
+    assert choose_encoding("gzip, zstd;q=0") == "gzip"
+    assert choose_encoding("*") == "zstd"
+    monkeypatch.setattr("api.compression.zstd_available", lambda: False)
+    assert choose_encoding("gzip, zstd") == "gzip"
+    assert choose_encoding("br, identity") is None
+    assert choose_encoding("") is None
+
+
+@pytest.mark.anyio
+async def test_compression_middleware():
+    app = FastAPI()
+
+    @app.get("/text")
+    async def text(size: int):
+        return PlainTextResponse("x" * size)
+
+    @app.get("/stream")
+    async def stream():
+        return StreamingResponse(iter([b"first\n", b"second\n"]), media_type="application/x-ndjson")
+
+    compressed = CompressionMiddleware(app, minimum_size=100)
+    async with AsyncClient(app=compressed, base_url="http://test") as client:
+        response = await client.get("/text?size=1000", headers={"Accept-Encoding": "gzip"})
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert int(response.headers["Content-Length"]) < 100
+        assert response.text == "x" * 1000
+        response = await client.get("/text?size=99", headers={"Accept-Encoding": "gzip"})
+        assert "Content-Encoding" not in response.headers
+        assert response.text == "x" * 99
+
+    # Every chunk of a stream is flushed, so the first line can be read before the end of the stream
+    messages = []
+    requested = asyncio.Event()
+
+    async def receive():
+        if requested.is_set():
+            # The client stays connected
+            await asyncio.Event().wait()
+        requested.set()
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    await compressed({"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+                      "scheme": "http", "path": "/stream", "raw_path": b"/stream", "root_path": "", "query_string": b"",
+                      "headers": [(b"accept-encoding", b"gzip")], "client": None, "server": None}, receive, send)
+    headers = dict(messages[0]["headers"])
+    assert headers[b"content-encoding"] == b"gzip" and b"content-length" not in headers
+    chunks = [message["body"] for message in messages[1:]]
+    assert zlib.decompressobj(wbits=31).decompress(chunks[0]) == b"first\n"
+    assert zlib.decompress(b"".join(chunks), wbits=31) == b"first\nsecond\n"
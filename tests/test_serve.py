@@ -0,0 +1,61 @@
+import importlib.util
+import os
+
+import pytest
+import uvicorn
+
+from api import serve
+
+
+@pytest.fixture
+def environment(monkeypatch):
+    for name in (serve.STARTED_AT_ENV, "PROMETHEUS_MULTIPROC_DIR", "API_PASSWORD_HASH_WORKERS", "API_WORKERS",
+                 "WEB_CONCURRENCY"):
+        # Set first, so that the variables set by the tests are removed afterwards as well.
+        monkeypatch.setenv(name, "")
+        monkeypatch.delenv(name)
+
+
+def test_serve(monkeypatch, environment):
+    runs = []
+
+    def run(app, **options):
+        runs.append((app, options, dict(os.environ)))
+    monkeypatch.setattr(uvicorn, "run", run)
+    monkeypatch.setattr(serve.os, "cpu_count", lambda: 16)
+
+    serve.main(["--workers", "4", "--limit-concurrency", "500", "--loop", "asyncio", "--http", "h11"])
+    (app, options, env), = runs
+    assert app == "api.main:app"
+    assert options["workers"] == 4
+    assert options["limit_concurrency"] == 500
+    assert (options["loop"], options["http"]) == ("asyncio", "h11")
+    assert options["timeout_graceful_shutdown"] == 30
+    assert not options["reload"]
+    # The workers share the CPUs for hashing, and their metrics in a directory removed when the server stops
+    assert env["API_PASSWORD_HASH_WORKERS"] == "4"
+    assert env["API_WORKERS"] == "4"
+    assert env[serve.STARTED_AT_ENV]
+    assert not os.path.exists(env["PROMETHEUS_MULTIPROC_DIR"])
+
+
+def test_serve_defaults(monkeypatch, environment):
+    monkeypatch.setenv("WEB_CONCURRENCY", "3")
+    assert serve.parse_args([]).workers == 3
+    assert serve.parse_args(["--reload"]).reload
+    assert serve.prepare_environment(1) is None
+    assert "PROMETHEUS_MULTIPROC_DIR" not in os.environ
+    assert "API_WORKERS" not in os.environ
+
+
+@pytest.mark.parametrize("argv", [["--workers", "0"], ["--loop", "trio"]])
+def test_serve_invalid_options(argv, environment):
+    with pytest.raises(SystemExit):
+        serve.parse_args(argv)
+
+
+@pytest.mark.skipif(importlib.util.find_spec("uvloop") is not None, reason="uvloop is installed")
+def test_serve_uvloop_not_installed(capsys, environment):
+    with pytest.raises(SystemExit):
+        serve.parse_args(["--loop", "uvloop"])
+    assert "needs the `uvloop` package" in capsys.readouterr().err
@@ -0,0 +1,26 @@
+import pytest
+
+from api.startup import LAZY_MODULES, import_times, measure_startup, package_times
+
+# The time a fresh interpreter takes to import the app and answer its first request, in process. The lifespan, which
+# waits for the database, is left out. It takes well under a second on a laptop, the margin absorbs slow CI machines.
+STARTUP_BUDGET_SECONDS = 1.5
+
+
+def test_import_times():
+    times = import_times()
+    modules = {time_.module for time_ in times}
+    assert "api.main" in modules
+    # The heavy, rarely used dependencies are imported on first use
+    assert not modules & set(LAZY_MODULES)
+    packages = package_times(times)
+    assert "api" in packages
+    assert list(packages.values()) == sorted(packages.values(), reverse=True)
+
+
+def test_time_to_first_request():
+    pytest.importorskip("mongomock_motor")
+    # In memory, so that the test needs no MongoDB server.
+    timings = measure_startup(in_memory=True)
+    assert timings["lazy_modules_loaded"] == []
+    assert timings["import_seconds"] + timings["first_request_seconds"] < STARTUP_BUDGET_SECONDS, timings
@@ -0,0 +1,72 @@
+import gzip
+
+import pytest
+
+from api.hashing import hash_password_sync
+from api.schemas import UserCreate
+from api.transfer import MAX_LINE_BYTES, parse_rows, read_records
+
+CSV = b'email,first_name,last_name\nada@gmail.com,Ada,"Lovelace, ""Countess""\nof Lovelace"\r\n\n\nalan@gmail.com,Alan,Turing'
+
+
+async def chunks_of(data: bytes, size: int):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+async def records_of(data: bytes, size: int, gzipped: bool = False, quoted: bool = True, chunk_size: int = 100):
+    return [records async for records in read_records(chunks_of(data, size), gzipped, quoted, chunk_size)]
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("size", [1, 7, len(CSV)])
+async def test_read_records(size):
+    # A quoted line break continues the record, blank lines are skipped, the line numbers are the ones of the file
+    assert await records_of(CSV, size) == [[
+        (1, b"email,first_name,last_name"),
+        (2, b'ada@gmail.com,Ada,"Lovelace, ""Countess""\nof Lovelace"'),
+        (6, b"alan@gmail.com,Alan,Turing"),
+    ]]
+    assert await records_of(gzip.compress(CSV), size, gzipped=True) == await records_of(CSV, size)
+    assert [len(records) for records in await records_of(CSV, size, chunk_size=2)] == [2, 1]
+
+
+@pytest.mark.anyio
+async def test_read_records_errors():
+    with pytest.raises(ValueError, match="not valid gzip data"):
+        await records_of(b"not gzip", 3, gzipped=True)
+    with pytest.raises(ValueError, match="not valid gzip data"):
+        await records_of(gzip.compress(CSV)[:-10], 3, gzipped=True)
+    with pytest.raises(ValueError, match="Line 2 is longer"):
+        await records_of(b"{}\n" + b"x" * (MAX_LINE_BYTES + 1), 1024)
+
+
+def test_parse_rows():
+    header = ["email", "first_name", "last_name", "password", "role"]
+    hashed = hash_password_sync("strong_password", n=16, r=8, p=1)
+    records = [(1, b"ada@gmail.com,Ada,Lovelace,strong_password,"),
+               (2, f"alan@gmail.com,Alan,Turing,{hashed},admin".encode()),
+               (3, b"grace,Grace,Hopper,strong_password,user"),
+               # A plaintext password shaped like a hash, and a hash cheaper than the configured cost
+               (4, b"linus@gmail.com,Linus,Torvalds,scrypt$1$1$1$ab$cd,user"),
+               (5, f"ken@gmail.com,Ken,Thompson,{hash_password_sync('strong', n=2, r=8, p=1)},user".encode())]
+    users, rejected = parse_rows(records, header)
+    # An empty value is a missing field, with its default
+    assert [(line, user.role.value, needs_hash) for line, user, needs_hash in users] == [
+        (1, "user", True), (2, "admin", False), (4, "user", True)]
+    assert users[1][1].password == hashed
+    assert users[2][1].password == "scrypt$1$1$1$ab$cd"
+    assert users[0][1].search_keys == ["ada lovelace", "lovelace", "ada", "ada@gmail.com"]
+    # The cheap hash is longer than a password can be, so the row is rejected
+    assert [row.line for row in rejected] == [3, 5]
+    assert rejected[1].errors[0].startswith("password:")
+    assert rejected[0].errors[0].startswith("email:")
+
+    user = UserCreate(email="ada@gmail.com", first_name="Ada", last_name="Lovelace", password="strong_password")
+    users, rejected = parse_rows([(1, user.json().encode()), (2, user.json(exclude={"password"}).encode()),
+                                  (3, b'{"_id": "nope", ' + user.json().encode()[1:]), (4, b"[1]"), (5, b"{")], None)
+    assert [line for line, _, _ in users] == [1]
+    assert [row.line for row in rejected] == [2, 3, 4, 5]
+    assert rejected[0].errors == ["password: field required"]
+    assert rejected[1].errors == ["_id: invalid ObjectId"]
+    assert rejected[2].errors == ["The row must be a JSON object."]
@@ -0,0 +1,54 @@
+import bson
+import orjson
+import pytest
+
+from api.schemas import Role, UserCreate
+from api.utils import UserGenerator, generate_users
+
+
+@pytest.mark.parametrize('parameter', [0, 1, 2, 3, 10])
+def test_generate_users(parameter):
+    users = generate_users(parameter)
+    assert len(users) == parameter
+    for user in users:
+        assert isinstance(user, UserCreate)
+        assert isinstance(user.role, Role)
+        assert user.date_of_birth is not None
+
+
+def test_generator_batches():
+    batches = list(UserGenerator().batches(25, 10))
+    assert [len(batch) for batch in batches] == [10, 10, 5]
+    emails = [user["email"] for batch in batches for user in batch]
+    assert len(set(emails)) == 25
+
+
+def test_generator_emails_are_unique():
+    users = [user for batch in UserGenerator(seed=1).batches(50000) for user in batch]
+    assert len({user["email"] for user in users}) == len(users)
+
+
+def test_generator_emails_of_two_seeds_do_not_overlap():
+    # The run 1 at position 0x10 and the run 0x11 at position 0 would both end with "110" without a separator
+    first, second = (UserGenerator(seed=seed).batch(0, 300) for seed in (0x1, 0x11))
+    suffixes = [{user["email"].split("@")[0].rsplit(".", 1)[1] for user in users} for users in (first, second)]
+    assert not suffixes[0] & suffixes[1]
+    assert not {user["email"] for user in first} & {user["email"] for user in second}
+
+
+def test_generator_is_reproducible():
+    assert list(UserGenerator(seed=42).batches(100, 30)) == list(UserGenerator(seed=42).batches(100, 30))
+    assert list(UserGenerator(seed=42).batches(100, 30)) != list(UserGenerator(seed=43).batches(100, 30))
+    # Unseeded runs tag their emails differently.
+    assert UserGenerator().batch(0, 1)[0]["email"] != UserGenerator().batch(0, 1)[0]["email"]
+
+
+@pytest.mark.parametrize('file_format', ["ndjson", "bson"])
+def test_generator_encoded_batches(file_format):
+    generator = UserGenerator(seed=7)
+    expected = [user for batch in generator.batches(30, 20) for user in batch]
+    data = b"".join(generator.encoded_batches(30, 20, file_format, workers=2))
+    if file_format == "bson":
+        assert bson.decode_all(data) == expected
+    else:
+        assert [orjson.loads(line) for line in data.splitlines()] == expected